@@ -1,6 +1,8 @@
 from bblfsh.client import BblfshClient
-from bblfsh.pyuast import decode, iterator, uast
+from bblfsh.compression import decode
+from bblfsh.pyuast import iterator, uast
 from bblfsh.tree_order import TreeOrder
 from bblfsh.aliases import *
-from bblfsh.roles import role_id, role_name
+from bblfsh.roles import role_id, role_name, role_mask
 from bblfsh.result_context import context
+from bblfsh.diff import diff
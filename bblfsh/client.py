@@ -68,7 +68,8 @@ class BblfshClient:
 
     def parse(self, filename: str, language: Optional[str]=None,
               contents: Optional[str]=None, mode: Optional[ModeType]=None,
-              timeout: int=60) -> ResultContext:
+              timeout: int=60, keep_response: bool=True,
+              keep_source: bool=False) -> ResultContext:
         """
         Queries the Babelfish server and receives the UAST response for the specified
         file.
@@ -83,10 +84,16 @@ class BblfshClient:
         :param mode:     UAST transformation mode.
         :param timeout: The request timeout in seconds. Zero or negative \
                         means no timeout.
+        :param keep_response: Keep the raw response in the result after \
+                              decoding it.
+        :param keep_source: Keep the contents in the result to get the text \
+                            of the nodes with node_text().
         :type filename: str
         :type language: str
         :type contents: str
         :type timeout: float
+        :type keep_response: bool
+        :type keep_source: bool
         :return: UAST object.
         """
         if timeout is None or timeout <= 0:
@@ -98,7 +105,8 @@ class BblfshClient:
                                content=contents, mode=mode,
                                language=self._scramble_language(language))
         response = self._stub_v2.Parse(request, timeout=timeout)
-        return ResultContext(response)
+        return ResultContext(response, keep_response=keep_response,
+                             source=contents if keep_source else None)
 
     def supported_languages(self) -> List[str]:
         sup_response = self._stub_v1.SupportedLanguages(SupportedLanguagesRequest())
@@ -21,7 +21,7 @@ import bblfsh.client as newbbl
 from bblfsh import role_id, role_name
 from bblfsh.node import Node
 from bblfsh.node_iterator import NodeIterator
-from bblfsh.result_context import ResultContext
+from bblfsh.result_context import Context, ResultContext
 from bblfsh.aliases import (
     ParseRequest, ParseResponse, DriverStub, ProtocolServiceStub,
     VersionRequest, SupportedLanguagesRequest, ModeType,
@@ -197,21 +197,20 @@ class CompatNodeIterator:
         return self
 
     def __next__(self) -> Node:
-        next_val = next(self._nodeit)
+        # Iterators created by iterator() and filter_nodes() already skip
+        # positions and scalars natively; this loop handles the rest.
+        while True:
+            next_val = next(self._nodeit)
 
-        is_node = isinstance(next_val, Node)
-        val = next_val.internal_node if is_node else next_val
+            is_node = isinstance(next_val, Node)
+            val = next_val.internal_node if is_node else next_val
 
-        # Skip positions and non dicts/lists, the later if only_nodes = True
-        skip = False
-        if isinstance(val, dict):
-            if "@type" not in val or val["@type"] == "uast:Positions":
-                skip = True
-        elif self._only_nodes:
-            skip = True
-
-        if skip:
-            val = self.__next__().internal_node
+            # Skip positions and non dicts/lists, the later if only_nodes = True
+            if isinstance(val, dict):
+                if "@type" in val and val["@type"] != "uast:Positions":
+                    break
+            elif not self._only_nodes:
+                break
 
         ret_val = next_val if is_node else Node(value=val)
         self._last_node = ret_val
@@ -247,10 +246,10 @@ def iterator(n: Union[Node, CompatNodeIterator, dict],
     if isinstance(n, CompatNodeIterator):
         return CompatNodeIterator(n._nodeit.iterate(order), only_nodes=True)
     elif isinstance(n, Node):
-        nat_it = native_iterator(n.internal_node, order)
+        nat_it = native_iterator(n.internal_node, order, nodes_only=True)
         return CompatNodeIterator(NodeIterator(nat_it), only_nodes=True)
     elif isinstance(n, dict):
-        nat_it = native_iterator(n, order)
+        nat_it = native_iterator(n, order, nodes_only=True)
         return CompatNodeIterator(NodeIterator(nat_it, uast()), only_nodes=True)
     else:
         raise WrongTypeException(
@@ -272,7 +271,9 @@ def filter_nodes(n: Node, query: str) -> CompatNodeIterator:
     Utility function. Same as filter() but will only filter for nodes (i. e.
     it will exclude scalars and positions).
     """
-    return CompatNodeIterator(filter(n, query)._nodeit, only_nodes=True)
+    ctx = uast()
+    nat_it = ctx.filter(query, n.internal_node, nodes_only=True)
+    return CompatNodeIterator(NodeIterator(nat_it, ctx), only_nodes=True)
 
 
 class TypedQueryException(Exception):
@@ -283,25 +284,30 @@ class TypedQueryException(Exception):
     pass
 
 
-def _scalariter2item(n: Node, query: str, wanted_type: type) -> Any:
-    rlist = list(filter(n, query))
-
-    if len(rlist) > 1:
-        raise TypedQueryException("More than one result for %s typed query" % str(type))
+# Typed queries are usually run several times on the same node, so the query
+# context of the last node, which maps its Python objects to libuast nodes, is
+# kept for the next query instead of building a new one for every call. As with
+# any Context, adding or removing fields of the tree in between requires
+# clearing it with _typed_query_ctx.invalidate().
+_typed_query_ctx: Optional[Context] = None
 
-    value = rlist[0]
-    if isinstance(value, Node):
-        value = value.internal_node
 
-    value_type = type(value)
-    if wanted_type == float and value_type == int:
-        value = float(value)
-
-    if not isinstance(value, wanted_type):
-        raise TypedQueryException("Typed query for type %s returned type %s instead"
-                        % (str(wanted_type), str(type(value))))
-
-    return wanted_type(value)
+def _scalariter2item(n: Node, query: str, wanted_type: type) -> Any:
+    global _typed_query_ctx
+    ctx = _typed_query_ctx
+    if ctx is None or ctx.root is not n.internal_node:
+        ctx = _typed_query_ctx = Context(n.internal_node)
+
+    try:
+        return ctx.eval_scalar(query, wanted_type)
+    except ValueError as e:
+        if not ctx.ctx.exists(query, ctx.root):
+            # as in the previous versions, which indexed the list of results
+            raise IndexError("no results for %s typed query" % str(wanted_type)) from None
+        raise TypedQueryException("%s for %s typed query" % (e, str(wanted_type))) from None
+    except TypeError as e:
+        raise TypedQueryException("Typed query for type %s failed: %s"
+                                  % (str(wanted_type), e)) from None
 
 
 def filter_string(n: Node, query: str) -> str:
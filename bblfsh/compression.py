@@ -0,0 +1,120 @@
+"""
+Optional compressed framing for encoded UASTs.
+
+A compressed UAST starts with a header made of MAGIC, the length of the codec
+name and the codec name, followed by the compressed data. decode() recognizes
+the header and decompresses the data before handing it to libuast, so plain and
+compressed UASTs can be decoded the same way.
+"""
+import zlib
+from typing import Callable, Dict, Union
+
+from bblfsh import pyuast
+
+# Differs from the magic number of the libuast binary format, so it can't be
+# mistaken for the beginning of an uncompressed UAST.
+MAGIC = b"\x00UZ\x01"
+
+BytesLike = Union[bytes, bytearray, memoryview]
+
+# Strings that appear in most UASTs, used as the preset dictionary of the zlib
+# codec. zlib finds matches faster near the end of the dictionary, so the most
+# frequent ones go last.
+UAST_ZDICT = "".join((
+    "uast:Import", "uast:RuntimeImport", "uast:ImportSelector",
+    "uast:Alias", "uast:Function", "uast:FunctionType", "uast:FunctionGroup",
+    "uast:Argument", "uast:Arguments", "uast:Results", "uast:QualifiedIdentifier",
+    "uast:Bool", "uast:Comment", "Prefix", "Suffix", "Tab", "Text", "Block",
+    "Target", "Names", "Path", "All", "Node", "Nodes", "Statements",
+    "uast:Block", "Format", "uast:String", "Value", "Name", "uast:Identifier",
+    "@token", "@role", "line", "col", "offset", "start", "end",
+    "uast:Position", "uast:Positions", "@pos", "@type",
+)).encode("utf-8")
+
+
+class Codec:
+    """
+    Compression algorithm that can be used to encode UASTs. The name is stored
+    in the header of the compressed data to select the codec on decode.
+    """
+    def __init__(self, name: str, compress: Callable[[bytes], bytes],
+                 decompress: Callable[[bytes], bytes]) -> None:
+        if not name or len(name.encode("utf-8")) > 255:
+            raise ValueError("codec name must have between 1 and 255 bytes")
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+
+
+class ZlibCodec(Codec):
+    def __init__(self, level: int = 6, zdict: bytes = UAST_ZDICT,
+                 name: str = "zlib") -> None:
+        super().__init__(name, self._compress, self._decompress)
+        self.level = level
+        self.zdict = zdict
+
+    def _compress(self, data: bytes) -> bytes:
+        c = zlib.compressobj(self.level, zdict=self.zdict)
+        return c.compress(data) + c.flush()
+
+    def _decompress(self, data: bytes) -> bytes:
+        d = zlib.decompressobj(zdict=self.zdict)
+        return d.decompress(data) + d.flush()
+
+
+_codecs: Dict[str, Codec] = {}
+
+
+def register_codec(codec: Codec) -> None:
+    """
+    Makes a codec available to encode and decode UASTs, replacing any codec
+    registered with the same name.
+    """
+    _codecs[codec.name] = codec
+
+
+def get_codec(name: str) -> Codec:
+    try:
+        return _codecs[name]
+    except KeyError:
+        raise ValueError("unknown UAST compression codec: %s" % name) from None
+
+
+register_codec(ZlibCodec())
+
+
+def is_compressed(data: BytesLike) -> bool:
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+def compress(data: BytesLike, codec: str = "zlib") -> bytes:
+    """
+    Compresses an encoded UAST and adds the header that identifies the codec.
+    """
+    c = get_codec(codec)
+    name = c.name.encode("utf-8")
+    return MAGIC + bytes((len(name),)) + name + c.compress(bytes(data))
+
+
+def decompress(data: BytesLike) -> bytes:
+    """
+    Returns the encoded UAST from data compressed with compress().
+    """
+    if not is_compressed(data):
+        raise ValueError("data is not a compressed UAST")
+    data = memoryview(data)
+    pos = len(MAGIC)
+    if len(data) <= pos:
+        raise ValueError("truncated compressed UAST header")
+    size = data[pos]
+    name = bytes(data[pos + 1:pos + 1 + size]).decode("utf-8")
+    return get_codec(name).decompress(bytes(data[pos + 1 + size:]))
+
+
+def decode(data: BytesLike, format: int = 0):
+    """
+    Decodes an encoded UAST, decompressing it first if it was compressed.
+    """
+    if is_compressed(data):
+        data = decompress(data)
+    return pyuast.decode(data, format=format)
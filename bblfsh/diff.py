@@ -0,0 +1,186 @@
+"""
+Structural diff between two versions of a UAST, based on subtree hashes.
+
+Identical subtrees are matched first, ignoring positions, so code that only
+moved in the file doesn't show up as changed. The remaining nodes are matched
+with nodes of the same type under matched parents; the rest were inserted or
+deleted.
+"""
+from bisect import bisect_right
+from collections import deque
+from typing import (
+    Any, Deque, Dict, FrozenSet, List, NamedTuple, Optional, Tuple, Union
+)
+
+from bblfsh.result_context import Context, ResultContext, SubtreeHash
+
+DiffContext = Union[ResultContext, Context]
+
+
+class TreeDiff(NamedTuple):
+    """
+    Changes between two trees. Inserted and deleted only contain the topmost
+    node of each inserted or deleted subtree, and moved only the topmost node
+    of each moved subtree, as (old, new) pairs. Updated contains the (old, new)
+    pairs of matched nodes whose own fields changed.
+    """
+    inserted: List[Any]
+    deleted: List[Any]
+    moved: List[Tuple[Any, Any]]
+    updated: List[Tuple[Any, Any]]
+
+
+def _sizes(hashes: List[SubtreeHash]) -> List[int]:
+    # number of nodes of each subtree; subtrees are contiguous in pre-order
+    sizes = [1] * len(hashes)
+    for i in range(len(hashes) - 1, 0, -1):
+        sizes[hashes[i].parent] += sizes[i]
+    return sizes
+
+
+def _fields(value: dict) -> FrozenSet[Tuple[str, Any]]:
+    # the fields of a node that aren't other nodes
+    return frozenset((k, v) for k, v in value.items()
+                     if k != "@pos" and not isinstance(v, (dict, list)))
+
+
+def _type(h: SubtreeHash) -> Any:
+    return h.value.get("@type")
+
+
+def _first_unmatched(candidates: Deque[int], matched: List[bool]) -> Optional[int]:
+    # candidates are kept in pre-order; the matched ones are dropped lazily
+    while candidates and matched[candidates[0]]:
+        candidates.popleft()
+    return candidates[0] if candidates else None
+
+
+def diff(old_ctx: DiffContext, new_ctx: DiffContext,
+         ignore_tokens: bool = False) -> TreeDiff:
+    """
+    Compares two trees, usually two parses of the same file, and returns the
+    nodes that were inserted, deleted, moved or updated. The nodes are those of
+    SubtreeHash.node: external nodes of a ResultContext, or dicts of a Python
+    context. With ignore_tokens, changes to tokens only aren't reported.
+    """
+    old = old_ctx.subtree_hashes(ignore_tokens=ignore_tokens)
+    new = new_ctx.subtree_hashes(ignore_tokens=ignore_tokens)
+    old_sizes, new_sizes = _sizes(old), _sizes(new)
+
+    old_to_new: Dict[int, int] = {}
+    new_matched = [False] * len(new)
+    # whether any node of each new subtree is matched
+    new_used = [False] * len(new)
+    # the roots of the subtrees matched by hash, which may have moved
+    identical: List[int] = []
+
+    by_hash: Dict[int, Deque[int]] = {}
+    by_hash_parent: Dict[Tuple[int, int], Deque[int]] = {}
+    for j, h in enumerate(new):
+        by_hash.setdefault(h.hash, deque()).append(j)
+        by_hash_parent.setdefault((h.hash, h.parent), deque()).append(j)
+
+    def match_subtree(i: int, j: int) -> None:
+        # identical subtrees have the same shape, so nodes pair up in pre-order
+        for k in range(old_sizes[i]):
+            old_to_new[i + k] = j + k
+            new_matched[j + k] = True
+            new_used[j + k] = True
+        # the ancestors of a used subtree were marked when it was matched
+        p = new[j].parent
+        while p != -1 and not new_used[p]:
+            new_used[p] = True
+            p = new[p].parent
+
+    # 1. top-down matching of identical subtrees, preferring the ones that keep
+    # their parent
+    i = 0
+    while i < len(old):
+        j = None
+        parent = old_to_new.get(old[i].parent)
+        if parent is not None:
+            kept = by_hash_parent.get((old[i].hash, parent))
+            if kept:
+                j = _first_unmatched(kept, new_used)
+        if j is None:
+            j = _first_unmatched(by_hash.get(old[i].hash, deque()), new_used)
+        if j is not None:
+            match_subtree(i, j)
+            identical.append(i)
+            i += old_sizes[i]
+        else:
+            i += 1
+
+    # 2. top-down matching of the remaining nodes with nodes of the same type
+    # under the matched parent: first the ones with the same fields, then the
+    # ones sharing most matched descendants
+    updated = []
+    old_fields = [_fields(h.value) for h in old]
+    by_type: Dict[Tuple[int, Any], List[int]] = {}
+    by_type_left: Dict[Tuple[int, Any], Deque[int]] = {}
+    by_fields: Dict[Tuple[int, Any, FrozenSet], Deque[int]] = {}
+    for j, h in enumerate(new):
+        if not new_matched[j]:
+            key = (h.parent, _type(h))
+            by_type.setdefault(key, []).append(j)
+            by_type_left.setdefault(key, deque()).append(j)
+            by_fields.setdefault(key + (_fields(h.value),), deque()).append(j)
+
+    def most_shared(i: int, candidates: List[int]) -> Optional[int]:
+        # the candidate holding most of the matched descendants of i; the
+        # candidates are siblings, so their subtrees are disjoint and sorted
+        shared: Dict[int, int] = {}
+        for k in range(i + 1, i + old_sizes[i]):
+            v = old_to_new.get(k)
+            if v is None:
+                continue
+            c = bisect_right(candidates, v) - 1
+            if c < 0:
+                continue
+            j = candidates[c]
+            if not new_matched[j] and v < j + new_sizes[j]:
+                shared[j] = shared.get(j, 0) + 1
+        if not shared:
+            return None
+        return min(shared, key=lambda j: (-shared[j], j))
+
+    for same_fields in (True, False):
+        for i, h in enumerate(old):
+            if i in old_to_new:
+                continue
+            if h.parent == -1:
+                parent = -1
+            elif h.parent in old_to_new:
+                parent = old_to_new[h.parent]
+            else:
+                continue
+            key = (parent, _type(h))
+            equal = by_fields.get(key + (old_fields[i],))
+            j = _first_unmatched(equal, new_matched) if equal else None
+            changed = j is None
+            if changed:
+                if same_fields or key not in by_type:
+                    continue
+                j = most_shared(i, by_type[key])
+                if j is None:
+                    j = _first_unmatched(by_type_left[key], new_matched)
+                    if j is None:
+                        continue
+            old_to_new[i] = j
+            new_matched[j] = True
+            if changed:
+                updated.append((h.node, new[j].node))
+
+    moved = []
+    for i in identical:
+        j = old_to_new[i]
+        parent = old[i].parent
+        expected = -1 if parent == -1 else old_to_new.get(parent)
+        if expected != new[j].parent:
+            moved.append((old[i].node, new[j].node))
+
+    deleted = [h.node for i, h in enumerate(old)
+               if i not in old_to_new and (h.parent == -1 or h.parent in old_to_new)]
+    inserted = [h.node for j, h in enumerate(new)
+                if not new_matched[j] and (h.parent == -1 or new_matched[h.parent])]
+    return TreeDiff(inserted, deleted, moved, updated)
@@ -4,9 +4,9 @@ from typing import Union, List, cast, Optional, Any
 
 from bblfsh.pyuast import Context, NodeExt, IteratorExt, iterator
 
-from bblfsh.roles import role_id
+from bblfsh.roles import node_role_mask, role_id
 from bblfsh.tree_order import TreeOrder
-from bblfsh.type_aliases import ResultMultiType
+from bblfsh.type_aliases import PruneType, ResultMultiType
 
 
 class NodeTypedGetException(Exception):
@@ -51,29 +51,52 @@ class CompatPosition:
 # property with the dict or Node objects in properties or list/tuple properties
 # when .children is accessed (because the user could change the node using get_dict()
 # or .properties).
-# Also, all these " in children" are O(n) so this will be slow for frequently accessing
-# the children property on big nodes.
+# Membership is tracked by identity and the properties are only scanned again when
+# they changed (a key was added or removed, a value or a list item replaced) or
+# children were replaced or removed through this object, so walking .children
+# recursively is linear on the size of the tree.
 class CompatChildren(MutableSequence):
     def __init__(self, parent: "Node") -> None:
         self._par_dict = parent.get_dict()
+        self._fingerprint: Optional[tuple] = None
+        self._children: List[Any] = []
         self._children = self._sync_children()
 
+    def _props_fingerprint(self) -> tuple:
+        return tuple((k, id(v), tuple(map(id, v)) if type(v) in (list, tuple) else ())
+                     for k, v in self._par_dict.items() if k != "_children")
+
+    def _invalidate(self) -> None:
+        # removed children that are still in the properties are added back
+        self._fingerprint = None
+
     def _sync_children(self) -> List["Node"]:
         if "_children" not in self._par_dict:
             self._par_dict["_children"] = []
         children = self._par_dict["_children"]
+
+        fingerprint = self._props_fingerprint()
+        if children is self._children and fingerprint == self._fingerprint:
+            return children
+
+        seen = {id(c) for c in children}
         for k, v in self._par_dict.items():
             if k in ("_children", "@pos", "@role", "@type"):
                 continue
 
             tv = type(v)
             if tv in (Node, dict):
-                if v not in children:
+                if id(v) not in seen:
+                    seen.add(id(v))
                     children.append(v)
             elif tv in (list, tuple):
                 # Get all node|dict types inside the list and add to children
-                children.extend([i for i in v if type(i) in (Node, dict) and i not in children])
+                for i in v:
+                    if type(i) in (Node, dict) and id(i) not in seen:
+                        seen.add(id(i))
+                        children.append(i)
             # else ignore it
+        self._fingerprint = fingerprint
         return children
 
     @staticmethod
@@ -91,9 +114,11 @@ class CompatChildren(MutableSequence):
 
     def __delitem__(self, idx: Union[int, slice]) -> None:
         del self._children[idx]
+        self._invalidate()
 
     def __setitem__(self, idx: Union[int, slice], val: Union['Node', dict]) -> None:
         self._par_dict["_children"].__setitem__(idx, self._node2dict(val))
+        self._invalidate()
         self._children = self._sync_children()
 
     def insert(self, idx: int, val: Union['Node', dict]) -> None:
@@ -142,6 +167,7 @@ class Node:
 
         self.ctx = ctx
         self.node_ext = node_ext
+        self._children_view: Optional[CompatChildren] = None
 
     def __str__(self) -> str:
         return str(self.get())
@@ -176,18 +202,39 @@ class Node:
     def get_dict(self) -> dict:
         return cast(dict, self._get_typed(dict))
 
-    def _iterator(self, it: IteratorExt) -> 'NodeIterator':
+    def _iterator(self, it: IteratorExt, prune: PruneType = None) -> 'NodeIterator':
         # TODO: this avoids circular imports; any better way to make it work?
         import bblfsh.node_iterator
-        return bblfsh.node_iterator.NodeIterator(it, self.ctx)
+        return bblfsh.node_iterator.NodeIterator(it, self.ctx, prune)
 
-    def iterate(self, order: int) -> 'NodeIterator':
+    def iterate(self, order: int, max_depth: Optional[int] = None,
+                prune: PruneType = None, skippable: bool = False) -> 'NodeIterator':
         TreeOrder.check_order(order)
-        return self._iterator(iterator(self.node_ext, order))
+        if max_depth is None and prune is None and not skippable:
+            return self._iterator(iterator(self.node_ext, order))
+
+        it = iterator(self.node_ext, order,
+                      max_depth=-1 if max_depth is None else max_depth, prunable=True)
+        return self._iterator(it, prune)
 
     def filter(self, query: str) -> 'NodeIterator':
         return self._iterator(self.ctx.filter(query, self.node_ext))
 
+    def count(self, query: str) -> int:
+        return self.ctx.count(query, self.node_ext)
+
+    def exists(self, query: str) -> bool:
+        return self.ctx.exists(query, self.node_ext)
+
+    def first(self, query: str) -> Optional[Union[ResultMultiType, 'Node']]:
+        res = self.ctx.first(query, self.node_ext)
+        if isinstance(res, NodeExt):
+            return Node(node_ext=res, ctx=self.ctx)
+        return res
+
+    def eval_scalar(self, query: str, type: Optional[type] = None) -> ResultMultiType:
+        return self.ctx.eval_scalar(query, self.node_ext, type)
+
     # TODO(juanjux): backward compatibility methods, remove once v1
     #                is definitely deprecated
 
@@ -217,7 +264,13 @@ class Node:
 
     @property
     def children(self) -> List["Node"]:
-        return CompatChildren(self)
+        view = self._children_view
+        if view is None or view._par_dict is not self.internal_node:
+            view = CompatChildren(self)
+            self._children_view = view
+        else:
+            view._children = view._sync_children()
+        return view
 
     @property
     def token(self) -> str:
@@ -232,6 +285,13 @@ class Node:
     def roles(self) -> List:
         return [role_id(name) for name in self.get_dict().get("@role", [])]
 
+    @property
+    def role_mask(self) -> int:
+        """
+        Bitmask of the roles of the node, see roles.role_mask().
+        """
+        return node_role_mask(self.get_dict())
+
     def _add_position(self) -> None:
         d = self.get_dict()
         if "@pos" not in d:
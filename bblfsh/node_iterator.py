@@ -1,21 +1,28 @@
-from typing import Union, Optional
+import itertools
+from typing import List, Union, Optional
 
 from bblfsh.node import Node
-from bblfsh.pyuast import Context, IteratorExt, NodeExt, iterator
+from bblfsh.pyuast import Context, Iterator, IteratorExt, NodeExt, iterator
 from bblfsh.tree_order import TreeOrder
-from bblfsh.type_aliases import ResultMultiType
+from bblfsh.type_aliases import PruneType, ResultMultiType
 
 
 class NodeIterator:
     # ctx is not used but prevents the context from deallocating (bug). This is because
     # currently the IteratorExt will go away if the context from which it was
     # called does.
-    def __init__(self, iter_ext: IteratorExt, ctx: Context = None) -> None:
+    #
+    # prune is either a set of node types or a callable receiving each Node; the
+    # children of the matching nodes are skipped. It needs an iterator created
+    # with prunable=True.
+    def __init__(self, iter_ext: IteratorExt, ctx: Context = None,
+                 prune: PruneType = None) -> None:
         self._iter_ext = iter_ext
         # default, can be changed on self.iterate()
         self._order: TreeOrder = TreeOrder.PRE_ORDER
         # saves the last node for re-iteration with iterate()
         self._last_node: Optional[Node] = None
+        self._prune = prune
         self.ctx = ctx
 
     def __iter__(self) -> 'NodeIterator':
@@ -27,10 +34,49 @@ class NodeIterator:
         if isinstance(next_node, NodeExt):
             # save last node for potential re-iteration
             self._last_node = Node(node_ext=next_node, ctx=self.ctx)
+            if self._prune is not None and self._pruned(self._last_node):
+                self.skip_children()
             return self._last_node
         # non node (bool, str, etc)
         return next_node
 
+    def _pruned(self, node: Node) -> bool:
+        if callable(self._prune):
+            return bool(self._prune(node))
+
+        value = node.get()
+        return isinstance(value, dict) and value.get("@type") in self._prune
+
+    def skip_children(self) -> None:
+        """
+        Skips the children of the last returned node. Only available on iterators
+        created with a max_depth, prune or skippable argument.
+        """
+        self._iter_ext.skip_children()
+
+    def next_batch(self, n: int) -> List[Union[ResultMultiType, Node]]:
+        """
+        Returns a list with up to n next results; the list is empty once the
+        iteration has finished. This amortizes the per-result call overhead
+        of the iterator protocol when scanning large trees.
+        """
+        if self._prune is not None:
+            # every node has to be checked before moving past it
+            return list(itertools.islice(self, n))
+
+        if isinstance(self._iter_ext, (IteratorExt, Iterator)):
+            batch = self._iter_ext.next_batch(n)
+        else:
+            batch = list(itertools.islice(self._iter_ext, n))
+
+        res = [Node(node_ext=v, ctx=self.ctx) if isinstance(v, NodeExt) else v
+               for v in batch]
+        for v in reversed(res):
+            if isinstance(v, Node):
+                self._last_node = v
+                break
+        return res
+
     def iterate(self, order: int) -> 'NodeIterator':
         if self._last_node is None:
             self._last_node = Node(node_ext=next(self._iter_ext), ctx=self.ctx)
@@ -1,13 +1,70 @@
+#include <algorithm>
+#include <cerrno>
+#include <chrono>
 #include <cstdint>
 #include <cstdlib>
 #include <cstring>
+#include <deque>
+#include <memory>
+#include <new>
 #include <unordered_map>
+#include <utility>
+#include <vector>
+
+#ifdef _WIN32
+#include <io.h>
+#else
+#include <unistd.h>
+#endif
 
 #include <Python.h>
 #include <structmember.h>
 
 #include "libuast.hpp"
 
+// ==========================================
+//   Profiling counters
+// ==========================================
+
+// The counters are only compiled in if PYUAST_STATS is defined (see setup.py);
+// otherwise the STAT_* macros do nothing and stats() returns zeros.
+struct PyUastStats {
+    uint64_t nodeExts;       // PyNodeExt objects allocated
+    uint64_t nodes;          // Node wrappers of Python objects created
+    uint64_t nodesHighWater; // largest obj2node map of a context
+    uint64_t strings;        // strings allocated for libuast by AsString and KeyAt, one per call
+    uint64_t stringBytes;    // bytes of those strings
+    uint64_t iterSteps;      // steps of the native iterators
+    uint64_t libuastCalls;   // timed libuast calls
+    uint64_t libuastNs;      // time spent in them, callbacks included
+};
+
+static PyUastStats pyuastStats = {};
+
+#ifdef PYUAST_STATS
+// StatsTimer adds the time of its scope to the libuast counters.
+class StatsTimer {
+    std::chrono::steady_clock::time_point start;
+public:
+    StatsTimer() : start(std::chrono::steady_clock::now()) {}
+    ~StatsTimer() {
+        auto d = std::chrono::steady_clock::now() - start;
+        pyuastStats.libuastCalls++;
+        pyuastStats.libuastNs += (uint64_t)std::chrono::duration_cast<std::chrono::nanoseconds>(d).count();
+    }
+};
+
+#define STAT_INC(field) (pyuastStats.field++)
+#define STAT_ADD(field, n) (pyuastStats.field += (uint64_t)(n))
+#define STAT_MAX(field, n) (pyuastStats.field = std::max(pyuastStats.field, (uint64_t)(n)))
+#define STAT_TIMER() StatsTimer statsTimer_
+#else
+#define STAT_INC(field) ((void)0)
+#define STAT_ADD(field, n) ((void)0)
+#define STAT_MAX(field, n) ((void)0)
+#define STAT_TIMER() ((void)0)
+#endif
+
 // Used to store references to the Pyobjects instanced in String() and
 // ItemAt() methods. Those can't be DECREF'ed to 0 because libuast uses them
 // so we pass ownership to these lists and free them at the end of filter()
@@ -21,6 +78,98 @@ PyObject* asPyBuffer(uast::Buffer buf) {
     //return PyMemoryView_FromMemory((char*)(buf.ptr), buf.size, PyBUF_READ);
 }
 
+// Size of the chunks passed to the write method of file objects.
+static const size_t encodeChunkSize = 1 << 20;
+
+// writeFd writes the whole buffer to a file descriptor.
+// Returns false and sets an OSError on failure.
+static bool writeFd(int fd, const char* data, size_t size) {
+    bool ok = true;
+    Py_BEGIN_ALLOW_THREADS
+    while (size > 0) {
+        size_t n = std::min(size, encodeChunkSize);
+#ifdef _WIN32
+        int w = _write(fd, data, (unsigned int)n);
+#else
+        ssize_t w = write(fd, data, n);
+#endif
+        if (w < 0) {
+            if (errno == EINTR) continue;
+            ok = false;
+            break;
+        }
+        data += w;
+        size -= (size_t)w;
+    }
+    Py_END_ALLOW_THREADS
+    if (!ok) PyErr_SetFromErrno(PyExc_OSError);
+    return ok;
+}
+
+// checkEncodeDest checks that a destination of writeBuffer is valid before encoding.
+// Booleans are integers for Python, but they are never meant as a file descriptor.
+bool checkEncodeDest(PyObject* dest) {
+    if (PyBool_Check(dest)) {
+        PyErr_SetString(PyExc_TypeError, "cannot write to a bool, expected a file descriptor, "
+                                         "a writable buffer or an object with a write method");
+        return false;
+    }
+    return true;
+}
+
+// writeBuffer writes encoded data to a destination, which can be a file descriptor,
+// a writable buffer large enough for the data or an object with a write method.
+// File objects receive the data in chunks, so there is never a second copy of the
+// whole buffer. Takes ownership of the buffer.
+// Returns the number of bytes written as a new reference.
+PyObject* writeBuffer(uast::Buffer buf, PyObject* dest) {
+    std::unique_ptr<void, decltype(&free)> owner(buf.ptr, &free);
+    const char* data = (const char*)(buf.ptr);
+
+    if (PyLong_Check(dest) && !PyBool_Check(dest)) {
+        int fd = (int)PyLong_AsLong(dest);
+        if (fd == -1 && PyErr_Occurred()) return nullptr;
+        if (!writeFd(fd, data, buf.size)) return nullptr;
+        return PyLong_FromSize_t(buf.size);
+    }
+
+    if (PyObject_CheckBuffer(dest) && !PyBytes_Check(dest)) {
+        Py_buffer view;
+        if (PyObject_GetBuffer(dest, &view, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) != 0)
+            return nullptr;
+        if ((size_t)(view.len) < buf.size) {
+            PyBuffer_Release(&view);
+            PyErr_Format(PyExc_ValueError, "buffer is too small: %zd bytes, %zu needed",
+                         view.len, buf.size);
+            return nullptr;
+        }
+        memcpy(view.buf, data, buf.size);
+        PyBuffer_Release(&view);
+        return PyLong_FromSize_t(buf.size);
+    }
+
+    PyObject* write = PyObject_GetAttrString(dest, "write");
+    if (!write) return nullptr;
+
+    for (size_t off = 0; off < buf.size; off += encodeChunkSize) {
+        size_t n = std::min(buf.size - off, encodeChunkSize);
+        PyObject* chunk = PyBytes_FromStringAndSize(data + off, (Py_ssize_t)n);
+        if (!chunk) {
+            Py_DECREF(write);
+            return nullptr;
+        }
+        PyObject* res = PyObject_CallFunctionObjArgs(write, chunk, NULL);
+        Py_DECREF(chunk);
+        if (!res) {
+            Py_DECREF(write);
+            return nullptr;
+        }
+        Py_DECREF(res);
+    }
+    Py_DECREF(write);
+    return PyLong_FromSize_t(buf.size);
+}
+
 bool isContext(PyObject* obj);
 
 bool assertNotContext(PyObject* obj) {
@@ -31,6 +180,197 @@ bool assertNotContext(PyObject* obj) {
     return true;
 }
 
+// singleResult reads the only result of a query iterator. Sets a ValueError if
+// the query has no results or more than one.
+template<class T>
+bool singleResult(uast::Iterator<T> *it, T *out) {
+    if (!it->next()) {
+        PyErr_SetString(PyExc_ValueError, "query has no results");
+        return false;
+    }
+    *out = it->node();
+    if (it->next()) {
+        PyErr_SetString(PyExc_ValueError, "query has more than one result");
+        return false;
+    }
+    return true;
+}
+
+// asScalar checks that a query result is a value of the given type, converting
+// integers if a float is expected. Any value is accepted if the type is None.
+// Borrows the value and returns a new reference.
+PyObject* asScalar(PyObject* value, PyObject* type) {
+    if (!type || type == Py_None) {
+        Py_INCREF(value);
+        return value;
+    }
+    if (type == (PyObject*)&PyFloat_Type && PyLong_Check(value) && !PyBool_Check(value)) {
+        return PyNumber_Float(value);
+    }
+    int ok = PyObject_IsInstance(value, type);
+    if (ok < 0) return nullptr;
+    if (!ok) {
+        PyErr_Format(PyExc_TypeError, "query returned %s instead of %R",
+                     Py_TYPE(value)->tp_name, type);
+        return nullptr;
+    }
+    if (Py_TYPE(value) == (PyTypeObject*)type) {
+        Py_INCREF(value);
+        return value;
+    }
+    return PyObject_CallFunctionObjArgs(type, value, NULL);
+}
+
+// ==========================================
+//   Tree walk with depth limits and pruning
+// ==========================================
+
+class Node;
+
+// walkKind returns the kind of a node of the tree being walked. An external node
+// is loaded to find it out, so it is only asked for when the depth is limited.
+static NodeKind walkKind(uast::Context<Node*> *ctx, Node* node);
+static NodeKind walkKind(uast::Context<NodeHandle> *ctx, NodeHandle node);
+
+// Walker visits a tree in pre-order or level order, allowing to limit the depth
+// of the walk and to skip the children of the current node.
+//
+// Everything it knows about the shape of the tree comes from the native
+// PRE_ORDER iterator, so it returns the same nodes, arrays and values as a
+// plain iteration in that order as long as nothing is skipped. The pre-order
+// walk follows the native iterator and steps over the subtrees to skip after
+// counting them. The level-order walk gets the children of each node from
+// the pre-order of its subtree, one iterator per child to measure it, which
+// costs O(size) per expanded node.
+//
+// Only objects count as a depth level: the elements of an array field have
+// the depth of the node the field belongs to plus one, as do its scalar
+// fields. Finding out if a node is an object is only needed with max_depth.
+template<class T>
+class Walker {
+private:
+    // Frame is an object or array of the pre-order walk whose subtree is being
+    // visited, until end items have been read.
+    struct Frame {
+        size_t end;
+        int depth;
+    };
+
+    uast::Context<T> *ctx;
+    TreeOrder order;
+    int maxDepth;
+    std::unique_ptr<uast::Iterator<T>> it; // pre-order walk
+    std::vector<Frame> frames;             // pre-order walk
+    size_t read;                           // pre-order items read so far
+    std::deque<std::pair<T, int>> pending; // level-order walk
+    T cur;
+    int curDepth;
+    bool started;
+    bool skip;
+
+    // subtreeSize returns the number of items of the subtree of a node,
+    // including itself.
+    size_t subtreeSize(T node) {
+        std::unique_ptr<uast::Iterator<T>> sub(ctx->Iterate(node, PRE_ORDER));
+        size_t n = 0;
+        while (sub->next()) n++;
+        return n;
+    }
+    // childDepth returns the depth of the children of the current node.
+    int childDepth() {
+        return walkKind(ctx, cur) == NODE_OBJECT ? curDepth + 1 : curDepth;
+    }
+    // leavePre moves the pre-order walk past the current node, stepping over
+    // its subtree if it is skipped or too deep.
+    void leavePre() {
+        if (!skip && maxDepth < 0) return; // the depth is not needed
+        size_t size = subtreeSize(cur);
+        if (size <= 1) return;
+        if (!skip) {
+            int depth = childDepth();
+            if (depth <= maxDepth) {
+                frames.push_back(Frame{read + size - 1, depth});
+                return;
+            }
+        }
+        for (size_t i = 1; i < size && it->next(); i++) read++;
+    }
+    bool nextPre() {
+        if (!it->next()) return false;
+        read++;
+        cur = it->node();
+        while (!frames.empty() && frames.back().end < read) frames.pop_back();
+        curDepth = frames.empty() ? 0 : frames.back().depth;
+        return true;
+    }
+    // expandLevel queues the children of the current node for the level-order walk.
+    void expandLevel() {
+        if (skip || !cur) return;
+
+        std::unique_ptr<uast::Iterator<T>> sub(ctx->Iterate(cur, PRE_ORDER));
+        if (!sub->next()) return; // the node itself
+        int depth = -1;
+        while (sub->next()) {
+            T child = sub->node();
+            if (depth < 0) {
+                depth = maxDepth < 0 ? curDepth + 1 : childDepth();
+                if (maxDepth >= 0 && depth > maxDepth) return;
+            }
+            pending.push_back(std::make_pair(child, depth));
+            for (size_t n = subtreeSize(child); n > 1 && sub->next(); n--) {}
+        }
+    }
+public:
+    Walker(uast::Context<T> *c, T root, TreeOrder o, int depth) :
+        ctx(c), order(o), maxDepth(depth), read(0), cur(), curDepth(0), started(false), skip(false) {
+        if (!root) return;
+        if (order == LEVEL_ORDER) {
+            pending.push_back(std::make_pair(root, 0));
+        } else {
+            it.reset(ctx->Iterate(root, PRE_ORDER));
+        }
+    }
+
+    // supports checks if the walk can be done in the given order. Any order is
+    // walked in pre-order.
+    static bool supports(TreeOrder o) {
+        return o == ANY_ORDER || o == PRE_ORDER || o == LEVEL_ORDER;
+    }
+
+    bool next() {
+        if (order == LEVEL_ORDER) {
+            if (started) expandLevel();
+            started = true;
+            skip = false;
+
+            if (pending.empty()) return false;
+            cur = pending.front().first;
+            curDepth = pending.front().second;
+            pending.pop_front();
+            return true;
+        }
+        if (!it) return false;
+        if (started) leavePre();
+        started = true;
+        skip = false;
+        return nextPre();
+    }
+    T node() {
+        return cur;
+    }
+    // skipChildren prevents the walk from visiting the children of the current node.
+    void skipChildren() {
+        skip = true;
+    }
+};
+
+bool checkWalkOrder(TreeOrder order) {
+    if (Walker<NodeHandle>::supports(order)) return true;
+    PyErr_SetString(PyExc_ValueError,
+        "depth limits and pruning are only supported for pre-order and level-order iteration");
+    return false;
+}
+
 // ==========================================
 //  External UAST Node (managed by libuast)
 // ==========================================
@@ -103,9 +443,11 @@ extern "C"
 typedef struct {
   PyObject_HEAD
   ContextExt *ctx;
-  PyObject *pyCtx;
+  PyObject *pyCtx; // Python context kept alive by the iterator, if any
   uast::Iterator<NodeHandle> *iter;
+  Walker<NodeHandle> *walk; // used instead of iter if set
   bool freeCtx;
+  bool done;
 } PyUastIterExt;
 
 static void PyUastIterExt_dealloc(PyObject *self);
@@ -117,25 +459,109 @@ static PyObject *PyUastIterExt_iter(PyObject *self) {
 
 static PyObject *PyUastIterExt_toPy(ContextExt *ctx, NodeHandle node);
 
-static PyObject *PyUastIterExt_next(PyObject *self) {
-  auto it = (PyUastIterExt *)self;
+// PyUastIterExt_advance moves the iterator to the next node.
+// Returns 1 if there is a node, 0 at the end and -1 on error.
+static int PyUastIterExt_advance(PyUastIterExt *it) {
+  if (it->done) return 0;
 
   try {
-      if (!it->iter->next()) {
-        PyErr_SetNone(PyExc_StopIteration);
-        return nullptr;
+      STAT_INC(iterSteps);
+      STAT_TIMER();
+      bool ok = it->walk ? it->walk->next() : it->iter->next();
+      if (!ok) {
+        it->done = true;
+        return 0;
       }
   } catch (const std::exception& e) {
       PyErr_SetString(PyExc_RuntimeError, e.what());
-      return nullptr;
+      return -1;
+  }
+  return 1;
+}
+
+// PyUastIterExt_node returns the current node of the iterator.
+static NodeHandle PyUastIterExt_node(PyUastIterExt *it) {
+  return it->walk ? it->walk->node() : it->iter->node();
+}
+
+static PyObject *PyUastIterExt_next(PyObject *self) {
+  auto it = (PyUastIterExt *)self;
+
+  int res = PyUastIterExt_advance(it);
+  if (res <= 0) {
+    if (res == 0) PyErr_SetNone(PyExc_StopIteration);
+    return nullptr;
   }
 
-  NodeHandle node = it->iter->node();
+  NodeHandle node = PyUastIterExt_node(it);
   if (node == 0) Py_RETURN_NONE;
 
   return PyUastIterExt_toPy(it->ctx, node);
 }
 
+// PyUastIterExt_next_batch returns a list with up to n next nodes; the list is
+// empty once the iterator is exhausted.
+// Returns a new reference.
+static PyObject *PyUastIterExt_next_batch(PyObject *self, PyObject *args) {
+  auto it = (PyUastIterExt *)self;
+  Py_ssize_t n = 0;
+  if (!PyArg_ParseTuple(args, "n", &n)) return nullptr;
+  if (n < 0) {
+    PyErr_SetString(PyExc_ValueError, "batch size must not be negative");
+    return nullptr;
+  }
+
+  PyObject* list = PyList_New(0);
+  if (!list) return nullptr;
+
+  while (PyList_GET_SIZE(list) < n) {
+    int res = PyUastIterExt_advance(it);
+    if (res == 0) break;
+    if (res < 0) {
+      Py_DECREF(list);
+      return nullptr;
+    }
+
+    NodeHandle node = PyUastIterExt_node(it);
+    PyObject* obj = nullptr;
+    if (node == 0) {
+      Py_INCREF(Py_None);
+      obj = Py_None;
+    } else {
+      obj = PyUastIterExt_toPy(it->ctx, node);
+    }
+    if (!obj || PyList_Append(list, obj) < 0) {
+      Py_XDECREF(obj);
+      Py_DECREF(list);
+      return nullptr;
+    }
+    Py_DECREF(obj);
+  }
+  return list;
+}
+
+// PyUastIterExt_skip_children prevents the iterator from visiting the children
+// of the last returned node.
+static PyObject *PyUastIterExt_skip_children(PyObject *self, PyObject *Py_UNUSED(ignored)) {
+  auto it = (PyUastIterExt *)self;
+  if (!it->walk) {
+    PyErr_SetString(PyExc_RuntimeError, "iterator was not created with max_depth or prunable");
+    return nullptr;
+  }
+  it->walk->skipChildren();
+  Py_RETURN_NONE;
+}
+
+static PyMethodDef PyUastIterExt_methods[] = {
+    {"next_batch", (PyCFunction) PyUastIterExt_next_batch, METH_VARARGS,
+     "Return a list with up to n next nodes, empty at the end of the iteration"
+    },
+    {"skip_children", (PyCFunction) PyUastIterExt_skip_children, METH_NOARGS,
+     "Do not visit the children of the last returned node"
+    },
+    {nullptr}  // Sentinel
+};
+
 extern "C"
 {
   static PyTypeObject PyUastIterExtType = {
@@ -166,7 +592,7 @@ extern "C"
     0,                                // tp_weaklistoffset
     PyUastIterExt_iter,               // tp_iter: __iter()__ method
     (iternextfunc)PyUastIterExt_next, // tp_iternext: next() method
-    0,                                // tp_methods
+    PyUastIterExt_methods,            // tp_methods
     0,                                // tp_members
     0,                                // tp_getset
     0,                                // tp_base
@@ -187,6 +613,7 @@ extern "C"
 class ContextExt {
 private:
     uast::Context<NodeHandle> *ctx;
+    size_t encodedSize; // size of the data the context was decoded from
 
     // toPy allocates a new PyNodeExt with a specified handle.
     // Returns a new reference.
@@ -195,6 +622,7 @@ private:
 
         PyNodeExt *pyObj = PyObject_New(PyNodeExt, &PyNodeExtType);
         if (!pyObj) return nullptr;
+        STAT_INC(nodeExts);
 
         pyObj->ctx = this;
         pyObj->handle = node;
@@ -217,7 +645,7 @@ private:
         return node->handle;
     }
 
-    PyObject* newIter(uast::Iterator<NodeHandle> *it, bool freeCtx){
+    PyObject* newIter(uast::Iterator<NodeHandle> *it, bool freeCtx, Walker<NodeHandle> *walk = nullptr){
         PyUastIterExt *pyIt = PyObject_New(PyUastIterExt, &PyUastIterExtType);
         if (!pyIt) return nullptr;
 
@@ -225,15 +653,18 @@ private:
           Py_DECREF(pyIt);
           return nullptr;
         }
+        pyIt->pyCtx = nullptr;
         pyIt->iter = it;
+        pyIt->walk = walk;
         pyIt->ctx = this;
         pyIt->freeCtx = freeCtx;
+        pyIt->done = false;
         return (PyObject*)pyIt;
     }
 public:
     friend class Context;
 
-    ContextExt(uast::Context<NodeHandle> *c) : ctx(c) {
+    ContextExt(uast::Context<NodeHandle> *c, size_t size = 0) : ctx(c), encodedSize(size) {
     }
     ~ContextExt(){
         delete(ctx);
@@ -262,26 +693,133 @@ public:
         return newIter(iter, false);
     }
 
-    // Filter queries an external UAST.
+    // Walk iterates over an external UAST tree up to a given depth (unlimited
+    // if negative), allowing to skip the children of the visited nodes.
     // Borrows the reference.
-    PyObject* Filter(PyObject* node, const char* query){
+    PyObject* Walk(PyObject* node, TreeOrder order, int maxDepth){
+        if (!assertNotContext(node)) return nullptr;
+        if (!checkWalkOrder(order)) return nullptr;
+
+        NodeHandle h = toHandle(node);
+        return newIter(nullptr, false, new Walker<NodeHandle>(ctx, h, order, maxDepth));
+    }
+
+    // filterIter runs a query on an external UAST and returns the native iterator.
+    // The callers time the evaluation, which goes on while the iterator advances.
+    // Borrows the reference.
+    uast::Iterator<NodeHandle>* filterIter(PyObject* node, const char* query){
         if (!assertNotContext(node)) return nullptr;
 
         NodeHandle unode = toHandle(node);
         if (unode == 0) unode = ctx->RootNode();
 
-        auto it = ctx->Filter(unode, query);
+        return ctx->Filter(unode, query);
+    }
+
+    // Filter queries an external UAST.
+    // Borrows the reference.
+    PyObject* Filter(PyObject* node, const char* query){
+        uast::Iterator<NodeHandle>* it;
+        {
+            STAT_TIMER(); // the steps are timed by the iterator
+            it = filterIter(node, query);
+        }
+        if (!it) return nullptr;
         return newIter(it, false);
     }
 
+    // Count returns the number of results of a query without converting them.
+    // Borrows the reference.
+    PyObject* Count(PyObject* node, const char* query){
+        size_t n = 0;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<NodeHandle>> it(filterIter(node, query));
+            if (!it) return nullptr;
+            while (it->next()) n++;
+        }
+        return PyLong_FromSize_t(n);
+    }
+
+    // Exists checks if a query has at least one result.
+    // Borrows the reference.
+    PyObject* Exists(PyObject* node, const char* query){
+        bool found;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<NodeHandle>> it(filterIter(node, query));
+            if (!it) return nullptr;
+            found = it->next();
+        }
+        return PyBool_FromLong(found);
+    }
+
+    // First returns the first result of a query, or None if there are no results.
+    // Borrows the reference.
+    PyObject* First(PyObject* node, const char* query){
+        NodeHandle h = 0;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<NodeHandle>> it(filterIter(node, query));
+            if (!it) return nullptr;
+            if (!it->next()) Py_RETURN_NONE;
+            h = it->node();
+        }
+        return lookup(h);
+    }
+
+    // Scalar returns the only result of a query as a value of the given type,
+    // without creating an iterator. Borrows the reference.
+    PyObject* Scalar(PyObject* node, const char* query, PyObject* type){
+        NodeHandle h = 0;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<NodeHandle>> it(filterIter(node, query));
+            if (!it || !singleResult(it.get(), &h)) return nullptr;
+        }
+
+        PyObject* ext = lookup(h);
+        if (!ext || ext == Py_None) return ext;
+        PyObject* value = PyNodeExt_load((PyNodeExt*)ext, nullptr);
+        Py_DECREF(ext);
+        if (!value) return nullptr;
+
+        PyObject* res = asScalar(value, type);
+        Py_DECREF(value);
+        return res;
+    }
+
     // Encode serializes the external UAST.
     // Borrows the reference.
     PyObject* Encode(PyObject *node, UastFormat format) {
         if (!assertNotContext(node)) return nullptr;
 
+        STAT_TIMER();
         uast::Buffer data = ctx->Encode(toHandle(node), format);
         return asPyBuffer(data);
     }
+    // EncodeTo serializes UAST and writes it to a destination (see writeBuffer).
+    // Returns a new reference.
+    PyObject* EncodeTo(PyObject *node, UastFormat format, PyObject *dest) {
+        if (!assertNotContext(node) || !checkEncodeDest(dest)) return nullptr;
+
+        STAT_TIMER();
+        uast::Buffer data = ctx->Encode(toHandle(node), format);
+        return writeBuffer(data, dest);
+    }
+    // Extract copies the subtree of a node into a new context.
+    // Borrows the reference.
+    ContextExt* Extract(PyObject *node) {
+        if (!assertNotContext(node)) return nullptr;
+
+        uast::Buffer data = ctx->Encode(toHandle(node), UAST_BINARY);
+        std::unique_ptr<void, decltype(&free)> owner(data.ptr, &free);
+        return new ContextExt(uast::Decode(data, UAST_BINARY), data.size);
+    }
+    // EncodedSize returns the size of the data the context was decoded from, if any.
+    size_t EncodedSize() {
+        return encodedSize;
+    }
 };
 
 // PyUastIterExt_toPy is a function that looks up for nodes visited by iterator.
@@ -294,6 +832,7 @@ static PyObject *PyUastIterExt_toPy(ContextExt *ctx, NodeHandle node) {
 static void PyUastIterExt_dealloc(PyObject *self) {
   auto it = (PyUastIterExt *)self;
   delete(it->iter);
+  delete(it->walk);
 
   if (it->freeCtx && it->ctx) {
       delete(it->ctx);
@@ -301,6 +840,8 @@ static void PyUastIterExt_dealloc(PyObject *self) {
 
   it->freeCtx = false;
   it->ctx = nullptr;
+  // the context can go away only after the iterator is released
+  Py_CLEAR(it->pyCtx);
   Py_TYPE(self)->tp_free(self);
 }
 
@@ -340,11 +881,14 @@ static PyObject *PythonContextExt_filter(PythonContextExt *self, PyObject *args,
     PyObject* it = nullptr;
     try {
         it = self->p->Filter(node, query);
-        ((PythonContextExt *)it)->pyCtx = (PyObject *)self;
     } catch (const std::exception& e) {
         PyErr_SetString(PyExc_RuntimeError, e.what());
     }
 
+    if (it) {
+        Py_INCREF(self);
+        ((PyUastIterExt *)it)->pyCtx = (PyObject *)self;
+    }
     return it;
 }
 
@@ -357,6 +901,106 @@ static PyObject *PythonContextExt_encode(PythonContextExt *self, PyObject *args)
     return self->p->Encode(node, format);
 }
 
+// PythonContextExt_encode_to serializes UAST to a file descriptor, a file object or a buffer.
+// Returns the number of bytes written as a new reference.
+static PyObject *PythonContextExt_encode_to(PythonContextExt *self, PyObject *args, PyObject *kwargs) {
+    char* kwds[] = {(char*)"dest", (char*)"node", (char*)"format", NULL};
+    PyObject *dest = nullptr;
+    PyObject *node = nullptr;
+    UastFormat format = UAST_BINARY;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|Oi", kwds, &dest, &node, &format))
+      return nullptr;
+
+    try {
+        return self->p->EncodeTo(node, format, dest);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+// parseQueryArgs parses the (query, node=None) arguments shared by the query methods.
+static bool parseQueryArgs(PyObject *args, PyObject *kwargs, const char **query, PyObject **node) {
+    char* kwds[] = {(char*)"query", (char*)"node", NULL};
+    return PyArg_ParseTupleAndKeywords(args, kwargs, "s|O", kwds, query, node);
+}
+
+// PythonContextExt_count counts the results of a query.
+// Returns a new reference.
+static PyObject *PythonContextExt_count(PythonContextExt *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    if (!parseQueryArgs(args, kwargs, &query, &node)) return nullptr;
+
+    try {
+        return self->p->Count(node, query);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+// PythonContextExt_exists checks if a query has any results.
+// Returns a new reference.
+static PyObject *PythonContextExt_exists(PythonContextExt *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    if (!parseQueryArgs(args, kwargs, &query, &node)) return nullptr;
+
+    try {
+        return self->p->Exists(node, query);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+// PythonContextExt_first returns the first result of a query.
+// Returns a new reference.
+static PyObject *PythonContextExt_first(PythonContextExt *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    if (!parseQueryArgs(args, kwargs, &query, &node)) return nullptr;
+
+    try {
+        return self->p->First(node, query);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+// parseScalarArgs parses the (query, node=None, type=None) arguments of eval_scalar.
+static bool parseScalarArgs(PyObject *args, PyObject *kwargs, const char **query,
+                            PyObject **node, PyObject **type) {
+    char* kwds[] = {(char*)"query", (char*)"node", (char*)"type", NULL};
+    return PyArg_ParseTupleAndKeywords(args, kwargs, "s|OO", kwds, query, node, type);
+}
+
+// PythonContextExt_eval_scalar returns the only result of a query, checking its type.
+// Returns a new reference.
+static PyObject *PythonContextExt_eval_scalar(PythonContextExt *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    PyObject *type = nullptr;
+    if (!parseScalarArgs(args, kwargs, &query, &node, &type)) return nullptr;
+
+    try {
+        return self->p->Scalar(node, query, type);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+static PyObject *PythonContextExt_extract(PythonContextExt *self, PyObject *args);
+
+// PythonContextExt_encoded_size returns the size of the data this context was decoded from.
+// Returns a new reference.
+static PyObject *PythonContextExt_encoded_size(PythonContextExt *self, PyObject *Py_UNUSED(ignored)) {
+    return PyLong_FromSize_t(self->p->EncodedSize());
+}
+
 static PyMethodDef PythonContextExt_methods[] = {
     {"root", (PyCFunction) PythonContextExt_root, METH_NOARGS,
      "Return the root node attached to this query context"
@@ -367,9 +1011,30 @@ static PyMethodDef PythonContextExt_methods[] = {
     {"filter", (PyCFunction) PythonContextExt_filter, METH_VARARGS | METH_KEYWORDS,
      "Filter a provided UAST with XPath"
     },
+    {"count", (PyCFunction) PythonContextExt_count, METH_VARARGS | METH_KEYWORDS,
+     "Count the results of an XPath query"
+    },
+    {"exists", (PyCFunction) PythonContextExt_exists, METH_VARARGS | METH_KEYWORDS,
+     "Check if an XPath query has any results"
+    },
+    {"first", (PyCFunction) PythonContextExt_first, METH_VARARGS | METH_KEYWORDS,
+     "Return the first result of an XPath query or None"
+    },
+    {"eval_scalar", (PyCFunction) PythonContextExt_eval_scalar, METH_VARARGS | METH_KEYWORDS,
+     "Return the only result of an XPath query, checking its type"
+    },
     {"encode", (PyCFunction) PythonContextExt_encode, METH_VARARGS,
      "Encodes a UAST into a buffer"
     },
+    {"encode_to", (PyCFunction) PythonContextExt_encode_to, METH_VARARGS | METH_KEYWORDS,
+     "Encodes a UAST into a file descriptor, a file object or a writable buffer"
+    },
+    {"extract", (PyCFunction) PythonContextExt_extract, METH_VARARGS,
+     "Copy the subtree of a node into a new context"
+    },
+    {"encoded_size", (PyCFunction) PythonContextExt_encoded_size, METH_NOARGS,
+     "Return the size of the data this context was decoded from"
+    },
     {nullptr}  // Sentinel
 };
 
@@ -430,7 +1095,6 @@ private:
     NodeKind  kind;
 
     PyObject* keys;
-    std::string* str;
 
     // checkPyException checks a Python error status, and if it's set, throws an error.
     static void checkPyException() {
@@ -469,20 +1133,35 @@ private:
         return NODE_OBJECT;
     }
     Node* lookupOrCreate(PyObject* obj);
+
+    // utf8 returns a new std::string with the UTF-8 representation of a Python
+    // string: one allocation and copy per call, nothing is cached in the node.
+    // Borrows the reference.
+    static std::string* utf8(PyObject* obj) {
+        Py_ssize_t size = 0;
+        const char* s = PyUnicode_AsUTF8AndSize(obj, &size);
+        if (!s) {
+            checkPyException();
+            return nullptr;
+        }
+        STAT_INC(strings);
+        STAT_ADD(stringBytes, size);
+        return new std::string(s, (size_t)size);
+    }
 public:
     friend class Interface;
     friend class Context;
 
     // Node creates a new node associated with a given Python object and sets the kind.
     // Steals the reference.
-    Node(Interface* c, NodeKind k, PyObject* v) : keys(nullptr), str(nullptr) {
+    Node(Interface* c, NodeKind k, PyObject* v) : keys(nullptr) {
         ctx = c;
         obj = v;
         kind = k;
     }
     // Node creates a new node associated with a given Python object and automatically determines the kind.
     // Creates a new reference.
-    Node(Interface* c, PyObject* v) : keys(nullptr), str(nullptr) {
+    Node(Interface* c, PyObject* v) : keys(nullptr) {
         ctx = c;
         obj = v; Py_INCREF(v);
         kind = kindOf(v);
@@ -493,7 +1172,6 @@ public:
             keys = nullptr;
         }
         if (obj) Py_DECREF(obj);
-        if (str) delete str;
     }
 
     PyObject* toPy();
@@ -501,14 +1179,18 @@ public:
     NodeKind Kind() {
         return kind;
     }
+    // IsUastNode checks if the node is an object with a type, other than positions.
+    bool IsUastNode() {
+        if (kind != NODE_OBJECT || !PyDict_Check(obj)) return false;
+        PyObject* typ = PyDict_GetItemString(obj, "@type"); // borrows
+        if (!typ || !PyUnicode_Check(typ)) return false;
+        return PyUnicode_CompareWithASCIIString(typ, "uast:Positions") != 0;
+    }
+    // AsString returns the UTF-8 value of a string node. libuast takes ownership
+    // of the result, so every call allocates a new copy of the UTF-8 buffer that
+    // Python caches in the string object; the node keeps no duplicate of it.
     std::string* AsString() {
-        if (!str) {
-            const char* s = PyUnicode_AsUTF8(obj);
-            str = new std::string(s);
-        }
-
-        std::string* s = new std::string(*str);
-        return s;
+        return utf8(obj);
     }
     int64_t AsInt() {
         long long v = PyLong_AsLongLong(obj);
@@ -543,6 +1225,8 @@ public:
         return sz;
     }
 
+    // KeyAt returns the i-th key of an object node, as a new copy per call like
+    // AsString.
     std::string* KeyAt(size_t i) {
         if (obj == Py_None) return nullptr;
 
@@ -551,10 +1235,8 @@ public:
 
         PyObject* key = PyList_GetItem(keys, i); // borrows
         if (!key) return nullptr;
-        const char * k = PyUnicode_AsUTF8(key);
 
-        std::string* s = new std::string(k);
-        return s;
+        return utf8(key);
     }
     Node* ValueAt(size_t i) {
         if (obj == Py_None) return nullptr;
@@ -580,14 +1262,66 @@ public:
         Py_INCREF(v);
         PyList_SetItem(obj, i, v); // steals
     }
-    void SetKeyValue(std::string k, Node* val) {
-        PyObject* v = nullptr;
-        if (val && val->obj) {
-            v = val->obj;
-        } else {
-            v = Py_None;
+    void SetKeyValue(std::string k, Node* val);
+};
+
+// NodeArena allocates nodes in blocks instead of one by one, since all the
+// nodes of an interface are released at the same time.
+class NodeArena {
+private:
+    struct Block {
+        Node*  nodes;
+        size_t cap;
+        size_t used;
+    };
+    std::vector<Block> blocks;
+    size_t size; // nodes in all blocks
+    size_t next; // capacity of the next block
+
+    static const size_t minBlock = 16;
+    static const size_t maxBlock = 4096;
+
+    void grow(size_t cap) {
+        Block b;
+        b.nodes = static_cast<Node*>(::operator new(cap * sizeof(Node)));
+        b.cap = cap;
+        b.used = 0;
+        blocks.push_back(b);
+        next = std::max(minBlock, std::min(cap * 2, maxBlock));
+    }
+public:
+    NodeArena() : size(0), next(minBlock) {}
+    ~NodeArena() {
+        for (auto& b : blocks) {
+            for (size_t i = 0; i < b.used; i++)
+                b.nodes[i].~Node();
+            ::operator delete(b.nodes);
         }
-        PyDict_SetItemString(obj, k.data(), v); // new ref
+    }
+
+    // Reserve makes sure that the next n nodes are allocated in a single block.
+    void Reserve(size_t n) {
+        if (n == 0) return;
+        if (!blocks.empty() && blocks.back().cap - blocks.back().used >= n) return;
+        grow(n);
+    }
+
+    template<class... Args>
+    Node* New(Args&&... args) {
+        if (blocks.empty() || blocks.back().used == blocks.back().cap) grow(next);
+        Block& b = blocks.back();
+        Node* node = new (&b.nodes[b.used]) Node(std::forward<Args>(args)...);
+        b.used++;
+        size++;
+        return node;
+    }
+
+    size_t Size() const { return size; }
+    size_t Blocks() const { return blocks.size(); }
+    size_t Capacity() const {
+        size_t n = 0;
+        for (auto& b : blocks) n += b.cap;
+        return n;
     }
 };
 
@@ -606,22 +1340,53 @@ private:
     // will not execute concurrently, avoiding concurrent writers to the cache.
     std::unordered_map<PyObject*, Node*> obj2node;
 
-    static PyObject* newBool(bool v) {
-        if (v) Py_RETURN_TRUE;
+    // Storage for all the nodes in obj2node.
+    NodeArena nodes;
 
-        Py_RETURN_FALSE;
-    }
+    // Strings created for keys and short values, shared by all the nodes that
+    // use them. Most of them are repeated across the whole tree (field names,
+    // node types, roles), so this saves both allocations and memory.
+    std::unordered_map<std::string, PyObject*> strings;
 
-    // lookupOrCreate either creates a new object or returns existing one.
-    // In the first case it creates a new reference.
-    Node* lookupOrCreate(PyObject* obj) {
-        if (!obj || obj == Py_None) return nullptr;
+    // Longer values are unlikely to repeat.
+    static const size_t maxSharedString = 64;
 
-        Node* node = obj2node[obj];
-        if (node) return node;
+    // sharedString returns a Python string with the given value, reusing it if it
+    // was already created by this interface.
+    // Returns a new reference.
+    PyObject* sharedString(const std::string& v) {
+        auto it = strings.find(v);
+        if (it != strings.end()) {
+            Py_INCREF(it->second);
+            return it->second;
+        }
+
+        PyObject* obj = PyUnicode_FromStringAndSize(v.data(), (Py_ssize_t)v.size());
+        if (!obj) return nullptr;
+
+        Py_INCREF(obj); // owned by the cache
+        strings.emplace(v, obj);
+        return obj;
+    }
+
+    static PyObject* newBool(bool v) {
+        if (v) Py_RETURN_TRUE;
+
+        Py_RETURN_FALSE;
+    }
 
-        node = new Node(this, obj);
-        obj2node[obj] = node;
+    // lookupOrCreate either creates a new object or returns existing one.
+    // In the first case it creates a new reference.
+    Node* lookupOrCreate(PyObject* obj) {
+        if (!obj || obj == Py_None) return nullptr;
+
+        auto r = obj2node.emplace(obj, nullptr);
+        if (!r.second) return r.first->second;
+
+        Node* node = nodes.New(this, obj);
+        r.first->second = node;
+        STAT_INC(nodes);
+        STAT_MAX(nodesHighWater, obj2node.size());
         return node;
     }
 
@@ -632,18 +1397,20 @@ private:
     Node* createIfNotExists(NodeKind kind, PyObject* obj) {
         if (!obj || obj == Py_None) return nullptr;
 
-        Node* node = obj2node[obj];
+        auto r = obj2node.emplace(obj, nullptr);
         // This object's node is already cached; release the reference.
-        if (node) {
+        if (!r.second) {
             // It is safe to DECREF here, since an INCREF has already happened at
             // NewString (in PyUnicode_FromString), NewInt (in PyLong_FromLongLong),
             // NewUint, NewFloat or NewBool
             Py_DECREF(obj);
-            return node;
+            return r.first->second;
         }
 
-        node = new Node(this, kind, obj);
-        obj2node[obj] = node;
+        Node* node = nodes.New(this, kind, obj);
+        r.first->second = node;
+        STAT_INC(nodes);
+        STAT_MAX(nodesHighWater, obj2node.size());
         return node;
     }
 public:
@@ -653,10 +1420,27 @@ public:
     Interface(){
     }
     ~Interface(){
-        // Only needs to deallocate Nodes, since they own
+        // Nodes are released by the arena, they own
         // the same object as used in the map key.
-        for (auto it : obj2node)
-            delete(it.second);
+        for (auto it : strings)
+            Py_DECREF(it.second);
+    }
+
+    // reserve prepares the interface to create nodes for about n objects.
+    void reserve(size_t n) {
+        obj2node.reserve(obj2node.size() + n);
+        nodes.Reserve(n);
+    }
+
+    // stats returns a dictionary with the number of nodes created by this
+    // interface and the storage allocated for them.
+    // Returns a new reference.
+    PyObject* stats() {
+        return Py_BuildValue("{s:n,s:n,s:n,s:n}",
+            "nodes", (Py_ssize_t)nodes.Size(),
+            "blocks", (Py_ssize_t)nodes.Blocks(),
+            "capacity", (Py_ssize_t)nodes.Capacity(),
+            "strings", (Py_ssize_t)strings.size());
     }
 
     // toNode creates a new or returns an existing node associated with Python object.
@@ -688,7 +1472,12 @@ public:
         return createIfNotExists(NODE_ARRAY, arr);
     }
     Node* NewString(std::string v) {
-        PyObject* obj = PyUnicode_FromString(v.data());
+        PyObject* obj = nullptr;
+        if (v.size() <= maxSharedString) {
+            obj = sharedString(v);
+        } else {
+            obj = PyUnicode_FromStringAndSize(v.data(), (Py_ssize_t)v.size());
+        }
         return createIfNotExists(NODE_STRING, obj);
     }
     Node* NewInt(int64_t v) {
@@ -721,6 +1510,19 @@ Node* Node::lookupOrCreate(PyObject* obj) {
     return ctx->lookupOrCreate(obj);
 }
 
+void Node::SetKeyValue(std::string k, Node* val) {
+    PyObject* v = nullptr;
+    if (val && val->obj) {
+        v = val->obj;
+    } else {
+        v = Py_None;
+    }
+    PyObject* key = ctx->sharedString(k);
+    if (!key) checkPyException();
+    PyDict_SetItem(obj, key, v); // new ref
+    Py_DECREF(key);
+}
+
 // ==========================================
 //          Python UAST iterator
 // ==========================================
@@ -728,9 +1530,12 @@ Node* Node::lookupOrCreate(PyObject* obj) {
 typedef struct {
   PyObject_HEAD
   Context *ctx;
-  PyObject *pyCtx;
+  PyObject *pyCtx; // Python context kept alive by the iterator, if any
   uast::Iterator<Node*> *iter;
+  Walker<Node*> *walk; // used instead of iter if set
   bool freeCtx;
+  bool done;
+  bool nodesOnly; // only return objects with a type, except positions
 } PyUastIter;
 
 static void PyUastIter_dealloc(PyObject *self);
@@ -740,25 +1545,120 @@ static PyObject *PyUastIter_iter(PyObject *self) {
   return self;
 }
 
-static PyObject *PyUastIter_next(PyObject *self) {
-  auto it = (PyUastIter *)self;
+// PyUastIter_advance moves the iterator to the next node.
+// Returns 1 if there is a node, 0 at the end and -1 on error.
+static Node *PyUastIter_node(PyUastIter *it);
+
+static int PyUastIter_advance(PyUastIter *it) {
+  if (it->done) return 0;
 
   try {
-      if (!it->iter->next()) {
-        PyErr_SetNone(PyExc_StopIteration);
-        return nullptr;
+      while (true) {
+          STAT_INC(iterSteps);
+          bool ok;
+          {
+              STAT_TIMER();
+              ok = it->walk ? it->walk->next() : it->iter->next();
+          }
+          if (!ok) {
+            it->done = true;
+            return 0;
+          }
+          if (!it->nodesOnly) break;
+
+          Node* node = PyUastIter_node(it);
+          if (node && node->IsUastNode()) break;
       }
   } catch (const std::exception& e) {
       PyErr_SetString(PyExc_RuntimeError, e.what());
-      return nullptr;
+      return -1;
+  }
+  return 1;
+}
+
+// PyUastIter_node returns the current node of the iterator.
+static Node *PyUastIter_node(PyUastIter *it) {
+  return it->walk ? it->walk->node() : it->iter->node();
+}
+
+static PyObject *PyUastIter_next(PyObject *self) {
+  auto it = (PyUastIter *)self;
+
+  int res = PyUastIter_advance(it);
+  if (res <= 0) {
+    if (res == 0) PyErr_SetNone(PyExc_StopIteration);
+    return nullptr;
   }
 
-  Node* node = it->iter->node();
+  Node* node = PyUastIter_node(it);
   if (!node) Py_RETURN_NONE;
 
   return node->toPy(); // new ref
 }
 
+// PyUastIter_next_batch returns a list with up to n next nodes; the list is
+// empty once the iterator is exhausted.
+// Returns a new reference.
+static PyObject *PyUastIter_next_batch(PyObject *self, PyObject *args) {
+  auto it = (PyUastIter *)self;
+  Py_ssize_t n = 0;
+  if (!PyArg_ParseTuple(args, "n", &n)) return nullptr;
+  if (n < 0) {
+    PyErr_SetString(PyExc_ValueError, "batch size must not be negative");
+    return nullptr;
+  }
+
+  PyObject* list = PyList_New(0);
+  if (!list) return nullptr;
+
+  while (PyList_GET_SIZE(list) < n) {
+    int res = PyUastIter_advance(it);
+    if (res == 0) break;
+    if (res < 0) {
+      Py_DECREF(list);
+      return nullptr;
+    }
+
+    Node* node = PyUastIter_node(it);
+    PyObject* obj = nullptr;
+    if (!node) {
+      Py_INCREF(Py_None);
+      obj = Py_None;
+    } else {
+      obj = node->toPy(); // new ref
+    }
+    if (PyList_Append(list, obj) < 0) {
+      Py_DECREF(obj);
+      Py_DECREF(list);
+      return nullptr;
+    }
+    Py_DECREF(obj);
+  }
+  return list;
+}
+
+// PyUastIter_skip_children prevents the iterator from visiting the children
+// of the last returned node.
+static PyObject *PyUastIter_skip_children(PyObject *self, PyObject *Py_UNUSED(ignored)) {
+  auto it = (PyUastIter *)self;
+  if (!it->walk) {
+    PyErr_SetString(PyExc_RuntimeError, "iterator was not created with max_depth or prunable");
+    return nullptr;
+  }
+  it->walk->skipChildren();
+  Py_RETURN_NONE;
+}
+
+static PyMethodDef PyUastIter_methods[] = {
+    {"next_batch", (PyCFunction) PyUastIter_next_batch, METH_VARARGS,
+     "Return a list with up to n next nodes, empty at the end of the iteration"
+    },
+    {"skip_children", (PyCFunction) PyUastIter_skip_children, METH_NOARGS,
+     "Do not visit the children of the last returned node"
+    },
+    {nullptr}  // Sentinel
+};
+
 extern "C"
 {
   static PyTypeObject PyUastIterType = {
@@ -789,7 +1689,7 @@ extern "C"
     0,                              // tp_weaklistoffset
     PyUastIter_iter,                // tp_iter: __iter()__ method
     (iternextfunc)PyUastIter_next,  // tp_iternext: next() method
-    0,                              // tp_methods
+    PyUastIter_methods,             // tp_methods
     0,                              // tp_members
     0,                              // tp_getset
     0,                              // tp_base
@@ -819,12 +1719,48 @@ private:
         if (node == nullptr) Py_RETURN_NONE;
         return iface->toPy(node);
     }
-    // toNode returns a node associated with a Python object.
+    // toNode returns a node associated with a Python object. The nodes of the
+    // tree are created as libuast visits them, in blocks allocated on demand.
     // Creates a new reference.
     Node* toNode(PyObject* obj) {
         return iface->lookupOrCreate(obj);
     }
-    PyObject* newIter(uast::Iterator<Node*> *it, bool freeCtx){
+    // toEncodedNode is toNode for a tree that is about to be visited whole, as
+    // by Encode. The first tree encoded with this context sizes the node
+    // storage in one go.
+    // Creates a new reference.
+    Node* toEncodedNode(PyObject* obj) {
+        if (iface->obj2node.empty() && obj && (PyDict_Check(obj) || PyList_Check(obj)))
+            iface->reserve(countObjects(obj));
+        return iface->lookupOrCreate(obj);
+    }
+    // countObjects returns the number of objects reachable from a Python tree,
+    // which is the upper bound of the number of nodes libuast may ask for.
+    // Borrows the reference.
+    static size_t countObjects(PyObject* root) {
+        size_t n = 0;
+        std::vector<PyObject*> stack;
+        stack.push_back(root);
+        while (!stack.empty()) {
+            PyObject* obj = stack.back();
+            stack.pop_back();
+            if (obj == Py_None) continue;
+            n++;
+
+            if (PyDict_Check(obj)) {
+                PyObject *key, *val;
+                Py_ssize_t pos = 0;
+                while (PyDict_Next(obj, &pos, &key, &val)) // borrows
+                    stack.push_back(val);
+            } else if (PyList_Check(obj)) {
+                Py_ssize_t sz = PyList_Size(obj);
+                for (Py_ssize_t i = 0; i < sz; i++)
+                    stack.push_back(PyList_GetItem(obj, i)); // borrows
+            }
+        }
+        return n;
+    }
+    PyObject* newIter(uast::Iterator<Node*> *it, bool freeCtx, Walker<Node*> *walk = nullptr){
         PyUastIter *pyIt = PyObject_New(PyUastIter, &PyUastIterType);
         if (!pyIt) return nullptr;
 
@@ -832,9 +1768,13 @@ private:
           Py_DECREF(pyIt);
           return nullptr;
         }
+        pyIt->pyCtx = nullptr;
         pyIt->iter = it;
+        pyIt->walk = walk;
         pyIt->ctx = this;
         pyIt->freeCtx = freeCtx;
+        pyIt->done = false;
+        pyIt->nodesOnly = false;
         return (PyObject*)pyIt;
     }
 public:
@@ -869,34 +1809,153 @@ public:
         return newIter(iter, freeCtx);
     }
 
-    // Filter queries UAST.
+    // Walk enumerates UAST nodes up to a given depth (unlimited if negative),
+    // allowing to skip the children of the visited nodes.
     // Creates a new reference.
-    PyObject* Filter(PyObject* node, std::string query){
+    PyObject* Walk(PyObject* node, TreeOrder order, int maxDepth, bool freeCtx){
+        if (!assertNotContext(node)) return nullptr;
+        if (!checkWalkOrder(order)) return nullptr;
+
+        Node* unode = toNode(node);
+        return newIter(nullptr, freeCtx, new Walker<Node*>(ctx, unode, order, maxDepth));
+    }
+
+    // filterIter runs a query on UAST and returns the native iterator.
+    // The callers time the evaluation, which goes on while the iterator advances.
+    // Creates a new reference.
+    uast::Iterator<Node*>* filterIter(PyObject* node, std::string query){
         if (!assertNotContext(node)) return nullptr;
 
         Node* unode = toNode(node);
         if (unode == nullptr) unode = ctx->RootNode();
 
-        auto it = ctx->Filter(unode, query);
+        return ctx->Filter(unode, query);
+    }
+
+    // Filter queries UAST.
+    // Creates a new reference.
+    PyObject* Filter(PyObject* node, std::string query){
+        uast::Iterator<Node*>* it;
+        {
+            STAT_TIMER(); // the steps are timed by the iterator
+            it = filterIter(node, query);
+        }
+        if (!it) return nullptr;
         return newIter(it, false);
     }
+
+    // Count returns the number of results of a query without converting them.
+    // Creates a new reference.
+    PyObject* Count(PyObject* node, std::string query){
+        size_t n = 0;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<Node*>> it(filterIter(node, query));
+            if (!it) return nullptr;
+            while (it->next()) n++;
+        }
+        return PyLong_FromSize_t(n);
+    }
+
+    // Exists checks if a query has at least one result.
+    // Creates a new reference.
+    PyObject* Exists(PyObject* node, std::string query){
+        bool found;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<Node*>> it(filterIter(node, query));
+            if (!it) return nullptr;
+            found = it->next();
+        }
+        return PyBool_FromLong(found);
+    }
+
+    // First returns the first result of a query, or None if there are no results.
+    // Creates a new reference.
+    PyObject* First(PyObject* node, std::string query){
+        Node* n = nullptr;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<Node*>> it(filterIter(node, query));
+            if (!it) return nullptr;
+            if (!it->next()) Py_RETURN_NONE;
+            n = it->node();
+        }
+        return toPy(n); // new ref
+    }
+
+    // Scalar returns the only result of a query as a value of the given type,
+    // without creating an iterator. Creates a new reference.
+    PyObject* Scalar(PyObject* node, std::string query, PyObject* type){
+        Node* n = nullptr;
+        {
+            STAT_TIMER();
+            std::unique_ptr<uast::Iterator<Node*>> it(filterIter(node, query));
+            if (!it || !singleResult(it.get(), &n)) return nullptr;
+        }
+
+        PyObject* value = toPy(n); // new ref
+        if (!value) return nullptr;
+        PyObject* res = asScalar(value, type);
+        Py_DECREF(value);
+        return res;
+    }
     // Encode serializes UAST.
     // Creates a new reference.
     PyObject* Encode(PyObject *node, UastFormat format) {
         if (!assertNotContext(node)) return nullptr;
 
-        uast::Buffer data = ctx->Encode(toNode(node), format);
+        STAT_TIMER();
+        uast::Buffer data = ctx->Encode(toEncodedNode(node), format);
         return asPyBuffer(data);
     }
+    // EncodeTo serializes UAST and writes it to a destination (see writeBuffer).
+    // Returns a new reference.
+    PyObject* EncodeTo(PyObject *node, UastFormat format, PyObject *dest) {
+        if (!assertNotContext(node) || !checkEncodeDest(dest)) return nullptr;
+
+        STAT_TIMER();
+        uast::Buffer data = ctx->Encode(toEncodedNode(node), format);
+        return writeBuffer(data, dest);
+    }
+    // Stats returns the allocation statistics of the nodes of this context.
+    // Returns a new reference.
+    PyObject* Stats() {
+        return iface->stats();
+    }
     PyObject* LoadFrom(PyNodeExt *src) {
         auto sctx = src->ctx->ctx;
         NodeHandle snode = src->handle;
 
-        Node* node = uast::Load(sctx, snode, ctx);
+        Node* node;
+        {
+            STAT_TIMER();
+            node = uast::Load(sctx, snode, ctx);
+        }
         return toPy(node); // new ref
     }
+
+    // LoadKind returns the kind of an external node, loading its subtree into
+    // this context.
+    NodeKind LoadKind(uast::Context<NodeHandle> *sctx, NodeHandle snode) {
+        Node* node;
+        {
+            STAT_TIMER();
+            node = uast::Load(sctx, snode, ctx);
+        }
+        return node ? node->Kind() : NODE_NULL;
+    }
 };
 
+static NodeKind walkKind(uast::Context<Node*> *ctx, Node* node) {
+    return node ? node->Kind() : NODE_NULL;
+}
+
+static NodeKind walkKind(uast::Context<NodeHandle> *ctx, NodeHandle node) {
+    Context loaded;
+    return loaded.LoadKind(ctx, node);
+}
+
 static PyObject *PyNodeExt_load(PyNodeExt *self, PyObject *Py_UNUSED(ignored)) {
     auto ctx = new Context();
     PyObject* node = ctx->LoadFrom(self);
@@ -907,6 +1966,7 @@ static PyObject *PyNodeExt_load(PyNodeExt *self, PyObject *Py_UNUSED(ignored)) {
 static void PyUastIter_dealloc(PyObject *self) {
   auto it = (PyUastIter *)self;
   delete(it->iter);
+  delete(it->walk);
 
   if (it->freeCtx && it->ctx) {
       delete(it->ctx);
@@ -914,6 +1974,8 @@ static void PyUastIter_dealloc(PyObject *self) {
 
   it->freeCtx = false;
   it->ctx = nullptr;
+  // the context can go away only after the iterator is released
+  Py_CLEAR(it->pyCtx);
   Py_TYPE(self)->tp_free(self);
 }
 
@@ -933,23 +1995,69 @@ static PyObject *PythonContext_root(PythonContext *self, PyObject *Py_UNUSED(ign
 }
 
 static PyObject *PythonContext_filter(PythonContext *self, PyObject *args, PyObject *kwargs) {
-    char* kwds[] = {(char*)"query", (char*)"node", NULL};
+    char* kwds[] = {(char*)"query", (char*)"node", (char*)"nodes_only", NULL};
     const char *query = nullptr;
     PyObject *node = nullptr;
-    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s|O", kwds, &query, &node))
+    int nodesOnly = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "s|Op", kwds, &query, &node, &nodesOnly))
       return nullptr;
 
     PyObject* it = nullptr;
     try {
         it = self->p->Filter(node, query);
-        ((PythonContext *)it)->pyCtx = (PyObject *)self;
     } catch (const std::exception& e) {
         PyErr_SetString(PyExc_RuntimeError, e.what());
     }
 
+    if (it) {
+        Py_INCREF(self);
+        ((PyUastIter *)it)->pyCtx = (PyObject *)self;
+        ((PyUastIter *)it)->nodesOnly = nodesOnly != 0;
+    }
+    return it;
+}
+
+// PythonContext_iterate iterates over a tree using this context, so the nodes
+// created for the Python objects are reused by later calls.
+// Returns a new reference.
+static PyObject *PythonContext_iterate(PythonContext *self, PyObject *args, PyObject *kwargs) {
+    char* kwds[] = {(char*)"node", (char*)"order", (char*)"max_depth", (char*)"prunable",
+                    (char*)"nodes_only", NULL};
+    PyObject *node = nullptr;
+    uint8_t order;
+    int maxDepth = -1;
+    int prunable = 0;
+    int nodesOnly = 0;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OB|ipp", kwds, &node, &order, &maxDepth,
+                                     &prunable, &nodesOnly))
+      return nullptr;
+
+    PyObject* it = nullptr;
+    try {
+        if (prunable || maxDepth >= 0) {
+            it = self->p->Walk(node, (TreeOrder)order, maxDepth, false);
+        } else {
+            it = self->p->Iterate(node, (TreeOrder)order, false);
+        }
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+    }
+
+    if (it) {
+        Py_INCREF(self);
+        ((PyUastIter *)it)->pyCtx = (PyObject *)self;
+        ((PyUastIter *)it)->nodesOnly = nodesOnly != 0;
+    }
     return it;
 }
 
+// PythonContext_arena_stats returns the number of nodes created by this context
+// and the storage allocated for them.
+// Returns a new reference.
+static PyObject *PythonContext_arena_stats(PythonContext *self, PyObject *Py_UNUSED(ignored)) {
+    return self->p->Stats();
+}
+
 static PyObject *PythonContext_encode(PythonContext *self, PyObject *args) {
     PyObject *node = nullptr;
     UastFormat format = UAST_BINARY; // TODO: make it a kwarg and enum
@@ -957,6 +2065,77 @@ static PyObject *PythonContext_encode(PythonContext *self, PyObject *args) {
     return self->p->Encode(node, format);
 }
 
+// PythonContext_encode_to serializes UAST to a file descriptor, a file object or a buffer.
+// Returns the number of bytes written as a new reference.
+static PyObject *PythonContext_encode_to(PythonContext *self, PyObject *args, PyObject *kwargs) {
+    char* kwds[] = {(char*)"dest", (char*)"node", (char*)"format", NULL};
+    PyObject *dest = nullptr;
+    PyObject *node = nullptr;
+    UastFormat format = UAST_BINARY;
+    if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|Oi", kwds, &dest, &node, &format))
+      return nullptr;
+
+    try {
+        return self->p->EncodeTo(node, format, dest);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+static PyObject *PythonContext_count(PythonContext *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    if (!parseQueryArgs(args, kwargs, &query, &node)) return nullptr;
+
+    try {
+        return self->p->Count(node, query);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+static PyObject *PythonContext_exists(PythonContext *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    if (!parseQueryArgs(args, kwargs, &query, &node)) return nullptr;
+
+    try {
+        return self->p->Exists(node, query);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+static PyObject *PythonContext_first(PythonContext *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    if (!parseQueryArgs(args, kwargs, &query, &node)) return nullptr;
+
+    try {
+        return self->p->First(node, query);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
+static PyObject *PythonContext_eval_scalar(PythonContext *self, PyObject *args, PyObject *kwargs) {
+    const char *query = nullptr;
+    PyObject *node = nullptr;
+    PyObject *type = nullptr;
+    if (!parseScalarArgs(args, kwargs, &query, &node, &type)) return nullptr;
+
+    try {
+        return self->p->Scalar(node, query, type);
+    } catch (const std::exception& e) {
+        PyErr_SetString(PyExc_RuntimeError, e.what());
+        return nullptr;
+    }
+}
+
 static PyMethodDef PythonContext_methods[] = {
     {"root", (PyCFunction) PythonContext_root, METH_NOARGS,
      "Return the root node attached to this query context"
@@ -964,9 +2143,30 @@ static PyMethodDef PythonContext_methods[] = {
     {"filter", (PyCFunction) PythonContext_filter, METH_VARARGS | METH_KEYWORDS,
      "Filter a provided UAST with XPath"
     },
+    {"iterate", (PyCFunction) PythonContext_iterate, METH_VARARGS | METH_KEYWORDS,
+     "Iterate over a provided UAST reusing this context"
+    },
+    {"count", (PyCFunction) PythonContext_count, METH_VARARGS | METH_KEYWORDS,
+     "Count the results of an XPath query"
+    },
+    {"exists", (PyCFunction) PythonContext_exists, METH_VARARGS | METH_KEYWORDS,
+     "Check if an XPath query has any results"
+    },
+    {"first", (PyCFunction) PythonContext_first, METH_VARARGS | METH_KEYWORDS,
+     "Return the first result of an XPath query or None"
+    },
+    {"eval_scalar", (PyCFunction) PythonContext_eval_scalar, METH_VARARGS | METH_KEYWORDS,
+     "Return the only result of an XPath query, checking its type"
+    },
     {"encode", (PyCFunction) PythonContext_encode, METH_VARARGS,
      "Encodes a UAST into a buffer"
     },
+    {"encode_to", (PyCFunction) PythonContext_encode_to, METH_VARARGS | METH_KEYWORDS,
+     "Encodes a UAST into a file descriptor, a file object or a writable buffer"
+    },
+    {"arena_stats", (PyCFunction) PythonContext_arena_stats, METH_NOARGS,
+     "Return the allocation statistics of the nodes of this context"
+    },
     {nullptr}  // Sentinel
 };
 
@@ -1018,21 +2218,43 @@ extern "C"
 //            Global functions
 // ==========================================
 
-static PyObject *PyUastIter_new(PyObject *self, PyObject *args) {
+static PyObject *PyUastIter_new(PyObject *self, PyObject *args, PyObject *kwargs) {
+  char* kwds[] = {(char*)"node", (char*)"order", (char*)"max_depth", (char*)"prunable",
+                  (char*)"nodes_only", NULL};
   PyObject *obj = nullptr;
   uint8_t order;
+  int maxDepth = -1;
+  int prunable = 0;
+  int nodesOnly = 0;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OB|ipp", kwds, &obj, &order, &maxDepth,
+                                   &prunable, &nodesOnly))
+    return nullptr;
 
-  if (!PyArg_ParseTuple(args, "OB", &obj, &order)) return nullptr;
+  // depth limits and pruning need the walker instead of the libuast iterator
+  bool walk = prunable || maxDepth >= 0;
 
   // the node can either be external or any other Python object
   if (PyObject_TypeCheck(obj, &PyNodeExtType)) {
     // external node -> external iterator
     auto node = (PyNodeExt*)obj;
+    if (nodesOnly) {
+      PyErr_SetString(PyExc_ValueError, "nodes_only is only supported on Python objects");
+      return nullptr;
+    }
+    if (walk) return node->ctx->Walk(obj, (TreeOrder)order, maxDepth);
     return node->ctx->Iterate(obj, (TreeOrder)order);
   }
   // Python object -> create a new context and attach it to an iterator
   Context* ctx = new Context();
-  return ctx->Iterate(obj, (TreeOrder)order, true);
+  PyObject* it = walk ? ctx->Walk(obj, (TreeOrder)order, maxDepth, true)
+                      : ctx->Iterate(obj, (TreeOrder)order, true);
+  if (!it) {
+    delete(ctx);
+    return nullptr;
+  }
+  ((PyUastIter *)it)->nodesOnly = nodesOnly != 0;
+  return it;
 }
 
 static PyObject *PythonContextExt_decode(PyObject *self, PyObject *args, PyObject *kwargs) {
@@ -1052,13 +2274,17 @@ static PyObject *PythonContextExt_decode(PyObject *self, PyObject *args, PyObjec
 
     try {
       uast::Buffer ubuf(buf.buf, (size_t)(buf.len));
-      uast::Context<NodeHandle>* ctx = uast::Decode(ubuf, format);
+      uast::Context<NodeHandle>* ctx;
+      {
+          STAT_TIMER();
+          ctx = uast::Decode(ubuf, format);
+      }
       pyU = PyObject_New(PythonContextExt, &PythonContextExtType);
 
       if (!pyU) {
         delete(ctx);
       } else {
-        pyU->p = new ContextExt(ctx);
+        pyU->p = new ContextExt(ctx, (size_t)(buf.len));
       }
     } catch (const std::exception& e) {
       PyErr_SetString(PyExc_RuntimeError, e.what());
@@ -1069,6 +2295,36 @@ static PyObject *PythonContextExt_decode(PyObject *self, PyObject *args, PyObjec
     return (PyObject*)pyU;
 }
 
+// PythonContextExt_extract copies the subtree of a node into a new context, which
+// doesn't keep this one alive.
+// Returns a new reference.
+static PyObject *PythonContextExt_extract(PythonContextExt *self, PyObject *args) {
+    PyObject *node = nullptr;
+    if (!PyArg_ParseTuple(args, "O", &node)) return nullptr;
+
+    if (!node || !PyObject_TypeCheck(node, &PyNodeExtType) || ((PyNodeExt*)node)->ctx != self->p) {
+      PyErr_SetString(PyExc_ValueError, "node must be a node of this context");
+      return nullptr;
+    }
+
+    PythonContextExt *pyU = nullptr;
+    try {
+      ContextExt* ctx = self->p->Extract(node);
+      if (!ctx) return nullptr;
+
+      pyU = PyObject_New(PythonContextExt, &PythonContextExtType);
+      if (!pyU) {
+        delete(ctx);
+      } else {
+        pyU->p = ctx;
+      }
+    } catch (const std::exception& e) {
+      PyErr_SetString(PyExc_RuntimeError, e.what());
+      pyU = nullptr;
+    }
+    return (PyObject*)pyU;
+}
+
 static PyObject *PythonContext_new(PyObject *self, PyObject *args) {
     // TODO: optionally accept root object
     if (!PyArg_ParseTuple(args, "")) return nullptr;
@@ -1085,10 +2341,541 @@ bool isContext(PyObject* obj) {
     return PyObject_TypeCheck(obj, &PythonContextExtType) || PyObject_TypeCheck(obj, &PythonContextType);
 }
 
+// ==========================================
+//            Subtree hashing
+// ==========================================
+
+// SubtreeHasher computes a structural hash (64-bit FNV-1a) of every node of a tree
+// of Python objects, combining the hashes of the children bottom-up, so equal
+// subtrees get equal hashes regardless of where they are. Object keys are hashed
+// in sorted order.
+class SubtreeHasher {
+private:
+    struct Entry {
+        uint64_t  hash;
+        Py_ssize_t parent;
+        PyObject* node; // borrowed
+    };
+
+    static const uint64_t offsetBasis = 14695981039346656037ULL;
+    static const uint64_t prime = 1099511628211ULL;
+
+    bool ignorePositions;
+    bool ignoreTokens;
+    std::vector<Entry> nodes;
+
+    static uint64_t add(uint64_t h, const void* data, size_t size) {
+        auto p = (const unsigned char*)data;
+        for (size_t i = 0; i < size; i++) {
+            h ^= p[i];
+            h *= prime;
+        }
+        return h;
+    }
+    static uint64_t addTag(uint64_t h, char tag) {
+        return add(h, &tag, 1);
+    }
+    static uint64_t addHash(uint64_t h, uint64_t v) {
+        return add(h, &v, sizeof(v));
+    }
+    static uint64_t addString(uint64_t h, const char* s, Py_ssize_t size) {
+        h = addHash(h, (uint64_t)size);
+        return add(h, s, (size_t)size);
+    }
+
+    bool skipKey(const char* key, Py_ssize_t size) {
+        if (size == 0 || key[0] != '@') return false;
+        std::string k(key, (size_t)size);
+        return (ignorePositions && k == "@pos") || (ignoreTokens && k == "@token");
+    }
+
+    // hash returns the hash of a value, recording the nodes (objects with a type) found
+    // if record is set. Borrows the reference. Throws if a Python error occurs.
+    uint64_t hash(PyObject* obj, Py_ssize_t parent, bool record) {
+        uint64_t h = offsetBasis;
+        if (!obj || obj == Py_None) return addTag(h, 'n');
+
+        if (PyBool_Check(obj)) return addTag(h, obj == Py_True ? 't' : 'f');
+        if (PyUnicode_Check(obj)) {
+            Py_ssize_t size = 0;
+            const char* s = PyUnicode_AsUTF8AndSize(obj, &size);
+            if (!s) throw std::runtime_error("cannot hash string");
+            return addString(addTag(h, 's'), s, size);
+        }
+        if (PyLong_Check(obj)) {
+            int overflow = 0;
+            long long v = PyLong_AsLongLongAndOverflow(obj, &overflow);
+            if (!overflow) return addHash(addTag(h, 'i'), (uint64_t)v);
+            unsigned long long u = PyLong_AsUnsignedLongLong(obj);
+            if (PyErr_Occurred()) throw std::runtime_error("cannot hash integer");
+            return addHash(addTag(h, 'u'), (uint64_t)u);
+        }
+        if (PyFloat_Check(obj)) {
+            double v = PyFloat_AsDouble(obj);
+            return add(addTag(h, 'd'), &v, sizeof(v));
+        }
+        if (PyList_Check(obj)) {
+            Py_ssize_t sz = PyList_Size(obj);
+            h = addHash(addTag(h, 'l'), (uint64_t)sz);
+            for (Py_ssize_t i = 0; i < sz; i++)
+                h = addHash(h, hash(PyList_GetItem(obj, i), parent, record)); // borrows
+            return h;
+        }
+        if (!PyDict_Check(obj)) throw std::runtime_error("unsupported value type");
+
+        // objects with a type are the nodes of the tree
+        Py_ssize_t idx = parent;
+        PyObject* typ = PyDict_GetItemString(obj, "@type"); // borrows
+        if (record && typ && PyUnicode_Check(typ)) {
+            idx = (Py_ssize_t)nodes.size();
+            nodes.push_back(Entry{0, parent, obj});
+        }
+
+        std::vector<std::pair<std::string, PyObject*>> fields;
+        PyObject *key, *val;
+        Py_ssize_t pos = 0;
+        while (PyDict_Next(obj, &pos, &key, &val)) { // borrows
+            Py_ssize_t size = 0;
+            const char* k = PyUnicode_Check(key) ? PyUnicode_AsUTF8AndSize(key, &size) : nullptr;
+            if (!k) throw std::runtime_error("object keys must be strings");
+            if (skipKey(k, size)) continue;
+            fields.emplace_back(std::string(k, (size_t)size), val);
+        }
+        std::sort(fields.begin(), fields.end(),
+            [](const std::pair<std::string, PyObject*>& a, const std::pair<std::string, PyObject*>& b) {
+                return a.first < b.first;
+            });
+
+        h = addHash(addTag(h, 'o'), (uint64_t)fields.size());
+        for (auto& f : fields) {
+            h = addString(h, f.first.data(), (Py_ssize_t)f.first.size());
+            // like libuast iterators, don't visit the nodes in attributes (positions)
+            bool attr = !f.first.empty() && f.first[0] == '@';
+            h = addHash(h, hash(f.second, idx, record && !attr));
+        }
+        if (idx != parent) nodes[idx].hash = h;
+        return h;
+    }
+public:
+    SubtreeHasher(bool positions, bool tokens) : ignorePositions(positions), ignoreTokens(tokens) {}
+
+    // Hash returns a list of (hash, parent index, node) tuples for the nodes of a tree in
+    // pre-order. The parent index of the root is -1.
+    // Returns a new reference.
+    PyObject* Hash(PyObject* root) {
+        hash(root, -1, true);
+
+        PyObject* list = PyList_New((Py_ssize_t)nodes.size());
+        if (!list) return nullptr;
+        for (size_t i = 0; i < nodes.size(); i++) {
+            auto& e = nodes[i];
+            PyObject* t = Py_BuildValue("(KnO)", (unsigned long long)e.hash, e.parent, e.node);
+            if (!t) {
+                Py_DECREF(list);
+                return nullptr;
+            }
+            PyList_SET_ITEM(list, (Py_ssize_t)i, t); // steals
+        }
+        return list;
+    }
+};
+
+static PyObject *PyUast_subtree_hashes(PyObject *self, PyObject *args, PyObject *kwargs) {
+  char* kwds[] = {(char*)"node", (char*)"ignore_positions", (char*)"ignore_tokens", NULL};
+  PyObject *node = nullptr;
+  int ignorePositions = 1;
+  int ignoreTokens = 0;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|pp", kwds, &node, &ignorePositions, &ignoreTokens))
+    return nullptr;
+  if (!assertNotContext(node)) return nullptr;
+
+  try {
+    SubtreeHasher hasher(ignorePositions != 0, ignoreTokens != 0);
+    return hasher.Hash(node);
+  } catch (const std::exception& e) {
+    if (!PyErr_Occurred()) PyErr_SetString(PyExc_RuntimeError, e.what());
+    return nullptr;
+  }
+}
+
+// ==========================================
+//            Token extraction
+// ==========================================
+
+// TokenCollector gathers the tokens of a tree of Python objects: the "@token" of
+// each node or, for nodes without it, its "Name" or "Value" string field.
+class TokenCollector {
+private:
+    struct Token {
+        PyObject* token; // borrowed
+        PyObject* type;  // borrowed
+        PyObject* roles; // borrowed
+        long long offset;
+    };
+
+    PyObject* types; // set of node types to include, or null for any
+    PyObject* roles; // set of roles the nodes must have, or null for any
+    std::vector<Token> tokens;
+
+    // field returns a borrowed reference to a string field of a node, or null.
+    static PyObject* field(PyObject* obj, const char* key) {
+        PyObject* v = PyDict_GetItemString(obj, key); // borrows
+        return v && PyUnicode_Check(v) ? v : nullptr;
+    }
+
+    // startOffset returns the start offset of a node, or -1 if it has no position.
+    static long long startOffset(PyObject* obj) {
+        PyObject* pos = PyDict_GetItemString(obj, "@pos"); // borrows
+        if (!pos || !PyDict_Check(pos)) return -1;
+        PyObject* start = PyDict_GetItemString(pos, "start"); // borrows
+        if (!start || !PyDict_Check(start)) return -1;
+        PyObject* off = PyDict_GetItemString(start, "offset"); // borrows
+        if (!off || !PyLong_Check(off)) return -1;
+        return PyLong_AsLongLong(off);
+    }
+
+    // hasRoles checks if a node has all the requested roles.
+    bool hasRoles(PyObject* nodeRoles) {
+        if (!roles) return true;
+        if (!nodeRoles || !PyList_Check(nodeRoles)) return PySet_GET_SIZE(roles) == 0;
+
+        // every requested role must be in the list; counting the listed roles
+        // found in the set would accept repeated roles in place of missing ones
+        PyObject* it = PyObject_GetIter(roles);
+        if (!it) throw std::runtime_error("cannot check roles");
+        bool all = true;
+        while (PyObject* role = PyIter_Next(it)) {
+            int r = PySequence_Contains(nodeRoles, role);
+            Py_DECREF(role);
+            if (r <= 0) {
+                all = false;
+                if (r < 0) {
+                    Py_DECREF(it);
+                    throw std::runtime_error("cannot check roles");
+                }
+                break;
+            }
+        }
+        Py_DECREF(it);
+        if (PyErr_Occurred()) throw std::runtime_error("cannot check roles");
+        return all;
+    }
+
+    void visit(PyObject* obj) {
+        PyObject* typ = field(obj, "@type");
+        if (!typ) return;
+        if (types) {
+            int r = PySet_Contains(types, typ);
+            if (r < 0) throw std::runtime_error("cannot check types");
+            if (!r) return;
+        }
+
+        PyObject* token = field(obj, "@token");
+        if (!token) token = field(obj, "Name");
+        if (!token) token = field(obj, "Value");
+        if (!token) return;
+
+        PyObject* nodeRoles = PyDict_GetItemString(obj, "@role"); // borrows
+        if (!hasRoles(nodeRoles)) return;
+
+        tokens.push_back(Token{token, typ, nodeRoles, startOffset(obj)});
+    }
+public:
+    TokenCollector(PyObject* t, PyObject* r) : types(t), roles(r) {}
+
+    // Collect returns a list of (token, type, roles, start offset) tuples sorted by
+    // offset; tokens without a position go last, in document order.
+    // Returns a new reference.
+    PyObject* Collect(PyObject* root) {
+        std::vector<PyObject*> stack;
+        stack.push_back(root);
+        while (!stack.empty()) {
+            PyObject* obj = stack.back();
+            stack.pop_back();
+
+            if (PyList_Check(obj)) {
+                for (Py_ssize_t i = PyList_GET_SIZE(obj) - 1; i >= 0; i--)
+                    stack.push_back(PyList_GET_ITEM(obj, i));
+                continue;
+            }
+            if (!PyDict_Check(obj)) continue;
+            visit(obj);
+
+            // children are pushed in reverse to visit them in document order;
+            // attributes (positions, roles) contain no tokens
+            size_t first = stack.size();
+            PyObject *key, *val;
+            Py_ssize_t pos = 0;
+            while (PyDict_Next(obj, &pos, &key, &val)) { // borrows
+                if (!PyDict_Check(val) && !PyList_Check(val)) continue;
+                if (PyUnicode_Check(key) && PyUnicode_GET_LENGTH(key) > 0 && PyUnicode_READ_CHAR(key, 0) == '@') continue;
+                stack.push_back(val);
+            }
+            std::reverse(stack.begin() + first, stack.end());
+        }
+
+        std::stable_sort(tokens.begin(), tokens.end(), [](const Token& a, const Token& b) {
+            if (a.offset < 0 || b.offset < 0) return b.offset < 0 && a.offset >= 0;
+            return a.offset < b.offset;
+        });
+
+        PyObject* list = PyList_New((Py_ssize_t)tokens.size());
+        if (!list) return nullptr;
+        for (size_t i = 0; i < tokens.size(); i++) {
+            auto& t = tokens[i];
+            PyObject* roles = t.roles && PyList_Check(t.roles) ? PyList_AsTuple(t.roles) : PyTuple_New(0);
+            PyObject* item = roles ? Py_BuildValue("(OONL)", t.token, t.type, roles, t.offset) : nullptr;
+            if (!item) {
+                Py_DECREF(list);
+                return nullptr;
+            }
+            PyList_SET_ITEM(list, (Py_ssize_t)i, item); // steals
+        }
+        return list;
+    }
+};
+
+static PyObject *PyUast_tokens(PyObject *self, PyObject *args, PyObject *kwargs) {
+  char* kwds[] = {(char*)"node", (char*)"types", (char*)"roles", NULL};
+  PyObject *node = nullptr;
+  PyObject *types = nullptr;
+  PyObject *roles = nullptr;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "O|OO", kwds, &node, &types, &roles))
+    return nullptr;
+  if (!assertNotContext(node)) return nullptr;
+
+  // any iterable is accepted for the filters
+  PyObject *typeSet = nullptr, *roleSet = nullptr;
+  if (types && types != Py_None && !(typeSet = PySet_New(types))) return nullptr;
+  if (roles && roles != Py_None && !(roleSet = PySet_New(roles))) {
+    Py_XDECREF(typeSet);
+    return nullptr;
+  }
+
+  PyObject* res = nullptr;
+  try {
+    TokenCollector collector(typeSet, roleSet);
+    res = collector.Collect(node);
+  } catch (const std::exception& e) {
+    if (!PyErr_Occurred()) PyErr_SetString(PyExc_RuntimeError, e.what());
+  }
+  Py_XDECREF(typeSet);
+  Py_XDECREF(roleSet);
+  return res;
+}
+
+// RoleMask is a bitmask of role ids, bit N being set if the role with id N is present.
+class RoleMask {
+public:
+    std::vector<uint64_t> words;
+
+    // FromPy converts a non-negative Python integer. Returns false with a Python
+    // error set on failure.
+    bool FromPy(PyObject* obj) {
+        words.clear();
+        if (!obj || obj == Py_None) return true;
+        if (!PyLong_Check(obj)) {
+            PyErr_SetString(PyExc_TypeError, "role mask must be an integer");
+            return false;
+        }
+        PyObject* zero = PyLong_FromLong(0);
+        PyObject* shift = PyLong_FromLong(64);
+        if (!zero || !shift) {
+            Py_XDECREF(zero);
+            Py_XDECREF(shift);
+            return false;
+        }
+        if (PyObject_RichCompareBool(obj, zero, Py_LT) == 1) {
+            Py_DECREF(zero);
+            Py_DECREF(shift);
+            PyErr_SetString(PyExc_ValueError, "role mask must be non-negative");
+            return false;
+        }
+
+        Py_INCREF(obj);
+        while (obj && PyObject_RichCompareBool(obj, zero, Py_GT) == 1) {
+            words.push_back(PyLong_AsUnsignedLongLongMask(obj));
+            PyObject* rest = PyNumber_Rshift(obj, shift);
+            Py_DECREF(obj);
+            obj = rest;
+        }
+        Py_XDECREF(obj);
+        Py_DECREF(zero);
+        Py_DECREF(shift);
+        return !PyErr_Occurred();
+    }
+    void Set(size_t bit) {
+        if (bit / 64 >= words.size()) words.resize(bit / 64 + 1);
+        words[bit / 64] |= uint64_t(1) << (bit % 64);
+    }
+    void Clear() {
+        std::fill(words.begin(), words.end(), 0);
+    }
+    bool Empty() const {
+        for (auto w : words) if (w) return false;
+        return true;
+    }
+    // word returns the i-th word, zero past the end.
+    uint64_t word(size_t i) const {
+        return i < words.size() ? words[i] : 0;
+    }
+    bool ContainsAll(const RoleMask& m) const {
+        for (size_t i = 0; i < m.words.size(); i++)
+            if ((word(i) & m.words[i]) != m.words[i]) return false;
+        return true;
+    }
+    bool ContainsAny(const RoleMask& m) const {
+        for (size_t i = 0; i < m.words.size(); i++)
+            if (word(i) & m.words[i]) return true;
+        return false;
+    }
+};
+
+// RoleMatcher selects the nodes of a tree of Python objects by their roles,
+// converting the "@role" names of each node to a bitmask with a table of ids.
+class RoleMatcher {
+private:
+    PyObject* ids; // role name -> id, borrowed
+    RoleMask all, any, none;
+    RoleMask node;
+
+    bool matches(PyObject* obj) {
+        PyObject* roles = PyDict_GetItemString(obj, "@role"); // borrows
+        node.Clear();
+        if (roles && PyList_Check(roles)) {
+            Py_ssize_t sz = PyList_GET_SIZE(roles);
+            for (Py_ssize_t i = 0; i < sz; i++) {
+                PyObject* id = PyDict_GetItemWithError(ids, PyList_GET_ITEM(roles, i)); // borrows
+                if (!id) {
+                    if (PyErr_Occurred()) throw std::runtime_error("cannot look up role");
+                    continue; // unknown roles are ignored
+                }
+                long n = PyLong_AsLong(id);
+                if (n < 0) {
+                    if (!PyErr_Occurred()) PyErr_SetString(PyExc_ValueError, "negative role id");
+                    throw std::runtime_error("invalid role id");
+                }
+                node.Set((size_t)n);
+            }
+        }
+        if (!node.ContainsAll(all)) return false;
+        if (!any.Empty() && !node.ContainsAny(any)) return false;
+        return !node.ContainsAny(none);
+    }
+public:
+    explicit RoleMatcher(PyObject* i) : ids(i) {}
+
+    bool SetMasks(PyObject* a, PyObject* y, PyObject* n) {
+        return all.FromPy(a) && any.FromPy(y) && none.FromPy(n);
+    }
+
+    // Collect returns the list of matching nodes in document order.
+    // Returns a new reference.
+    PyObject* Collect(PyObject* root) {
+        PyObject* list = PyList_New(0);
+        if (!list) return nullptr;
+
+        std::vector<PyObject*> stack;
+        stack.push_back(root);
+        while (!stack.empty()) {
+            PyObject* obj = stack.back();
+            stack.pop_back();
+
+            if (PyList_Check(obj)) {
+                for (Py_ssize_t i = PyList_GET_SIZE(obj) - 1; i >= 0; i--)
+                    stack.push_back(PyList_GET_ITEM(obj, i));
+                continue;
+            }
+            if (!PyDict_Check(obj)) continue;
+
+            bool ok = false;
+            try {
+                ok = PyDict_GetItemString(obj, "@type") && matches(obj);
+            } catch (...) {
+                Py_DECREF(list);
+                throw;
+            }
+            if (ok && PyList_Append(list, obj) < 0) {
+                Py_DECREF(list);
+                return nullptr;
+            }
+
+            size_t first = stack.size();
+            PyObject *key, *val;
+            Py_ssize_t pos = 0;
+            while (PyDict_Next(obj, &pos, &key, &val)) { // borrows
+                if (!PyDict_Check(val) && !PyList_Check(val)) continue;
+                if (PyUnicode_Check(key) && PyUnicode_GET_LENGTH(key) > 0 && PyUnicode_READ_CHAR(key, 0) == '@') continue;
+                stack.push_back(val);
+            }
+            std::reverse(stack.begin() + first, stack.end());
+        }
+        return list;
+    }
+};
+
+static PyObject *PyUast_nodes_with_roles(PyObject *self, PyObject *args, PyObject *kwargs) {
+  char* kwds[] = {(char*)"node", (char*)"ids", (char*)"all", (char*)"any", (char*)"none", NULL};
+  PyObject *node = nullptr;
+  PyObject *ids = nullptr;
+  PyObject *all = nullptr, *any = nullptr, *none = nullptr;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "OO!|OOO", kwds, &node, &PyDict_Type, &ids,
+                                   &all, &any, &none))
+    return nullptr;
+  if (!assertNotContext(node)) return nullptr;
+
+  try {
+    RoleMatcher matcher(ids);
+    if (!matcher.SetMasks(all, any, none)) return nullptr;
+    return matcher.Collect(node);
+  } catch (const std::exception& e) {
+    if (!PyErr_Occurred()) PyErr_SetString(PyExc_RuntimeError, e.what());
+    return nullptr;
+  }
+}
+
+// PyUast_stats returns the profiling counters as a dict.
+// Returns a new reference.
+static PyObject *PyUast_stats(PyObject *self, PyObject *Py_UNUSED(ignored)) {
+  const PyUastStats& st = pyuastStats;
+  return Py_BuildValue("{s:O,s:K,s:K,s:K,s:K,s:K,s:K,s:K,s:K}",
+                       "enabled",
+#ifdef PYUAST_STATS
+                       Py_True,
+#else
+                       Py_False,
+#endif
+                       "node_exts", (unsigned long long)st.nodeExts,
+                       "nodes", (unsigned long long)st.nodes,
+                       "nodes_high_water", (unsigned long long)st.nodesHighWater,
+                       "strings", (unsigned long long)st.strings,
+                       "string_bytes", (unsigned long long)st.stringBytes,
+                       "iter_steps", (unsigned long long)st.iterSteps,
+                       "libuast_calls", (unsigned long long)st.libuastCalls,
+                       "libuast_ns", (unsigned long long)st.libuastNs);
+}
+
+static PyObject *PyUast_reset_stats(PyObject *self, PyObject *Py_UNUSED(ignored)) {
+  pyuastStats = PyUastStats();
+  Py_RETURN_NONE;
+}
+
 static PyMethodDef extension_methods[] = {
-    {"iterator", PyUastIter_new, METH_VARARGS, "Get an iterator over a node"},
+    {"iterator", (PyCFunction)PyUastIter_new, METH_VARARGS | METH_KEYWORDS, "Get an iterator over a node"},
     {"decode", (PyCFunction)PythonContextExt_decode, METH_VARARGS | METH_KEYWORDS, "Decode UAST from a byte array"},
     {"uast", PythonContext_new, METH_VARARGS, "Creates a new UAST context"},
+    {"subtree_hashes", (PyCFunction)PyUast_subtree_hashes, METH_VARARGS | METH_KEYWORDS,
+     "Compute structural hashes of the nodes of a tree"},
+    {"tokens", (PyCFunction)PyUast_tokens, METH_VARARGS | METH_KEYWORDS,
+     "Extract the tokens of the nodes of a tree sorted by position"},
+    {"nodes_with_roles", (PyCFunction)PyUast_nodes_with_roles, METH_VARARGS | METH_KEYWORDS,
+     "Select the nodes of a tree by role bitmasks"},
+    {"stats", PyUast_stats, METH_NOARGS,
+     "Return the profiling counters; they are only updated if built with PYUAST_STATS"},
+    {"reset_stats", PyUast_reset_stats, METH_NOARGS, "Reset the profiling counters"},
     {nullptr, nullptr, 0, nullptr}
 };
 
@@ -0,0 +1,116 @@
+"""
+Recognition of the simplest XPath query shapes so that they can be evaluated
+without asking libuast to traverse the whole tree once per query.
+
+Only queries of the form ``//ns:Type`` optionally followed by predicates of the
+form ``[@attr='literal']`` (several of them, or joined by ``and``) are
+recognized. Anything else must be evaluated by libuast.
+"""
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Node types are only accepted with a namespace prefix (uast:Identifier,
+# python:Call...) because unprefixed element names can also match UAST fields.
+_TYPE_STEP_RE = re.compile(r"^//([A-Za-z_][\w.-]*:[A-Za-z_][\w.-]*)")
+_PREDICATE_RE = re.compile(r"\[([^\[\]]*)\]")
+_COMPARISON_RE = re.compile(
+    r"\s*@([A-Za-z_][\w.-]*)\s*=\s*(?:'([^']*)'|\"([^\"]*)\")\s*")
+_AND_RE = re.compile(r"and(?=[\s@])")
+
+
+def _attr_strings(value) -> List[str]:
+    # Mirrors how libuast exposes node fields as XPath attributes: scalars are
+    # converted to their string form and lists of scalars become repeated
+    # attributes with the same name.
+    if isinstance(value, list):
+        return [s for v in value for s in _attr_strings(v)]
+    if isinstance(value, bool):
+        return ["true" if value else "false"]
+    if isinstance(value, float) and value.is_integer():
+        return [str(int(value))]
+    if isinstance(value, (str, int, float)):
+        return [str(value)]
+    return []
+
+
+def node_fields(node: dict) -> Dict[str, Tuple[str, ...]]:
+    """
+    Returns the XPath attributes of a loaded node: the string forms of its
+    scalar fields, by name. libuast exposes "@token" and "token" alike as the
+    token attribute, so a name has the values of both keys, as a repeated
+    attribute would.
+    """
+    fields: Dict[str, Tuple[str, ...]] = {}
+    for key, value in node.items():
+        strings = _attr_strings(value)
+        if strings:
+            name = key[1:] if key.startswith("@") else key
+            fields[name] = fields.get(name, ()) + tuple(strings)
+    return fields
+
+
+class SimpleQuery:
+    """
+    A parsed ``//ns:Type[@attr='literal']...`` query that can be matched against
+    loaded nodes in Python.
+    """
+
+    def __init__(self, query: str, internal_type: str,
+                 predicates: List[Tuple[str, str]]) -> None:
+        self.query = query
+        self.internal_type = internal_type
+        self.predicates = predicates
+
+    @staticmethod
+    def parse(query: str) -> Optional["SimpleQuery"]:
+        """
+        Returns a SimpleQuery if the query has one of the supported shapes or
+        None otherwise.
+        """
+        query = query.strip()
+        m = _TYPE_STEP_RE.match(query)
+        if not m:
+            return None
+
+        predicates: List[Tuple[str, str]] = []
+        pos = m.end()
+        while pos < len(query):
+            pm = _PREDICATE_RE.match(query, pos)
+            if not pm:
+                return None
+            parsed = SimpleQuery._parse_predicate(pm.group(1))
+            if parsed is None:
+                return None
+            predicates.extend(parsed)
+            pos = pm.end()
+
+        return SimpleQuery(query, m.group(1), predicates)
+
+    @staticmethod
+    def _parse_predicate(expr: str) -> Optional[List[Tuple[str, str]]]:
+        res: List[Tuple[str, str]] = []
+        pos = 0
+        while True:
+            cm = _COMPARISON_RE.match(expr, pos)
+            if not cm:
+                return None
+            literal = cm.group(2) if cm.group(2) is not None else cm.group(3)
+            res.append((cm.group(1), literal))
+            pos = cm.end()
+            if pos == len(expr):
+                return res
+            am = _AND_RE.match(expr, pos)
+            if not am:
+                return None
+            pos = am.end()
+
+    def matches(self, node: dict) -> bool:
+        return node.get("@type") == self.internal_type and \
+            self.matches_fields(node_fields(node))
+
+    def matches_fields(self, fields: Dict[str, Tuple[str, ...]]) -> bool:
+        """
+        Checks the predicates against the attributes returned by node_fields(),
+        for a node already known to be of the queried type.
+        """
+        return all(literal in fields.get(attr, ()) for attr, literal in self.predicates)
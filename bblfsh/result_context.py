@@ -1,8 +1,17 @@
+import sys
+from typing import Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple, Union
+
 from bblfsh.aliases import ParseResponse
+from bblfsh.compression import compress
 from bblfsh.node import Node
 from bblfsh.node_iterator import NodeIterator
-from bblfsh.pyuast import decode, iterator, uast
+from bblfsh.pyuast import (NodeExt, decode, iterator, nodes_with_roles, subtree_hashes,
+                           tokens, uast)
+from bblfsh.query import SimpleQuery, node_fields
+from bblfsh.roles import TREE_ROLE_IDS, RoleSpec, role_mask, roles_query
+from bblfsh.source import LineIndex, Source, node_span
 from bblfsh.tree_order import TreeOrder
+from bblfsh.type_aliases import EncodeDestType, PruneType, ResultMultiType, TokenTuple
 
 
 class ResponseError(Exception):
@@ -17,34 +26,438 @@ class GetOnEmptyNodeException(Exception):
     pass
 
 
+class ClosedContextException(Exception):
+    pass
+
+
+# Positions hang from the "@pos" key. The tree iterators visit them like any other
+# node, so they end up in the type index, but libuast maps "@" keys to XPath
+# attributes instead of child elements, so //uast:Positions isn't guaranteed to
+# return the same nodes as the index. Queries for these types go to libuast.
+_UNINDEXED_TYPES = frozenset(("uast:Positions", "uast:Position"))
+
+
+# an external node and the XPath attributes of its loaded value, see node_fields()
+_IndexEntry = Tuple[NodeExt, Dict[str, Tuple[str, ...]]]
+
+
+def _strip_response(response: ParseResponse) -> ParseResponse:
+    # everything but the encoded UAST, which can be large
+    return ParseResponse(language=response.language, filename=response.filename)
+
+
+def _deep_sizeof(root) -> int:
+    size = 0
+    seen = set()
+    stack = [root]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+    return size
+
+
+class SubtreeHash(NamedTuple):
+    """
+    Structural hash of the subtree of a node. parent is the position of the
+    parent node in the list returned by subtree_hashes(), or -1 for the root,
+    and value is the node loaded as a dict. node is the external node of a
+    ResultContext, which can be wrapped with Node(node_ext=node, ctx=ctx.ctx)
+    when needed, or the dict itself for a Python context.
+    """
+    hash: int
+    parent: int
+    node: Union[NodeExt, dict]
+    value: dict
+
+
+class FilterManyResult(dict):
+    """
+    Result of ResultContext.filter_many: maps every query name to the list of
+    results. The names of the queries that were answered together from the type
+    index are available in the fused attribute.
+    """
+    def __init__(self, results: Dict[str, List], fused: FrozenSet[str]) -> None:
+        super().__init__(results)
+        self.fused = fused
+
+
 class ResultContext:
-    def __init__(self, grpc_response: ParseResponse = None) -> None:
+    def __init__(self, grpc_response: ParseResponse = None,
+                 type_index: bool = False, keep_response: bool = True,
+                 source: Union[str, bytes, Source, None] = None) -> None:
+        """
+        :param grpc_response: The parse response to decode.
+        :param type_index: Build the type index on the first query it can serve.
+        :param keep_response: Keep the response after decoding it. If False, \
+                              only its language and filename are kept, so the \
+                              encoded UAST isn't held in memory twice.
+        :param source: The parsed source code, to get the text of the nodes.
+        """
+        if source is not None and not isinstance(source, Source):
+            source = Source(source)
+        self.source: Optional[Source] = source
+        # maps each node type to its (external node, attributes) pairs in
+        # document order; built on first use, see _get_type_index()
+        self._type_index: Optional[Dict[str, List[_IndexEntry]]] = None
+        self._use_type_index = type_index
+        self._ctx = None
+
         if grpc_response:
             if grpc_response.errors:
                 raise ResponseError("\n".join(
                     [error.text for error in grpc_response.errors])
                 )
-            self._response = grpc_response
             self.ctx = decode(grpc_response.uast, format=0)
+            if not keep_response:
+                grpc_response = _strip_response(grpc_response)
+            self._response = grpc_response
         else:
             self._response = None
             self.ctx = uast()
 
+    def memory_usage(self) -> Dict[str, int]:
+        """
+        Returns the size in bytes of what this context holds in Python: the raw
+        parse response ("response"), the type index ("type_index") and the source
+        code ("source"), plus their sum ("total").
+
+        libuast doesn't report the memory of the decoded tree, so it is not
+        included. For reference, "encoded_size" is the size of the data the tree
+        was decoded from (0 for contexts that weren't decoded); it is not part
+        of the total.
+        """
+        usage = {
+            "response": len(self._response.uast) if self._response is not None else 0,
+            "source": len(self.source) if self.source is not None else 0,
+            "type_index": _deep_sizeof(self._type_index) if self._type_index else 0,
+        }
+        usage["total"] = sum(usage.values())
+        usage["encoded_size"] = (self._ctx.encoded_size()
+                                 if hasattr(self._ctx, "encoded_size") else 0)
+        return usage
+
+    def drop_caches(self) -> None:
+        """
+        Releases the type index. The context stays usable: if it was created
+        with type_index=True the index is built again by the next query that
+        can use it, otherwise queries go back to libuast.
+        """
+        self._type_index = None
+
+    def close(self) -> None:
+        """
+        Releases the raw response, the source, the type index and the reference
+        to the native tree. The tree is freed once the nodes and iterators obtained
+        from this context are released too. The context can't be queried after
+        closing it: its methods raise ClosedContextException, except for
+        memory_usage() and the language and filename properties.
+        """
+        if self._response is not None:
+            self._response = _strip_response(self._response)
+        self._type_index = None
+        self.source = None
+        self._ctx = None
+
+    @property
+    def ctx(self):
+        """
+        The native context holding the decoded tree.
+        """
+        if self._ctx is None:
+            raise ClosedContextException("the context was closed")
+        return self._ctx
+
+    @ctx.setter
+    def ctx(self, ctx) -> None:
+        self._ctx = ctx
+
+    def __enter__(self) -> "ResultContext":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
     def filter(self, query: str) -> NodeIterator:
+        exts = self._indexed_query(query)
+        if exts is not None:
+            return NodeIterator(iter(exts), self.ctx)
+
         return NodeIterator(self.ctx.filter(query), self.ctx)
 
+    def count(self, query: str) -> int:
+        """
+        Returns the number of results of the query without loading them.
+        """
+        exts = self._indexed_query(query)
+        if exts is not None:
+            return len(exts)
+
+        return self.ctx.count(query)
+
+    def exists(self, query: str) -> bool:
+        """
+        Returns True if the query has any results, stopping at the first one.
+        """
+        exts = self._indexed_query(query)
+        if exts is not None:
+            return len(exts) > 0
+
+        return self.ctx.exists(query)
+
+    def first(self, query: str) -> Optional[Union[ResultMultiType, Node]]:
+        """
+        Returns the first result of the query, or None if it has no results.
+        """
+        exts = self._indexed_query(query)
+        if exts is not None:
+            res = exts[0] if exts else None
+        else:
+            res = self.ctx.first(query)
+
+        if isinstance(res, NodeExt):
+            return Node(node_ext=res, ctx=self.ctx)
+        return res
+
+    def eval_scalar(self, query: str, type: Optional[type] = None) -> ResultMultiType:
+        """
+        Returns the only result of the query, usually an XPath expression that
+        evaluates to a value, like count() or boolean(). Raises ValueError if
+        the query doesn't have exactly one result and TypeError if the result is
+        not of the given type; integers are converted if a float is expected.
+        """
+        return self.ctx.eval_scalar(query, type=type)
+
+    def _indexed_query(self, query: str) -> Optional[List[NodeExt]]:
+        # Returns the results of the query from the type index, or None if the
+        # index is not in use or can't answer this query.
+        if not self._use_type_index and self._type_index is None:
+            return None
+
+        sq = SimpleQuery.parse(query)
+        if sq is None or sq.internal_type in _UNINDEXED_TYPES:
+            return None
+
+        return [ext for ext, fields in self._get_type_index().get(sq.internal_type, ())
+                if sq.matches_fields(fields)]
+
+    def _get_type_index(self) -> Dict[str, List[_IndexEntry]]:
+        if self._type_index is None:
+            self._type_index = self._build_type_index()
+        return self._type_index
+
+    def _build_type_index(self) -> Dict[str, List[_IndexEntry]]:
+        # Indexes the nodes of every type in a single walk of the tree. Only the
+        # handles and the scalar fields that predicates can test are kept, not
+        # the loaded tree.
+        index: Dict[str, List[_IndexEntry]] = {}
+        for ext, value in self._pair_nodes(self.ctx.load()):
+            internal_type = value.get("@type")
+            if internal_type is not None:
+                index.setdefault(internal_type, []).append((ext, node_fields(value)))
+        return index
+
+    def _pair_nodes(self, values: dict) -> Iterable[Tuple[NodeExt, dict]]:
+        # Both iterators walk the same tree with the same order, so each
+        # external node is paired with its loaded counterpart.
+        root = self.ctx.root()
+        if root is None:
+            return ()
+        return ((ext, value) for ext, value in zip(iterator(root, TreeOrder.PRE_ORDER),
+                                                    iterator(values, TreeOrder.PRE_ORDER))
+                if isinstance(value, dict))
+
+    def nodes_of_type(self, internal_type: str) -> NodeIterator:
+        """
+        Returns an iterator over the nodes of the given type in document order.
+        The first call builds an index of the whole tree by type; once it is built,
+        filter() also uses it for //ns:Type and //ns:Type[@attr='value'] queries.
+        """
+        if internal_type in _UNINDEXED_TYPES:
+            return self.filter("//" + internal_type)
+
+        exts = [ext for ext, _ in self._get_type_index().get(internal_type, ())]
+        return NodeIterator(iter(exts), self.ctx)
+
+    def subtree_hashes(self, ignore_positions: bool = True,
+                       ignore_tokens: bool = False) -> List[SubtreeHash]:
+        """
+        Returns a structural hash of the subtree of every node, in pre-order.
+        Equal subtrees have equal hashes, in this tree or in others, so they can
+        be used to find duplicated code or as cache keys. Positions and tokens
+        can be left out of the hashes.
+        """
+        if self.ctx.root() is None:
+            return []
+
+        values = self.ctx.load()
+        exts = {id(value): ext for ext, value in self._pair_nodes(values)}
+        hashes = subtree_hashes(values, ignore_positions=ignore_positions,
+                                ignore_tokens=ignore_tokens)
+        return [SubtreeHash(h, parent, exts[id(value)], value)
+                for h, parent, value in hashes]
+
+    def node_span(self, node: Union[Node, dict]) -> Tuple[int, int]:
+        """
+        Returns the start and end byte offsets of a node in the source.
+        """
+        return node_span(node)
+
+    def node_text(self, node: Union[Node, dict]) -> str:
+        """
+        Returns the source text of a node. Requires the source to be kept, see
+        BblfshClient.parse(keep_source=True).
+        """
+        if self.source is None:
+            raise ValueError("the source code was not kept, parse with keep_source=True")
+        return self.source.slice(*node_span(node))
+
+    @property
+    def lines(self) -> LineIndex:
+        """
+        Line index of the source code, to convert offsets to lines and columns.
+        Requires the source to be kept, see BblfshClient.parse(keep_source=True).
+        """
+        if self.source is None:
+            raise ValueError("the source code was not kept, parse with keep_source=True")
+        return self.source.lines
+
+    def tokens(self, types: Optional[Iterable[str]] = None,
+               roles: Optional[Iterable[str]] = None) -> List[TokenTuple]:
+        """
+        Returns (token, type, roles, start offset) tuples for the nodes with a
+        token, sorted by position, without creating a Node for each of them.
+        The token is the @token of the node or, if it has none, its Name or
+        Value field. types restricts the result to the given node types and
+        roles to the nodes having all the given roles (as named in the tree,
+        e.g. "Identifier"). The offset is -1 for nodes without a position,
+        which go last. The tree is loaded once per call and walked in a single
+        pass; nothing is kept after it returns.
+        """
+        if self.ctx.root() is None:
+            return []
+        return tokens(self.ctx.load(), types, roles)
+
+    def nodes_with_roles(self, all: RoleSpec = 0, any: RoleSpec = 0,
+                         none: RoleSpec = 0) -> NodeIterator:
+        """
+        Returns an iterator over the nodes having all the roles in all, at least
+        one of the roles in any (if given) and none of the roles in none, in
+        document order. Roles can be given as names, ids or a bitmask (see
+        roles.role_mask()). The masks are turned into a single XPath query (see
+        roles.roles_query()), so the tree is traversed by libuast without loading
+        it and only the matching nodes are wrapped.
+        """
+        query = roles_query(role_mask(all), role_mask(any), role_mask(none))
+        if query is None or self.ctx.root() is None:
+            return NodeIterator(iter(()), self.ctx)
+
+        return NodeIterator(self.ctx.filter(query), self.ctx)
+
+    def filter_many(self, queries: Dict[str, str]) -> FilterManyResult:
+        """
+        Evaluates several named queries and returns the list of results of each one.
+
+        If the type index is in use (see nodes_of_type()), the queries of the form
+        //ns:Type, optionally with [@attr='value'] predicates, are fused: they are
+        all answered from the index, which is built in a single walk of the tree,
+        and a node matching several of them is shared between their result lists.
+        The rest of the queries, or all of them without the index, are evaluated
+        one by one by libuast.
+        """
+        fused: Dict[str, List[NodeExt]] = {}
+        for name, query in queries.items():
+            exts = self._indexed_query(query)
+            if exts is not None:
+                fused[name] = exts
+
+        nodes: Dict[int, Node] = {}
+
+        def wrap(ext: NodeExt) -> Node:
+            node = nodes.get(id(ext))
+            if node is None:
+                node = nodes[id(ext)] = Node(node_ext=ext, ctx=self.ctx)
+            return node
+
+        results: Dict[str, List] = {}
+        for name, query in queries.items():
+            if name in fused:
+                results[name] = [wrap(ext) for ext in fused[name]]
+            else:
+                results[name] = list(self.filter(query))
+        return FilterManyResult(results, frozenset(fused))
+
     def get_all(self) -> dict:
         return self.ctx.load()
 
-    def iterate(self, order: int) -> NodeIterator:
+    def iterate(self, order: int, max_depth: Optional[int] = None,
+                prune: PruneType = None, skippable: bool = False) -> NodeIterator:
+        """
+        Iterates over the tree in the given order. With max_depth only nodes up to
+        that depth are visited, and with prune (a set of node types or a callable
+        receiving each Node) the children of the matching nodes are skipped; both
+        are supported for pre-order and level-order. The returned iterator allows
+        skip_children() if any of them or skippable is set.
+
+        The root has depth 0 and the fields of a node, including the elements of
+        its array fields, have its depth plus one: arrays don't count as a level.
+        Finding out which values are nodes loads them, so walks with max_depth
+        are slower. Without a depth limit or skipped nodes, the walk returns the
+        same values as a plain iteration.
+        """
         TreeOrder.check_order(order)
-        return NodeIterator(iterator(self.ctx.root(), order), self.ctx)
+        if max_depth is None and prune is None and not skippable:
+            return NodeIterator(iterator(self.ctx.root(), order), self.ctx)
+
+        it = iterator(self.ctx.root(), order,
+                      max_depth=-1 if max_depth is None else max_depth, prunable=True)
+        return NodeIterator(it, self.ctx, prune)
 
     # Encode in binary format by default
-    def encode(self, node: dict = None, fmt: int = 0):
+    def encode(self, node: dict = None, fmt: int = 0,
+               compression: Optional[str] = None):
+        """
+        Encodes the UAST, or the subtree of node. If compression names a codec
+        (see bblfsh.compression) the result is compressed with it, which
+        bblfsh.decode() detects.
+        """
         encoded = self.ctx.encode(node, fmt)
+        if compression:
+            return compress(encoded, compression)
         return encoded
 
+    def encode_to(self, dest: EncodeDestType, node: dict = None, fmt: int = 0) -> int:
+        """
+        Encodes the UAST directly into dest, which can be a file descriptor, a
+        writable buffer large enough for the data or an object with a write()
+        method, that receives the data in chunks. Returns the number of bytes
+        written.
+        """
+        return self.ctx.encode_to(dest, node, fmt)
+
+    def extract(self, node: Union[Node, NodeExt]) -> "ResultContext":
+        """
+        Returns a new ResultContext holding a copy of the subtree of node, with
+        the same language and filename. It doesn't reference this context, so
+        keeping it doesn't keep the whole tree in memory.
+        """
+        node_ext = node.node_ext if isinstance(node, Node) else node
+        if node_ext is None:
+            raise ValueError("only native nodes can be extracted")
+
+        res = ResultContext(type_index=self._use_type_index, source=self.source)
+        res.ctx = self.ctx.extract(node_ext)
+        if self._response is not None:
+            res._response = _strip_response(self._response)
+        return res
+
     @property
     def language(self) -> str:
         return self._response.language
@@ -74,21 +487,99 @@ class ResultContext:
 
 # Python context
 class Context:
+    """
+    Query context over a tree of Python objects (dicts, lists and scalars).
+
+    The native context, which maps every visited Python object to a libuast node,
+    is kept across filter(), iterate() and encode() calls instead of being rebuilt
+    for each one. That mapping caches the keys of each dict, so call invalidate()
+    after mutating the tree; assigning a new root does it automatically.
+    """
     def __init__(self, root: dict) -> None:
         self.ctx = uast()
-        self.root = root
+        self._root = root
+
+    @property
+    def root(self) -> dict:
+        return self._root
+
+    @root.setter
+    def root(self, root: dict) -> None:
+        self._root = root
+        self.invalidate()
+
+    def invalidate(self) -> None:
+        """
+        Drops the cached native nodes. Iterators created before keep working on
+        the previous native context.
+        """
+        self.ctx = uast()
 
     def filter(self, query: str) -> dict:
         return self.ctx.filter(query, self.root)
 
-    def iterate(self, order: int) -> iterator:
+    def eval_scalar(self, query: str, type: Optional[type] = None) -> ResultMultiType:
+        """
+        Same as ResultContext.eval_scalar().
+        """
+        return self.ctx.eval_scalar(query, self.root, type)
+
+    def iterate(self, order: int, max_depth: Optional[int] = None,
+                skippable: bool = False) -> iterator:
         TreeOrder.check_order(order)
-        return iterator(self.root, order)
+        if max_depth is None and not skippable:
+            return self.ctx.iterate(self.root, order)
+        return self.ctx.iterate(self.root, order,
+                                max_depth=-1 if max_depth is None else max_depth,
+                                prunable=True)
 
-    def encode(self, fmt: int = 0):
+    def encode(self, fmt: int = 0, compression: Optional[str] = None):
         encoded = self.ctx.encode(self.root, fmt)
+        if compression:
+            return compress(encoded, compression)
         return encoded
 
+    def encode_to(self, dest: EncodeDestType, fmt: int = 0) -> int:
+        """
+        Encodes the tree directly into dest, see ResultContext.encode_to.
+        """
+        return self.ctx.encode_to(dest, self.root, fmt)
+
+    def subtree_hashes(self, ignore_positions: bool = True,
+                       ignore_tokens: bool = False) -> List[SubtreeHash]:
+        """
+        Returns a structural hash of the subtree of every node, in pre-order,
+        see ResultContext.subtree_hashes. The nodes are the dicts of the tree.
+        """
+        return [SubtreeHash(h, parent, value, value) for h, parent, value in
+                subtree_hashes(self.root, ignore_positions=ignore_positions,
+                               ignore_tokens=ignore_tokens)]
+
+    def tokens(self, types: Optional[Iterable[str]] = None,
+               roles: Optional[Iterable[str]] = None) -> List[TokenTuple]:
+        """
+        Returns (token, type, roles, start offset) tuples for the nodes with a
+        token, sorted by position, see ResultContext.tokens.
+        """
+        return tokens(self.root, types, roles)
+
+    def nodes_with_roles(self, all: RoleSpec = 0, any: RoleSpec = 0,
+                         none: RoleSpec = 0) -> List[dict]:
+        """
+        Same as ResultContext.nodes_with_roles(), returning the matching dicts.
+        """
+        return nodes_with_roles(self.root, TREE_ROLE_IDS, role_mask(all), role_mask(any),
+                                role_mask(none))
+
+    def arena_stats(self) -> Dict[str, int]:
+        """
+        Returns the number of native nodes created for the Python objects of the
+        tree ("nodes"), the number of blocks they are allocated in ("blocks"),
+        the capacity of those blocks ("capacity") and the number of strings
+        shared by the nodes ("strings").
+        """
+        return self.ctx.arena_stats()
+
 
 def context(root: dict) -> Context:
     return Context(root)
@@ -1,3 +1,5 @@
+from typing import Dict, Iterable, List, Optional, Union
+
 from bblfsh.aliases import DESCRIPTOR
 
 
@@ -5,19 +7,106 @@ class RoleSearchException(Exception):
     pass
 
 
+# a bitmask, a single role name or several role names or ids
+RoleSpec = Union[int, str, Iterable[Union[str, int]]]
+
+# Role tables, built once from the protocol descriptor. ROLE_IDS is keyed by the
+# protocol names (e.g. "LEFT_SHIFT"), TREE_ROLE_IDS by the names used in the
+# "@role" field of the nodes (e.g. "LeftShift").
+ROLE_IDS: Dict[str, int] = {
+    v.name.upper(): v.number for v in DESCRIPTOR.enum_types_by_name["Role"].values
+}
+ROLE_NAMES: Dict[int, str] = {number: name for name, number in ROLE_IDS.items()}
+TREE_ROLE_IDS: Dict[str, int] = {
+    "".join(part.capitalize() for part in name.split("_")): number
+    for name, number in ROLE_IDS.items()
+}
+TREE_ROLE_NAMES: Dict[int, str] = {number: name for name, number in TREE_ROLE_IDS.items()}
+
+
 def role_id(rname: str) -> int:
-    try:
-        name = DESCRIPTOR.enum_types_by_name["Role"].values_by_name[rname.upper()].number
-    except KeyError:
+    rid = ROLE_IDS.get(rname.upper())
+    if rid is None:
+        rid = TREE_ROLE_IDS.get(rname)
+    if rid is None:
         raise RoleSearchException("Role with name '{}' not found".format(rname))
 
-    return name
+    return rid
 
 
 def role_name(rid: int) -> str:
     try:
-        id_ = DESCRIPTOR.enum_types_by_name["Role"].values_by_number[rid].name
+        return ROLE_NAMES[rid]
     except KeyError:
-        raise RoleSearchException("Role with ID '{}' not found".format(rid))
+        raise RoleSearchException("Role with ID '{}' not found".format(rid)) from None
+
+
+def role_mask(roles: RoleSpec) -> int:
+    """
+    Returns the bitmask of a set of roles, given by name or id, where bit N is
+    set if the role with id N is present. A mask is returned as is, and a string
+    is taken as the name of a single role.
+    """
+    if isinstance(roles, int):
+        return roles
+    if isinstance(roles, str):
+        roles = (roles,)
+
+    mask = 0
+    for role in roles:
+        mask |= 1 << (role if isinstance(role, int) else role_id(role))
+    return mask
+
+
+def mask_roles(mask: int) -> List[str]:
+    """
+    Returns the names of the roles in a bitmask, by id.
+    """
+    names = []
+    rid = 0
+    while mask:
+        if mask & 1:
+            names.append(role_name(rid))
+        mask >>= 1
+        rid += 1
+    return names
+
+
+def node_role_mask(value: dict) -> int:
+    """
+    Returns the role bitmask of a node given as a dict. Unknown roles are ignored.
+    """
+    mask = 0
+    for name in value.get("@role", ()):
+        rid = TREE_ROLE_IDS.get(name)
+        if rid is not None:
+            mask |= 1 << rid
+    return mask
+
+
+def roles_query(all: int = 0, any: int = 0, none: int = 0) -> Optional[str]:
+    """
+    Returns an XPath query selecting the nodes that have all the roles of the
+    all bitmask, at least one of the roles of any (if not 0) and none of the
+    roles of none, or None if no node can match because a required role has no
+    name in the tree. Positions, which have no roles, are left out.
+    """
+    def names(mask: int) -> List[str]:
+        return [name for rid, name in TREE_ROLE_NAMES.items() if mask >> rid & 1]
 
-    return id_.upper()
+    required = names(all)
+    if len(required) != bin(all).count("1"):
+        return None
+    query = "//*[not(self::uast:Positions or self::uast:Position)]"
+    query += "".join("[@role='{}']".format(name) for name in required)
+    if any:
+        alternatives = names(any)
+        if not alternatives:
+            return None
+        query += "[{}]".format(" or ".join("@role='{}'".format(name)
+                                           for name in alternatives))
+    excluded = names(none)
+    if excluded:
+        query += "[not({})]".format(" or ".join("@role='{}'".format(name)
+                                                for name in excluded))
+    return query
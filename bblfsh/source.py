@@ -0,0 +1,255 @@
+"""
+Source code of a parsed file, kept to get the text of the nodes.
+
+UAST positions are byte offsets into the UTF-8 encoded source. Source converts
+them to character offsets with an index built once per file, the first time
+it is needed; ASCII files, the most common ones, don't need it at all.
+
+LineIndex converts byte offsets to lines and columns, both the byte columns used
+by UAST positions and the UTF-16 columns used by editors (LSP).
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, Optional, Sequence, Tuple, Union
+
+
+class Source:
+    def __init__(self, content: Union[str, bytes]) -> None:
+        if isinstance(content, str):
+            self._text: Optional[str] = content
+            self.data = content.encode("utf-8")
+        else:
+            self._text = None
+            self.data = bytes(content)
+        # byte offset of every character plus the length of the data, or None
+        # if the content is ASCII; see _get_char_starts()
+        self._char_starts: Optional[array] = None
+        self._ascii: Optional[bool] = None
+        self._lines: Optional[LineIndex] = None
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = self.data.decode("utf-8")
+        return self._text
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def _get_char_starts(self) -> Optional[array]:
+        if self._ascii is None:
+            self._ascii = len(self.text) == len(self.data)
+            if not self._ascii:
+                starts = array("Q", [0]) * (len(self.text) + 1)
+                pos = 0
+                for i, c in enumerate(self.text):
+                    starts[i] = pos
+                    if c < "\x80":
+                        pos += 1
+                    elif c < "\u0800":
+                        pos += 2
+                    elif c < "\U00010000":
+                        pos += 3
+                    else:
+                        pos += 4
+                starts[len(self.text)] = pos
+                self._char_starts = starts
+        return self._char_starts
+
+    def char_offset(self, byte_offset: int) -> int:
+        """
+        Converts a byte offset to the offset of the character that contains it.
+        """
+        if not 0 <= byte_offset <= len(self.data):
+            raise IndexError("byte offset out of range: %d" % byte_offset)
+        starts = self._get_char_starts()
+        if starts is None:
+            return byte_offset
+        return bisect_right(starts, byte_offset) - 1
+
+    def byte_offset(self, char_offset: int) -> int:
+        """
+        Converts a character offset to a byte offset.
+        """
+        starts = self._get_char_starts()
+        if starts is None:
+            if not 0 <= char_offset <= len(self.data):
+                raise IndexError("character offset out of range: %d" % char_offset)
+            return char_offset
+        if not 0 <= char_offset < len(starts):
+            raise IndexError("character offset out of range: %d" % char_offset)
+        return starts[char_offset]
+
+    def slice(self, start: int, end: int) -> str:
+        """
+        Returns the text between two byte offsets.
+        """
+        return self.data[start:end].decode("utf-8", errors="replace")
+
+    @property
+    def lines(self) -> "LineIndex":
+        """
+        Line index of the source, built on first use.
+        """
+        if self._lines is None:
+            self._lines = LineIndex(self.data)
+        return self._lines
+
+
+class LineIndex:
+    """
+    Start offsets of the lines of a file, to convert byte offsets to and from
+    (line, column) pairs. Lines and byte columns start at 1, like in UAST
+    positions; UTF-16 columns start at 0, like in LSP. The conversions also
+    have batch versions taking and returning arrays.
+    """
+    def __init__(self, data: bytes) -> None:
+        self.data = data
+        starts = array("q", [0])
+        pos = data.find(b"\n")
+        while pos >= 0:
+            starts.append(pos + 1)
+            pos = data.find(b"\n", pos + 1)
+        self.line_starts = starts
+        # UTF-16 column of every byte of the non-ASCII lines, built on demand;
+        # see _utf16_map()
+        self._utf16_maps: Dict[int, Optional[array]] = {}
+
+    def __len__(self) -> int:
+        return len(self.line_starts)
+
+    def _check_offset(self, offset: int) -> None:
+        if not 0 <= offset <= len(self.data):
+            raise IndexError("offset out of range: %d" % offset)
+
+    def _check_line(self, line: int) -> None:
+        if not 1 <= line <= len(self.line_starts):
+            raise IndexError("line out of range: %d" % line)
+
+    def _line_end(self, line: int) -> int:
+        # offset of the end of the line, without the line break
+        if line < len(self.line_starts):
+            return self.line_starts[line] - 1
+        return len(self.data)
+
+    def _utf16_map(self, line: int) -> Optional[array]:
+        # None for ASCII lines, where UTF-16 and byte columns are the same.
+        # All the bytes of a character map to its column.
+        if line in self._utf16_maps:
+            return self._utf16_maps[line]
+
+        start = self.line_starts[line - 1]
+        chunk = self.data[start:self._line_end(line)]
+        text = chunk.decode("utf-8", errors="replace")
+        umap = None
+        if len(text) != len(chunk):
+            umap = array("q")
+            units = 0
+            for c in text:
+                umap.extend([units] * len(c.encode("utf-8")))
+                units += 2 if c > "\uffff" else 1
+            umap.append(units)
+        self._utf16_maps[line] = umap
+        return umap
+
+    def line(self, offset: int) -> int:
+        self._check_offset(offset)
+        return bisect_right(self.line_starts, offset)
+
+    def line_col(self, offset: int) -> Tuple[int, int]:
+        """
+        Converts a byte offset to a (line, byte column) pair.
+        """
+        line = self.line(offset)
+        return line, offset - self.line_starts[line - 1] + 1
+
+    def offset(self, line: int, col: int) -> int:
+        """
+        Converts a (line, byte column) pair to a byte offset.
+        """
+        self._check_line(line)
+        offset = self.line_starts[line - 1] + col - 1
+        if not self.line_starts[line - 1] <= offset <= self._line_end(line):
+            raise IndexError("column out of range: %d" % col)
+        return offset
+
+    def utf16_col(self, offset: int) -> int:
+        """
+        Returns the UTF-16 column of a byte offset in its line.
+        """
+        line = self.line(offset)
+        col = offset - self.line_starts[line - 1]
+        umap = self._utf16_map(line)
+        return col if umap is None else umap[col]
+
+    def utf16_line_col(self, offset: int) -> Tuple[int, int]:
+        """
+        Converts a byte offset to a (line, UTF-16 column) pair.
+        """
+        return self.line(offset), self.utf16_col(offset)
+
+    def offset_from_utf16(self, line: int, col: int) -> int:
+        """
+        Converts a (line, UTF-16 column) pair to a byte offset.
+        """
+        self._check_line(line)
+        start = self.line_starts[line - 1]
+        umap = self._utf16_map(line)
+        if umap is None:
+            if not 0 <= col <= self._line_end(line) - start:
+                raise IndexError("column out of range: %d" % col)
+            return start + col
+
+        i = bisect_left(umap, col)
+        if i == len(umap) or umap[i] != col:
+            raise IndexError("column out of range: %d" % col)
+        return start + i
+
+    def lines_cols(self, offsets: Iterable[int]) -> Tuple[array, array]:
+        """
+        Converts byte offsets to arrays of lines and byte columns.
+        """
+        lines, cols = array("q"), array("q")
+        for offset in offsets:
+            line, col = self.line_col(offset)
+            lines.append(line)
+            cols.append(col)
+        return lines, cols
+
+    def offsets(self, lines: Sequence[int], cols: Sequence[int]) -> array:
+        """
+        Converts lines and byte columns to an array of byte offsets.
+        """
+        if len(lines) != len(cols):
+            raise ValueError("lines and columns have different lengths")
+        return array("q", (self.offset(line, col) for line, col in zip(lines, cols)))
+
+    def utf16_lines_cols(self, offsets: Iterable[int]) -> Tuple[array, array]:
+        """
+        Converts byte offsets to arrays of lines and UTF-16 columns.
+        """
+        lines, cols = array("q"), array("q")
+        for offset in offsets:
+            lines.append(self.line(offset))
+            cols.append(self.utf16_col(offset))
+        return lines, cols
+
+    def offsets_from_utf16(self, lines: Sequence[int], cols: Sequence[int]) -> array:
+        """
+        Converts lines and UTF-16 columns to an array of byte offsets.
+        """
+        if len(lines) != len(cols):
+            raise ValueError("lines and columns have different lengths")
+        return array("q", (self.offset_from_utf16(line, col)
+                           for line, col in zip(lines, cols)))
+
+
+def node_span(node) -> Tuple[int, int]:
+    """
+    Returns the start and end byte offsets of a node, given as a Node or a dict.
+    """
+    value = node.get_dict() if hasattr(node, "get_dict") else node
+    pos = value.get("@pos") if isinstance(value, dict) else None
+    if not pos or "start" not in pos or "end" not in pos:
+        raise ValueError("node has no position")
+    return pos["start"]["offset"], pos["end"]["offset"]
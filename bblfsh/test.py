@@ -1,5 +1,7 @@
+import io
 import resource
 import typing as t
+import tempfile
 import unittest
 import gc
 import bblfsh
@@ -10,8 +12,12 @@ from bblfsh import (BblfshClient, iterator, TreeOrder,
 from bblfsh.launcher import ensure_bblfsh_is_running
 from bblfsh.client import NonUTF8ContentException
 from bblfsh.node import NodeTypedGetException
-from bblfsh.result_context import (Node, NodeIterator, ResultContext)
-from bblfsh.pyuast import uast, decode
+from bblfsh.result_context import (ClosedContextException, Node, NodeIterator,
+                                   ResultContext)
+from bblfsh.roles import mask_roles, role_mask, roles_query
+from bblfsh.source import Source
+from bblfsh import pyuast
+from bblfsh.pyuast import NodeExt, uast, decode
 from functools import cmp_to_key
 
 
@@ -141,6 +147,142 @@ class BblfshTests(unittest.TestCase):
         l = list(it)
         self.assertEqual(len(l), 0)
 
+    def testFilterMany(self) -> None:
+        queries = {
+            "imports": "//uast:RuntimeImport",
+            "os": "//uast:Identifier[@Name='os']",
+            "os_quoted": '//uast:Identifier[@Name="os"]',
+            "os_and": "//uast:Identifier[@Name='os' and @role='Identifier']",
+            "os_roles": "//uast:Identifier[@Name='os'][@role='Expression']",
+            "no_match": "//uast:Identifier[@Name='no such name']",
+            "no_attr": "//uast:Identifier[@Value='os']",
+            "no_type": "//python:NoSuchType",
+            "ids": "//uast:Identifier",
+            "positions": "//uast:Positions",
+            "count": "count(//uast:RuntimeImport)",
+        }
+        get = lambda it: [n.get() if isinstance(n, Node) else n for n in it]
+        expected = self._parse_fixture()
+
+        class CountingContext:
+            def __init__(self, ctx) -> None:
+                self.ctx = ctx
+                self.queries: t.List[str] = []
+
+            def filter(self, query: str, *args):
+                self.queries.append(query)
+                return self.ctx.filter(query, *args)
+
+            def __getattr__(self, name: str):
+                return getattr(self.ctx, name)
+
+        # without the type index every query is evaluated by libuast
+        ctx = self._parse_fixture()
+        ctx.ctx = counting = CountingContext(ctx.ctx)
+        res = ctx.filter_many(queries)
+        self.assertEqual(res.fused, set())
+        self.assertListEqual(counting.queries, list(queries.values()))
+        for name, query in queries.items():
+            self.assertListEqual(get(res[name]), get(expected.filter(query)), name)
+
+        # with it the simple queries are answered from the index, with the same results
+        ctx.nodes_of_type("uast:Identifier")
+        counting.queries.clear()
+        res = ctx.filter_many(queries)
+        self.assertEqual(res.fused, set(queries) - {"positions", "count"})
+        self.assertListEqual(counting.queries, [queries["positions"], queries["count"]])
+        for name, query in queries.items():
+            self.assertListEqual(get(res[name]), get(expected.filter(query)), name)
+        self.assertIs(res["os"][0], res["os_quoted"][0])
+
+        # attributes of every kind are compared as libuast does
+        tree = {"@type": "root", "Nodes": [
+            {"@type": "t:A", "Int": 1, "Float": 2.0, "Bool": True, "@token": "x",
+             "List": ["a", "b"]},
+            {"@type": "t:A", "Int": 2, "token": "x", "Obj": {"@type": "t:B", "Name": "n"}},
+            {"Name": "untyped"},
+        ]}
+        queries = {
+            "all": "//t:A",
+            "int": "//t:A[@Int='1']",
+            "float": "//t:A[@Float='2']",
+            "bool": "//t:A[@Bool='true']",
+            "token": "//t:A[@token='x']",
+            "list": "//t:A[@List='b']",
+            "object": "//t:A[@Obj='n']",
+            "nested": "//t:B[@Name='n']",
+            "untyped": "//t:A[@Name='untyped']",
+        }
+        encoded = bblfsh.context(tree).encode()
+        native = ResultContext()
+        native.ctx = decode(encoded, format=0)
+        indexed = ResultContext(type_index=True)
+        indexed.ctx = decode(encoded, format=0)
+        res = indexed.filter_many(queries)
+        self.assertEqual(res.fused, set(queries))
+        for name, query in queries.items():
+            self.assertListEqual(get(res[name]), get(native.filter(query)), name)
+
+    def testTypeIndex(self) -> None:
+        expected = self._parse_fixture()
+        ctx = self._parse_fixture()
+
+        ids = [n.get() for n in ctx.nodes_of_type("uast:Identifier")]
+        self.assertGreater(len(ids), 0)
+        self.assertListEqual(ids, [n.get() for n in expected.filter("//uast:Identifier")])
+
+        # once the index exists, filter() is served from it
+        for query in ("//uast:RuntimeImport", "//uast:Identifier[@Name='os']",
+                      "//uast:Positions", "//uast:Identifier/Name"):
+            self.assertListEqual([n.get() for n in ctx.filter(query)],
+                                 [n.get() for n in expected.filter(query)])
+
+    def testCountExistsFirst(self) -> None:
+        ctx = self._parse_fixture()
+        query = "//uast:RuntimeImport"
+        expected = list(ctx.filter(query))
+
+        self.assertEqual(ctx.count(query), len(expected))
+        self.assertTrue(ctx.exists(query))
+        self.assertEqual(ctx.first(query).get(), expected[0].get())
+
+        self.assertEqual(ctx.count("//*[@role='Friend']"), 0)
+        self.assertFalse(ctx.exists("//*[@role='Friend']"))
+        self.assertIsNone(ctx.first("//*[@role='Friend']"))
+
+        root = ctx.root
+        self.assertEqual(root.count(query), len(expected))
+        self.assertTrue(root.exists(query))
+        self.assertEqual(root.first("count(//uast:RuntimeImport)").get(), len(expected))
+
+    def testCountExistsFirstPython(self) -> None:
+        ctx = uast()
+        obj = {"@type": "a", "k1": "v1", "child": {"@type": "b", "k2": "v2"}}
+        self.assertEqual(ctx.count("//b", obj), 1)
+        self.assertEqual(ctx.count("//c", obj), 0)
+        self.assertTrue(ctx.exists("/*[@k1='v1']", obj))
+        self.assertFalse(ctx.exists("/*[@k1='v2']", obj))
+        self.assertIs(ctx.first("//b", obj), obj["child"])
+        self.assertIsNone(ctx.first("//c", obj))
+
+    def testEvalScalar(self) -> None:
+        ctx = self._parse_fixture()
+        query = "count(//uast:RuntimeImport)"
+        expected = ctx.count("//uast:RuntimeImport")
+        self.assertEqual(ctx.eval_scalar(query, int), expected)
+        self.assertEqual(ctx.eval_scalar(query, float), float(expected))
+        self.assertIs(ctx.root.eval_scalar("boolean(//uast:RuntimeImport)", bool), True)
+        with self.assertRaises(TypeError):
+            ctx.eval_scalar(query, str)
+        with self.assertRaises(ValueError):
+            ctx.eval_scalar("//uast:Identifier")
+
+        obj = {"@type": "a", "k1": "v1", "child": {"@type": "b", "k2": "v2"}}
+        self.assertEqual(uast().eval_scalar("count(//b)", obj, int), 1)
+        self.assertEqual(bblfsh.context(obj).eval_scalar("string(//b/@k2)", str), "v2")
+        with self.assertRaises(ValueError):
+            uast().eval_scalar("//c", obj)
+
     def testFilterProperties(self) -> None:
         ctx = uast()
         obj = {"k1": "v1", "k2": "v2"}
@@ -212,6 +354,72 @@ class BblfshTests(unittest.TestCase):
         self.assertEqual(role_id(role_name(1)), 1)
         self.assertEqual(role_name(role_id("IDENTIFIER")),  "IDENTIFIER")
 
+    def testStats(self) -> None:
+        pyuast.reset_stats()
+        stats = pyuast.stats()
+        self.assertTrue(all(v == 0 for k, v in stats.items() if k != "enabled"))
+
+        ctx = self._parse_fixture()
+        visited = sum(1 for _ in ctx.iterate(TreeOrder.PRE_ORDER))
+        ctx.get_all()
+        stats = pyuast.stats()
+        if stats["enabled"]:
+            self.assertGreaterEqual(stats["iter_steps"], visited)
+            self.assertGreater(stats["node_exts"], 0)
+            self.assertGreater(stats["nodes"], 0)
+            self.assertGreater(stats["libuast_calls"], 0)
+        else:
+            self.assertEqual(stats["iter_steps"], 0)
+
+        # count() is timed as a whole, including the steps over the results
+        pyuast.reset_stats()
+        ctx.count("//uast:Identifier")
+        self.assertEqual(pyuast.stats()["libuast_calls"], 1 if stats["enabled"] else 0)
+
+    def testRoleMask(self) -> None:
+        mask = role_mask(["Identifier", role_id("EXPRESSION")])
+        self.assertEqual(mask, (1 << role_id("IDENTIFIER")) | (1 << role_id("EXPRESSION")))
+        self.assertEqual(sorted(mask_roles(mask)), ["EXPRESSION", "IDENTIFIER"])
+        self.assertEqual(role_mask(mask), mask)
+        # a string is a single role name, not a sequence of characters
+        self.assertEqual(role_mask("Identifier"), 1 << role_id("IDENTIFIER"))
+        self.assertEqual(role_mask("EXPRESSION"), 1 << role_id("EXPRESSION"))
+
+    def testNodesWithRoles(self) -> None:
+        ctx = self._parse_fixture()
+        expected = [n.get() for n in ctx.filter("//*[@role='Identifier']")]
+        found = list(ctx.nodes_with_roles(all=["Identifier"]))
+        self.assertEqual(sorted(str(n.get()) for n in found), sorted(map(str, expected)))
+        for n in found:
+            self.assertTrue(n.role_mask & role_mask(["Identifier"]))
+
+        # the same nodes as the equivalent XPath query, in document order
+        get = lambda it: [n.get() for n in it]
+        self.assertEqual(get(ctx.nodes_with_roles(all=["Identifier"])), expected)
+        self.assertEqual(get(ctx.nodes_with_roles(all=["Identifier"], none=["Qualified"])),
+                         get(ctx.filter("//*[@role='Identifier' and not(@role='Qualified')]")))
+        self.assertEqual(get(ctx.nodes_with_roles(any=["Identifier", "Literal"])),
+                         get(ctx.filter("//*[@role='Identifier' or @role='Literal']")))
+        self.assertEqual(list(ctx.nodes_with_roles(all=1 << 1000)), [])
+        self.assertEqual(roles_query(any=1 << 1000), None)
+        self.assertEqual(roles_query(all=role_mask("Identifier")),
+                         "//*[not(self::uast:Positions or self::uast:Position)]"
+                         "[@role='Identifier']")
+
+        tree = {"@type": "root", "@role": ["File"], "Nodes": [
+            {"@type": "a", "@role": ["Identifier", "Expression"]},
+            {"@type": "b", "@role": ["Identifier"]},
+            {"@type": "c", "@role": ["Literal"]},
+        ]}
+        pyctx = bblfsh.context(tree)
+        types = lambda nodes: [n["@type"] for n in nodes]
+        self.assertEqual(types(pyctx.nodes_with_roles(all=["Identifier"])), ["a", "b"])
+        self.assertEqual(types(pyctx.nodes_with_roles(all=["Identifier"],
+                                                      none=["Expression"])), ["b"])
+        self.assertEqual(types(pyctx.nodes_with_roles(any=["Literal", "File"])),
+                         ["root", "c"])
+        self.assertEqual(len(pyctx.nodes_with_roles()), 4)
+
     @staticmethod
     def _itTestTree() -> dict:
         def set_position(node: dict, start_offset: int, start_line: int, start_col: int,
@@ -337,6 +545,76 @@ class BblfshTests(unittest.TestCase):
         # We only can test that the order gives us all the nodes
         self.assertEqual(expanded, ['son1', 'son2'])
 
+    def testNextBatch(self) -> None:
+        ctx = self._parse_fixture()
+        expected = self._get_nodes(ctx.iterate(TreeOrder.PRE_ORDER))
+
+        it = ctx.iterate(TreeOrder.PRE_ORDER)
+        batches = []
+        while True:
+            batch = it.next_batch(7)
+            if not batch:
+                break
+            self.assertLessEqual(len(batch), 7)
+            batches.extend(n.get() for n in batch)
+        self.assertListEqual(batches, expected)
+        self.assertListEqual(it.next_batch(7), [])
+
+        root = self._itTestTree()
+        it = iterator(root, TreeOrder.PRE_ORDER)
+        self.assertListEqual(it.next_batch(100), list(iterator(root, TreeOrder.PRE_ORDER)))
+        self.assertListEqual(it.next_batch(100), [])
+
+    def testIteratorMaxDepth(self) -> None:
+        root = self._itTestTree()
+        it = iterator(root, TreeOrder.PRE_ORDER, max_depth=1)
+        self.assertListEqual(self._get_nodetypes(it), ['root', 'son1', 'son2'])
+
+        it = iterator(root, TreeOrder.LEVEL_ORDER, max_depth=0)
+        self.assertListEqual(self._get_nodetypes(it), ['root'])
+
+        # arrays don't count as a level, the elements of a field are one level
+        # below the node it belongs to
+        tree = {"@type": "root", "Nodes": [{"@type": "a", "Nodes": [{"@type": "b"}]}]}
+        for order in (TreeOrder.PRE_ORDER, TreeOrder.LEVEL_ORDER):
+            it = iterator(tree, order, max_depth=1)
+            self.assertListEqual([n["@type"] for n in it if isinstance(n, dict)],
+                                 ["root", "a"])
+            # without limits the walk returns what a plain iteration does
+            self.assertListEqual(list(iterator(tree, order, prunable=True)),
+                                 list(iterator(tree, order)))
+
+        with self.assertRaises(ValueError):
+            iterator(root, TreeOrder.POST_ORDER, max_depth=1)
+
+    def testIteratorSkipChildren(self) -> None:
+        root = self._itTestTree()
+        it = iterator(root, TreeOrder.PRE_ORDER, prunable=True)
+        types = []
+        for n in it:
+            types.append(n["@type"])
+            if n["@type"] == "son1":
+                it.skip_children()
+        self.assertListEqual(types, ['root', 'son1', 'son2', 'son2_1', 'son2_2'])
+
+        with self.assertRaises(RuntimeError):
+            iterator(root, TreeOrder.PRE_ORDER).skip_children()
+
+    def testIteratePrune(self) -> None:
+        ctx = self._parse_fixture()
+        full = self._get_nodes(ctx.iterate(TreeOrder.PRE_ORDER))
+        self.assertListEqual(self._get_nodes(ctx.iterate(TreeOrder.PRE_ORDER, skippable=True)), full)
+        self.assertListEqual(self._get_nodes(ctx.iterate(TreeOrder.LEVEL_ORDER, skippable=True)),
+                             self._get_nodes(ctx.iterate(TreeOrder.LEVEL_ORDER)))
+
+        pruned = self._get_nodes(ctx.iterate(TreeOrder.PRE_ORDER, prune={"uast:RuntimeImport"}))
+        self.assertLess(len(pruned), len(full))
+        imports = [n for n in pruned if isinstance(n, dict) and n.get("@type") == "uast:RuntimeImport"]
+        self.assertEqual(len(imports), ctx.count("//uast:RuntimeImport"))
+
+        top = self._get_nodes(ctx.root.iterate(TreeOrder.PRE_ORDER, max_depth=0))
+        self.assertListEqual(top, [ctx.root.get()])
+
     # Iterating from the root node should give the same result as
     # iterating from the tree, for every available node
     def testNodeIteratorEqualsCtxIterator(self) -> None:
@@ -587,6 +865,69 @@ class BblfshTests(unittest.TestCase):
         for nodeC, nodePy in zip(itC, itPy):
             self.assertEqual(nodeC.get(), nodePy)
 
+    def testPythonContextReuse(self) -> None:
+        root = self._itTestTree()
+        ctx = bblfsh.context(root)
+        expected = ['root', 'son1', 'son1_1', 'son1_2', 'son2', 'son2_1', 'son2_2']
+
+        for _ in range(3):
+            self.assertListEqual(self._get_nodetypes(ctx.iterate(TreeOrder.PRE_ORDER)), expected)
+            self.assertEqual(len(list(ctx.filter("//son1_1"))), 1)
+
+        it = ctx.iterate(TreeOrder.PRE_ORDER)
+        root["children"].append({"@type": "son3"})
+        ctx.invalidate()
+        self.assertListEqual(self._get_nodetypes(ctx.iterate(TreeOrder.PRE_ORDER)),
+                             expected + ['son3'])
+        # iterators created before the invalidation keep working
+        self.assertEqual(next(it)["@type"], "root")
+
+        ctx.root = {"@type": "other"}
+        self.assertListEqual(self._get_nodetypes(ctx.iterate(TreeOrder.PRE_ORDER)), ['other'])
+
+    def testPythonContextArenaStats(self) -> None:
+        ctx = bblfsh.context(self._itTestTree())
+        self.assertEqual(ctx.arena_stats()["nodes"], 0)
+
+        list(ctx.iterate(TreeOrder.PRE_ORDER))
+        stats = ctx.arena_stats()
+        self.assertGreater(stats["nodes"], 0)
+        self.assertGreaterEqual(stats["capacity"], stats["nodes"])
+
+        list(ctx.iterate(TreeOrder.PRE_ORDER))
+        self.assertEqual(ctx.arena_stats()["nodes"], stats["nodes"])
+
+        # encoding visits the whole tree, so the storage is sized from it
+        ctx = bblfsh.context(self._itTestTree())
+        ctx.encode()
+        self.assertEqual(ctx.arena_stats()["blocks"], 1)
+
+    def testEncodeTo(self) -> None:
+        ctx = self._parse_fixture()
+        encoded = bytes(ctx.encode(fmt=0))
+
+        out = io.BytesIO()
+        self.assertEqual(ctx.encode_to(out), len(encoded))
+        self.assertEqual(out.getvalue(), encoded)
+
+        buf = bytearray(len(encoded) + 10)
+        self.assertEqual(ctx.encode_to(buf), len(encoded))
+        self.assertEqual(bytes(buf[:len(encoded)]), encoded)
+        with self.assertRaises(ValueError):
+            ctx.encode_to(bytearray(10))
+        with self.assertRaises(TypeError):
+            ctx.encode_to(True)
+
+        with tempfile.TemporaryFile() as f:
+            self.assertEqual(ctx.encode_to(f.fileno()), len(encoded))
+            f.seek(0)
+            self.assertEqual(f.read(), encoded)
+
+        pyctx = bblfsh.context(ctx.root.get())
+        out = io.BytesIO()
+        pyctx.encode_to(out)
+        self.assertEqual(decode(out.getvalue(), format=0).load(), ctx.root.get())
+
     def testBinaryEncodeDecodePythonContext(self) -> None:
         # Binary encoding should be invertible
         # C++ memory context
@@ -599,6 +940,201 @@ class BblfshTests(unittest.TestCase):
 
         self.assertEqual(pyDict, decoded.load())
 
+    def testExtract(self) -> None:
+        ctx = self._parse_fixture()
+        func = ctx.first("//uast:FunctionGroup")
+        sub = ctx.extract(func)
+        expected = func.get()
+        del ctx, func
+        gc.collect()
+
+        self.assertEqual(sub.root.get(), expected)
+        self.assertEqual(sub.language, "python")
+        self.assertEqual(sub.first("//uast:FunctionGroup").get(), expected)
+
+    def testMemoryUsageAndClose(self) -> None:
+        ctx = self._parse_fixture()
+        usage = ctx.memory_usage()
+        self.assertGreater(usage["response"], 0)
+        self.assertGreater(usage["encoded_size"], 0)
+        self.assertEqual(usage["type_index"], 0)
+
+        ids = list(ctx.nodes_of_type("uast:Identifier"))
+        self.assertGreater(ctx.memory_usage()["type_index"], 0)
+        ctx.drop_caches()
+        self.assertEqual(ctx.memory_usage()["type_index"], 0)
+        self.assertEqual(len(list(ctx.nodes_of_type("uast:Identifier"))), len(ids))
+
+        # tokens(), nodes_with_roles() and subtree_hashes() don't keep anything
+        total = ctx.memory_usage()["total"]
+        ctx.tokens()
+        ctx.nodes_with_roles(all=["Identifier"])
+        ctx.subtree_hashes()
+        self.assertEqual(ctx.memory_usage()["total"], total)
+
+        with self.client.parse(self.fixtures_pyfile, keep_response=False) as ctx2:
+            self.assertEqual(ctx2.memory_usage()["response"], 0)
+            self.assertEqual(ctx2.language, "python")
+            node = ctx2.first("//uast:Identifier")
+        # nodes keep working after closing the context they came from
+        self.assertEqual(node.internal_type, "uast:Identifier")
+        self.assertEqual(ctx2.filename, "test.py")
+        self.assertEqual(ctx2.memory_usage()["total"], 0)
+        with self.assertRaises(ClosedContextException):
+            ctx2.filter("//uast:Identifier")
+        with self.assertRaises(ClosedContextException):
+            ctx2.tokens()
+
+    def testSubtreeHashes(self) -> None:
+        def ident(offset: int) -> dict:
+            return {"@type": "uast:Identifier", "Name": "x",
+                    "@pos": {"@type": "uast:Positions",
+                             "start": {"@type": "uast:Position", "offset": offset}}}
+
+        tree = {"@type": "root", "Nodes": [ident(1), ident(5)]}
+        hashes = bblfsh.context(tree).subtree_hashes()
+        self.assertEqual([h.parent for h in hashes], [-1, 0, 0])
+        self.assertEqual(hashes[1].hash, hashes[2].hash)
+        self.assertNotEqual(hashes[0].hash, hashes[1].hash)
+
+        hashes = bblfsh.context(tree).subtree_hashes(ignore_positions=False)
+        self.assertNotEqual(hashes[1].hash, hashes[2].hash)
+
+        ctx = self._parse_fixture()
+        hashes = ctx.subtree_hashes()
+        self.assertEqual(len(hashes), sum(1 for n in ctx.iterate(TreeOrder.PRE_ORDER)
+                                          if isinstance(n.get(), dict) and
+                                          "@type" in n.get()))
+        self.assertIsInstance(hashes[0].node, NodeExt)
+        self.assertEqual(hashes[0].node.load(), hashes[0].value)
+        # the values belong to the caller, changing them doesn't affect other calls
+        hashes[0].value["@type"] = "changed"
+        self.assertNotEqual(ctx.subtree_hashes()[0].value["@type"], "changed")
+        # hashes don't depend on the context
+        pyhashes = bblfsh.context(ctx.root.get()).subtree_hashes()
+        self.assertEqual([h.hash for h in hashes], [h.hash for h in pyhashes])
+
+    def testDiff(self) -> None:
+        with open(self.fixtures_pyfile) as f:
+            code = f.read()
+        old = self.client.parse(self.fixtures_pyfile, contents=code)
+        # shifting the whole file doesn't change anything
+        shifted = self.client.parse(self.fixtures_pyfile, contents="\n\n" + code)
+        self.assertEqual(bblfsh.diff(old, shifted), ([], [], [], []))
+
+        def ident(name: str) -> dict:
+            return {"@type": "uast:Identifier", "Name": name}
+
+        def block(*nodes: dict) -> dict:
+            return {"@type": "uast:Block", "Statements": list(nodes)}
+
+        a = bblfsh.context(block(block(ident("x"), ident("y")), block(ident("z"))))
+        b = bblfsh.context(block(block(ident("y")), block(ident("z"), ident("x")),
+                                 ident("w")))
+        res = bblfsh.diff(a, b)
+        self.assertEqual(res.inserted, [ident("w")])
+        self.assertEqual(res.deleted, [])
+        self.assertEqual(res.moved, [(ident("x"), ident("x"))])
+        self.assertEqual(res.updated, [])
+
+        res = bblfsh.diff(a, bblfsh.context(block(block(ident("x"), ident("v")),
+                                                  block(ident("z")))))
+        self.assertEqual(res.updated, [(ident("y"), ident("v"))])
+
+    def testTokens(self) -> None:
+        ctx = self._parse_fixture()
+        toks = ctx.tokens(types=["uast:Identifier"])
+        names = [n.get()["Name"] for n in ctx.filter("//uast:Identifier")]
+        self.assertEqual(sorted(t[0] for t in toks), sorted(names))
+        self.assertTrue(all(t[1] == "uast:Identifier" for t in toks))
+        offsets = [t[3] for t in toks if t[3] >= 0]
+        self.assertEqual(offsets, sorted(offsets))
+
+        toks = ctx.tokens(roles=["Identifier"])
+        self.assertTrue(toks)
+        self.assertTrue(all("Identifier" in t[2] for t in toks))
+
+        tree = {"@type": "root", "Nodes": [
+            {"@type": "uast:String", "Value": "b", "@role": ["Literal"],
+             "@pos": {"@type": "uast:Positions",
+                      "start": {"@type": "uast:Position", "offset": 5}}},
+            {"@type": "uast:Identifier", "Name": "a",
+             "@pos": {"@type": "uast:Positions",
+                      "start": {"@type": "uast:Position", "offset": 1}}},
+            {"@type": "uast:Identifier", "Name": "c"},
+        ]}
+        self.assertEqual(bblfsh.context(tree).tokens(), [
+            ("a", "uast:Identifier", (), 1),
+            ("b", "uast:String", ("Literal",), 5),
+            ("c", "uast:Identifier", (), -1),
+        ])
+
+        # repeated roles don't stand for missing ones
+        tree["Nodes"][0]["@role"] = ["Literal", "Literal"]
+        ctx = bblfsh.context(tree)
+        self.assertEqual(ctx.tokens(roles=["Literal", "Identifier"]), [])
+        self.assertEqual(len(ctx.tokens(roles=["Literal"])), 1)
+
+    def testNodeText(self) -> None:
+        ctx = self.client.parse(self.fixtures_pyfile, keep_source=True)
+        for node in ctx.filter("//uast:Identifier"):
+            if "@pos" not in node.get():
+                continue
+            start, end = ctx.node_span(node)
+            self.assertLess(start, end)
+            self.assertEqual(ctx.node_text(node), node.get()["Name"])
+
+        with self.assertRaises(ValueError):
+            self._parse_fixture().node_text(ctx.root)
+
+    def testSourceOffsets(self) -> None:
+        source = Source("a\u00e9\u20ac\U0001f600b")
+        self.assertEqual(len(source), 11)
+        self.assertEqual([source.byte_offset(i) for i in range(6)], [0, 1, 3, 6, 10, 11])
+        self.assertEqual([source.char_offset(b) for b in range(12)],
+                         [0, 1, 1, 2, 2, 2, 3, 3, 3, 3, 4, 5])
+        self.assertEqual(source.slice(1, 6), "\u00e9\u20ac")
+        self.assertEqual(Source(b"abc").char_offset(2), 2)
+
+    def testLineIndex(self) -> None:
+        lines = Source("ab\nx\u00e9\U0001f600z\n\nq").lines
+        self.assertEqual(list(lines.line_starts), [0, 3, 12, 13])
+        self.assertEqual(lines.line_col(4), (2, 2))
+        self.assertEqual(lines.offset(2, 2), 4)
+        self.assertEqual(lines.utf16_line_col(10), (2, 4))
+        self.assertEqual(lines.offset_from_utf16(2, 4), 10)
+        with self.assertRaises(IndexError):
+            # in the middle of a surrogate pair
+            lines.offset_from_utf16(2, 3)
+
+        lns, cols = lines.utf16_lines_cols([0, 4, 6, 11, 13])
+        self.assertEqual(list(lns), [1, 2, 2, 2, 4])
+        self.assertEqual(list(cols), [0, 1, 2, 5, 0])
+        self.assertEqual(list(lines.offsets_from_utf16(lns, cols)), [0, 4, 6, 11, 13])
+
+        ctx = self.client.parse(self.fixtures_pyfile, keep_source=True)
+        for node in ctx.filter("//uast:Identifier"):
+            pos = node.get().get("@pos")
+            if pos:
+                start = pos["start"]
+                self.assertEqual(ctx.lines.line_col(start["offset"]),
+                                 (start["line"], start["col"]))
+
+    def testCompressedEncodeDecode(self) -> None:
+        ctx = self._parse_fixture()
+        plain = bytes(ctx.encode(fmt=0))
+        packed = ctx.encode(fmt=0, compression="zlib")
+        self.assertLess(len(packed), len(plain))
+        self.assertEqual(bblfsh.decode(packed).load(), ctx.root.get())
+        self.assertEqual(bblfsh.decode(plain).load(), ctx.root.get())
+
+        pyctx = bblfsh.context(ctx.root.get())
+        packed = pyctx.encode(compression="zlib")
+        self.assertEqual(bblfsh.decode(packed).load(), ctx.root.get())
+
+        with self.assertRaises(ValueError):
+            ctx.encode(compression="unknown")
+
     def testInvalidDecodeBytes(self) -> None:
         with self.assertRaises(RuntimeError):
             decode(b'', format = 0)
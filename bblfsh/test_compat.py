@@ -7,7 +7,7 @@ from bblfsh.client import NonUTF8ContentException
 from bblfsh.compat import CompatBblfshClient as BblfshClient
 from bblfsh.compat import (
     filter as xpath_filter, role_id, iterator, role_name, Node, TreeOrder, filter_bool,
-    filter_number, CompatNodeIterator
+    filter_number, filter_nodes, filter_string, CompatNodeIterator, TypedQueryException
 )
 from bblfsh.launcher import ensure_bblfsh_is_running
 
@@ -143,6 +143,15 @@ class BblfshTests(unittest.TestCase):
                             "count(//uast:Positions/end/uast:Position[@col=49])")
         self.assertEqual(int(res), 2)
 
+    def testFilterTypedErrors(self):
+        root = self._parse_fixture().uast
+        with self.assertRaises(TypedQueryException):
+            filter_string(root, "count(//uast:Identifier)")
+        with self.assertRaises(TypedQueryException):
+            filter_number(root, "//uast:Identifier")
+        with self.assertRaises(IndexError):
+            filter_string(root, "//uast:Identifier[@Name='no such name']/@Name")
+
     # get_str() already tested by testFilterToken
 
     def testRoleIdName(self):
@@ -210,6 +219,24 @@ class BblfshTests(unittest.TestCase):
         self.assertListEqual(expanded, ['root', 'son1', 'son2', 'son1_1',
                                         'son1_2', 'son2_1', 'son2_2'])
 
+    def testIteratorNodesOnly(self):
+        root = self._parse_fixture().uast
+        nodes = list(iterator(root, TreeOrder.PRE_ORDER))
+        self.assertGreater(len(nodes), 0)
+        for n in nodes:
+            self.assertIsInstance(n.get_dict(), dict)
+            self.assertNotEqual(n.internal_type, "uast:Positions")
+
+        tree = {"@type": "root", "@pos": {"@type": "uast:Positions"}, "name": "x",
+                "children": [{"@type": "child", "ids": [1, 2]}, {"no_type": True}]}
+        types = [n.internal_type for n in iterator(tree, TreeOrder.PRE_ORDER)]
+        self.assertListEqual(types, ["root", "child"])
+
+        found = list(filter_nodes(root, "//uast:Identifier"))
+        self.assertGreater(len(found), 0)
+        for n in found:
+            self.assertEqual(n.internal_type, "uast:Identifier")
+
     def testAddToNode(self):
         n = Node()
         n.internal_node["foo"] = "bar"
@@ -301,8 +328,29 @@ class BblfshTests(unittest.TestCase):
         self.assertDictEqual(n.children[3].get_dict(), l[0])
         self.assertDictEqual(n.children[4].get_dict(), l[1])
 
+    def testChildrenIdentity(self):
+        n = Node()
+        n.internal_type = 'root'
+        # equal but distinct nodes are different children
+        l = [{"@type": "child"}, {"@type": "child"}]
+        n.properties["some_list"] = l
+        self.assertEqual(len(n.children), 2)
+        self.assertIs(n.children, n.children)
+
+        l.append({"@type": "child"})
+        self.assertEqual(len(n.children), 3)
+        del n.children[0]
+        # still in the properties, so it is added back
+        self.assertEqual(len(n.children), 3)
+
+        # replacing a list item without resizing the list is noticed too
+        l[0] = {"@type": "replaced"}
+        self.assertIn("replaced", [c.internal_type for c in n.children])
+
     def testChildrenFile(self):
         root = self._parse_fixture().uast
+        # one child per top-level statement; each has its own position, so
+        # none of them are equal and deduplicating by identity keeps them all
         self.assertEqual(len(root.children), 10)
         n = Node()
         n.internal_type = 'child_node'
@@ -1,3 +1,9 @@
-from typing import Union
+from typing import AbstractSet, Any, Callable, Tuple, Union
 
 ResultMultiType = Union[dict, int, float, bool, str, None]
+# Node types or predicate selecting the nodes whose children won't be iterated
+PruneType = Union[AbstractSet[str], Callable[[Any], bool], None]
+# File descriptor, writable buffer or object with a write() method
+EncodeDestType = Union[int, bytearray, memoryview, Any]
+# (token, type, roles, start offset) as returned by ResultContext.tokens
+TokenTuple = Tuple[str, str, Tuple[str, ...], int]
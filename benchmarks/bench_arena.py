@@ -0,0 +1,43 @@
+"""
+Measures the creation of native nodes for Python trees: the time of the first
+walk over a fresh context, which creates a node per Python object, and the
+number of nodes and allocation blocks it needs.
+"""
+import argparse
+import time
+
+import bblfsh
+from bblfsh import TreeOrder
+
+from synthetic import drain, generate
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("%10s %10s %8s %10s %12s %12s" % ("nodes", "native", "blocks", "capacity",
+                                            "walk ms", "encode ms"))
+    for size in args.sizes:
+        tree = generate(size)
+        walk = encode = 0.0
+        for _ in range(args.repeat):
+            ctx = bblfsh.context(tree)
+            start = time.perf_counter()
+            drain(ctx.iterate(TreeOrder.PRE_ORDER))
+            walk += time.perf_counter() - start
+
+            ctx = bblfsh.context(tree)
+            start = time.perf_counter()
+            ctx.encode()
+            encode += time.perf_counter() - start
+        stats = ctx.arena_stats()
+        print("%10d %10d %8d %10d %12.2f %12.2f" % (
+            size, stats["nodes"], stats["blocks"], stats["capacity"],
+            walk / args.repeat * 1e3, encode / args.repeat * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Compares the per-node cost of the one-at-a-time iterator protocol with
+next_batch(), both on the native iterators and on NodeIterator.
+"""
+import argparse
+
+from bblfsh import TreeOrder, iterator
+
+from synthetic import drain, generate, result_context, timed
+
+
+def per_node_ns(fn) -> float:
+    t = timed(fn)
+    return t.mean * 1e9 / max(t.result, 1)
+
+
+def drain_batch(it, n: int) -> int:
+    count = 0
+    while True:
+        batch = it.next_batch(n)
+        if not batch:
+            return count
+        count += len(batch)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size", type=int, default=100000)
+    parser.add_argument("--batch", type=int, nargs="+", default=[16, 256, 4096])
+    args = parser.parse_args()
+
+    tree = generate(args.size)
+    ctx = result_context(tree)
+    cases = [
+        ("IteratorExt", lambda: iterator(ctx.ctx.root(), TreeOrder.PRE_ORDER)),
+        ("Iterator", lambda: iterator(tree, TreeOrder.PRE_ORDER)),
+        ("NodeIterator", lambda: ctx.iterate(TreeOrder.PRE_ORDER)),
+    ]
+
+    print("%-14s %8s %12s" % ("iterator", "batch", "ns/node"))
+    for name, make in cases:
+        print("%-14s %8s %12.1f" % (name, "-", per_node_ns(lambda: drain(make()))))
+        for n in args.batch:
+            print("%-14s %8d %12.1f" % (name, n, per_node_ns(lambda: drain_batch(make(), n))))
+
+
+if __name__ == "__main__":
+    main()
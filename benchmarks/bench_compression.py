@@ -0,0 +1,49 @@
+"""
+Compares the size and the encode and decode times of UASTs without compression
+and with the zlib codec at several levels, with and without the preset UAST
+dictionary. Parses the given files with bblfshd, or uses synthetic trees if no
+files are given.
+"""
+import argparse
+
+from bblfsh import BblfshClient, decode
+from bblfsh.compression import ZlibCodec, register_codec
+
+from synthetic import generate, result_context, timed
+
+CODECS = [None]
+for level in (1, 6, 9):
+    register_codec(ZlibCodec(level, name="zlib-%d" % level))
+    register_codec(ZlibCodec(level, zdict=b"", name="zlib-%d-nodict" % level))
+    CODECS += ["zlib-%d" % level, "zlib-%d-nodict" % level]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("files", nargs="*")
+    parser.add_argument("--endpoint", default="localhost:9432")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.files:
+        client = BblfshClient(args.endpoint)
+        inputs = [(path, client.parse(path)) for path in args.files]
+    else:
+        inputs = [("synthetic-%d" % size, result_context(generate(size)))
+                  for size in args.sizes]
+
+    print("%-24s %-16s %12s %8s %10s %10s" % ("input", "codec", "bytes", "ratio",
+                                              "encode ms", "decode ms"))
+    for name, ctx in inputs:
+        plain = len(ctx.encode())
+        for codec in CODECS:
+            data, _, _, enc = timed(lambda: ctx.encode(compression=codec), args.repeat)
+            dec = timed(lambda: decode(data), args.repeat).mean
+            print("%-24s %-16s %12d %8.3f %10.2f %10.2f" % (
+                name[-24:], codec or "none", len(data), len(data) / plain,
+                enc * 1e3, dec * 1e3))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""
+Measures the cost of iterating the same Python tree repeatedly with a fresh
+native context per call (pyuast.iterator) and with a persistent one
+(bblfsh.context).
+"""
+import argparse
+
+import bblfsh
+from bblfsh import TreeOrder, iterator
+
+from synthetic import drain, generate, timed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    print("%10s %14s %14s %8s" % ("nodes", "fresh ms", "persistent ms", "speedup"))
+    for size in args.sizes:
+        tree = generate(size)
+        ctx = bblfsh.context(tree)
+
+        fresh = timed(lambda: drain(iterator(tree, TreeOrder.PRE_ORDER)), args.repeat).mean
+        # the first walk builds the node map, the rest reuse it
+        drain(ctx.iterate(TreeOrder.PRE_ORDER))
+        persistent = timed(lambda: drain(ctx.iterate(TreeOrder.PRE_ORDER)), args.repeat).mean
+        print("%10d %14.2f %14.2f %8.2f" % (size, fresh * 1e3, persistent * 1e3, fresh / persistent))
+
+
+if __name__ == "__main__":
+    main()
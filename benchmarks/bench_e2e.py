@@ -0,0 +1,115 @@
+"""
+Measures the throughput of BblfshClient.parse end to end, gRPC and decoding
+included, against the fake server of fake_bblfshd.py, at several concurrency
+levels. Reports files per second, megabytes of UAST per second and latency
+percentiles.
+
+The server replays the responses recorded in --responses or, by default,
+synthetic UASTs. To record responses from a real server:
+
+    python3 bench_e2e.py --record recordings/ --endpoint localhost:9432 file.py ...
+"""
+import argparse
+import math
+import time
+from concurrent import futures
+from typing import Dict, List
+
+from bblfsh import BblfshClient
+from bblfsh.aliases import ParseResponse
+
+from fake_bblfshd import FakeServer, load_responses, record
+from synthetic import encode, generate
+
+
+def synthetic_responses(count: int, size: int) -> Dict[str, bytes]:
+    responses = {}
+    for i in range(count):
+        name = "synthetic%d.py" % i
+        data = encode(generate(size, seed=i))
+        responses[name] = ParseResponse(uast=data, language="python",
+                                        filename=name).SerializeToString()
+    return responses
+
+
+def percentile(values: List[float], p: float) -> float:
+    # nearest-rank percentile of sorted values
+    k = max(0, math.ceil(p / 100 * len(values)) - 1)
+    return values[k]
+
+
+def run(client: BblfshClient, names: List[str], requests: int, concurrency: int,
+        sizes: Dict[str, int]) -> dict:
+    def parse(i: int) -> float:
+        name = names[i % len(names)]
+        start = time.perf_counter()
+        client.parse(name, language="python", contents="", keep_response=False)
+        return time.perf_counter() - start
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = sorted(pool.map(parse, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    total = sum(sizes[names[i % len(names)]] for i in range(requests))
+    return {
+        "files_s": requests / elapsed,
+        "mb_s": total / elapsed / 1e6,
+        "p50": percentile(latencies, 50),
+        "p90": percentile(latencies, 90),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="files to parse with --record")
+    parser.add_argument("--responses", help="directory of recorded responses")
+    parser.add_argument("--record", help="record the responses of --endpoint for the "
+                                         "given files into this directory and exit")
+    parser.add_argument("--endpoint", default="localhost:9432")
+    parser.add_argument("--synthetic", type=int, default=16,
+                        help="number of synthetic responses if none are recorded")
+    parser.add_argument("--size", type=int, default=2000,
+                        help="nodes of each synthetic response")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="milliseconds")
+    args = parser.parse_args()
+
+    if args.record:
+        client = BblfshClient(args.endpoint)
+        names = record(client, args.files, args.record)
+        client.close()
+        print("recorded %d responses in %s" % (len(names), args.record))
+        return
+
+    if args.responses:
+        responses = load_responses(args.responses)
+    else:
+        responses = synthetic_responses(args.synthetic, args.size)
+    names = sorted(responses)
+    sizes = {name: len(ParseResponse.FromString(data).uast)
+             for name, data in responses.items()}
+
+    server = FakeServer(responses, latency=args.latency / 1e3, jitter=args.jitter / 1e3,
+                        workers=max(args.concurrency))
+    with server:
+        client = BblfshClient(server.endpoint)
+        # warm up the channel
+        run(client, names, min(len(names), args.requests), 1, sizes)
+
+        print("%12s %10s %10s %10s %10s %10s" % ("concurrency", "files/s", "MB/s",
+                                                 "p50 ms", "p90 ms", "p99 ms"))
+        for concurrency in args.concurrency:
+            r = run(client, names, args.requests, concurrency, sizes)
+            print("%12d %10.1f %10.2f %10.2f %10.2f %10.2f" % (
+                concurrency, r["files_s"], r["mb_s"], r["p50"] * 1e3, r["p90"] * 1e3,
+                r["p99"] * 1e3))
+        client.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Compares writing an encoded UAST to a file with encode() followed by write()
+and with encode_to(), reporting the time and how much the peak resident memory
+of the process grows during each of them.
+
+The buffer libuast encodes into is allocated outside of Python, so it is
+measured with the resident set size instead of tracemalloc. encode() holds that
+buffer and a Python copy of it at the same time, while encode_to() writes the
+buffer in chunks, so the saving is about the size of the encoded data. Measuring
+the peak requires Linux 4.0 or newer; elsewhere it is reported as n/a.
+"""
+import argparse
+import gc
+import tempfile
+import time
+from typing import Optional, Tuple
+
+from synthetic import encode, generate, result_context
+
+
+def _status_bytes(field: str) -> Optional[int]:
+    # a "VmRSS:   1234 kB" line of /proc/self/status, in bytes
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak() -> bool:
+    # writing 5 to clear_refs sets the peak (VmHWM) back to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def measure(fn) -> Tuple[float, Optional[int]]:
+    gc.collect()
+    before = _status_bytes("VmRSS") if _reset_peak() else None
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    peak = _status_bytes("VmHWM")
+    if before is None or peak is None:
+        return elapsed, None
+    return elapsed, peak - before
+
+
+def _mb(n: Optional[int]) -> str:
+    return "n/a" if n is None else "%.2f" % (n / 2 ** 20)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    args = parser.parse_args()
+
+    print("%10s %10s %12s %12s %14s %14s" % ("nodes", "MB", "encode ms", "encode_to ms",
+                                             "encode RSS MB", "encode_to RSS MB"))
+    with tempfile.TemporaryFile() as f:
+        for size in args.sizes:
+            # decode from bytes so that the Python tree is gone before measuring
+            ctx = result_context(encode(generate(size)))
+
+            def copy():
+                f.seek(0)
+                f.write(ctx.encode())
+
+            def stream():
+                f.seek(0)
+                ctx.encode_to(f)
+
+            copy_time, copy_peak = measure(copy)
+            stream_time, stream_peak = measure(stream)
+            mb = f.tell() / 2 ** 20
+            print("%10d %10.2f %12.2f %12.2f %14s %14s" % (
+                size, mb, copy_time * 1e3, stream_time * 1e3, _mb(copy_peak),
+                _mb(stream_peak)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Measures the memory used by each pyuast operation on synthetic trees: the peak
+RSS growth while it runs, and the Python memory (tracemalloc) still allocated
+while its result is held. tracemalloc doesn't see the allocations of libuast,
+which only show up in RSS. Every measurement runs in its own forked process,
+so they don't affect each other.
+
+With --leaks N, decoding, filtering, iterating and loading are repeated N times
+and the command fails if RSS keeps growing after the first iterations.
+"""
+import argparse
+import gc
+import multiprocessing
+import os
+import resource
+import sys
+import tracemalloc
+from typing import Callable, Dict
+
+import bblfsh
+from bblfsh import TreeOrder
+from bblfsh.node import Node
+from bblfsh.pyuast import decode
+from bblfsh.result_context import ResultContext
+
+from synthetic import drain, encode, generate, result_context
+
+QUERY = "//uast:Identifier"
+
+
+def rss() -> int:
+    """
+    Returns the current resident set size in bytes, or the peak one where the
+    current one is not available.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return peak_rss()
+
+
+def peak_rss() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def operations(tree: dict, data: bytes) -> Dict[str, Callable[[], Callable[[], object]]]:
+    """
+    Returns the measured operations. Each entry prepares its inputs, which are
+    not measured, and returns the operation, whose result is held while the
+    retained memory is measured.
+    """
+    def new_context() -> ResultContext:
+        return result_context(data, keep_response=False)
+
+    def prepare_decode():
+        return lambda: decode(data, format=0)
+
+    def prepare_get_all():
+        return new_context().get_all
+
+    def prepare_filter():
+        ctx = new_context()
+        return lambda: list(ctx.filter(QUERY))
+
+    def prepare_node_wrap():
+        ctx = new_context()
+        exts = list(ctx.ctx.filter(QUERY))
+        return lambda: [Node(node_ext=e, ctx=ctx.ctx) for e in exts]
+
+    def prepare_held_iterator():
+        ctx = new_context()
+
+        def op():
+            it = ctx.iterate(TreeOrder.PRE_ORDER)
+            next(it)
+            return it
+        return op
+
+    def prepare_python_context():
+        def op():
+            ctx = bblfsh.context(tree)
+            drain(ctx.iterate(TreeOrder.PRE_ORDER))
+            return ctx
+        return op
+
+    return {
+        "decode": prepare_decode,
+        "get_all": prepare_get_all,
+        "filter": prepare_filter,
+        "node_wrap": prepare_node_wrap,
+        "held_iterator": prepare_held_iterator,
+        "python_context": prepare_python_context,
+    }
+
+
+def _measure(prepare: Callable[[], Callable[[], object]], conn) -> None:
+    op = prepare()
+    gc.collect()
+    before = rss()
+    tracemalloc.start()
+    result = op()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    conn.send({
+        "peak_rss": max(0, peak_rss() - before),
+        "rss": rss() - before,
+        "traced_peak": peak,
+        "traced_retained": retained,
+    })
+    del result
+
+
+def measure(prepare: Callable[[], Callable[[], object]]) -> dict:
+    ctx = multiprocessing.get_context("fork")
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_measure, args=(prepare, send))
+    proc.start()
+    res = recv.recv()
+    proc.join()
+    return res
+
+
+def check_leaks(data: bytes, iterations: int, tolerance: int) -> bool:
+    """
+    Repeats decode, filter, iterate and load, and checks that RSS doesn't grow by
+    more than tolerance bytes after the first tenth of the iterations.
+    """
+    warmup = max(1, iterations // 10)
+    start = 0
+    for i in range(iterations):
+        ctx = result_context(data)
+        drain(ctx.filter(QUERY))
+        drain(ctx.iterate(TreeOrder.PRE_ORDER))
+        ctx.get_all()
+        del ctx
+        if i + 1 == warmup:
+            gc.collect()
+            start = rss()
+
+    gc.collect()
+    growth = rss() - start
+    print("%d iterations, RSS growth after warm-up: %.2f MB (tolerance %.2f MB)" % (
+        iterations, growth / 1e6, tolerance / 1e6))
+    return growth <= tolerance
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--leaks", type=int, default=0, metavar="N",
+                        help="check for leaks repeating the operations N times")
+    parser.add_argument("--leak-size", type=int, default=10000)
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="RSS growth allowed by --leaks, in MB")
+    args = parser.parse_args()
+
+    if args.leaks:
+        data = encode(generate(args.leak_size))
+        if not check_leaks(data, args.leaks, int(args.tolerance * 1e6)):
+            sys.exit(1)
+        return
+
+    print("%-16s %10s %12s %12s %14s %14s" % ("operation", "nodes", "peak RSS MB",
+                                              "RSS MB", "traced peak MB", "retained MB"))
+    for size in args.sizes:
+        tree = generate(size)
+        data = encode(tree)
+        for name, prepare in operations(tree, data).items():
+            r = measure(prepare)
+            print("%-16s %10d %12.2f %12.2f %14.2f %14.2f" % (
+                name, size, r["peak_rss"] / 1e6, r["rss"] / 1e6,
+                r["traced_peak"] / 1e6, r["traced_retained"] / 1e6))
+
+
+if __name__ == "__main__":
+    main()
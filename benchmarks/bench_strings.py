@@ -0,0 +1,33 @@
+"""
+Measures the string conversions between Python and libuast on Python trees:
+filtering and encoding read every key and string value, loading a decoded tree
+creates them.
+"""
+import argparse
+
+import bblfsh
+from bblfsh.pyuast import decode
+
+from synthetic import drain, generate, timed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    print("%10s %12s %12s %12s" % ("nodes", "filter ms", "encode ms", "load ms"))
+    for size in args.sizes:
+        ctx = bblfsh.context(generate(size))
+        data = bytes(ctx.encode())
+
+        filtering = timed(lambda: drain(ctx.filter("//uast:Identifier[@Name='x1']")),
+                          args.repeat).mean
+        encoding = timed(lambda: ctx.encode(), args.repeat).mean
+        loading = timed(lambda: decode(data, format=0).load(), args.repeat).mean
+        print("%10d %12.2f %12.2f %12.2f" % (size, filtering * 1e3, encoding * 1e3, loading * 1e3))
+
+
+if __name__ == "__main__":
+    main()
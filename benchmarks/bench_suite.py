@@ -0,0 +1,154 @@
+"""
+Times the hot paths of the client on synthetic UASTs: decoding, loading the whole
+tree, queries, iteration in every order, Node construction and encoding.
+
+Results can be saved as JSON with --output and compared with a previous run
+with --compare, which exits with an error if any operation got slower than the
+given threshold.
+"""
+import argparse
+import json
+import platform
+import sys
+from typing import Callable, Dict, List, Optional
+
+import bblfsh
+from bblfsh import TreeOrder
+from bblfsh.node import Node
+from bblfsh.pyuast import decode
+
+from synthetic import DEFAULT_TYPES, drain, encode, generate, result_context, timed
+
+QUERIES = {
+    "type": "//uast:Identifier",
+    "attr": "//uast:Identifier[@Name='x1']",
+    "role": "//*[@role='Call']",
+    "nested": "//python:Call//uast:String",
+    "count": "count(//uast:Identifier)",
+}
+
+
+def operations(data: bytes) -> Dict[str, Callable[[], object]]:
+    """
+    Returns the benchmarked operations over an encoded UAST. Each operation works
+    on its own context, so caches built by one don't speed up the others.
+    """
+    ops: Dict[str, Callable[[], object]] = {"decode": lambda: decode(data, format=0)}
+
+    ctx = result_context(data)
+    ops["get_all"] = ctx.get_all
+
+    for name, query in QUERIES.items():
+        qctx = result_context(data)
+        ops["filter:" + name] = lambda q=query, c=qctx: drain(c.filter(q))
+
+    for order in TreeOrder:
+        if order == TreeOrder.CHILDREN_ORDER:
+            continue
+        ictx = result_context(data)
+        ops["iterate:" + order.name.lower()] = lambda o=order, c=ictx: drain(c.iterate(o))
+
+    nctx = result_context(data)
+    exts = list(nctx.ctx.filter(QUERIES["type"]))
+    ops["node"] = lambda: [Node(node_ext=e, ctx=nctx.ctx) for e in exts]
+
+    ectx = result_context(data)
+    ops["encode"] = ectx.encode
+    return ops
+
+
+def parse_types(spec: Optional[str]) -> Dict[str, float]:
+    # "uast:Identifier=0.5,python:Call=0.5"
+    if not spec:
+        return DEFAULT_TYPES
+    types = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        types[name] = float(weight or 1)
+    return types
+
+
+def run(args: argparse.Namespace) -> dict:
+    types = parse_types(args.types)
+    results: List[dict] = []
+    print("%-22s %10s %12s %12s" % ("operation", "nodes", "min ms", "median ms"))
+    for size in args.sizes:
+        tree = generate(size, fanout=args.fanout, types=types, seed=args.seed,
+                        depth=args.depth)
+        data = encode(tree)
+        nodes = drain(bblfsh.iterator(tree, TreeOrder.PRE_ORDER, nodes_only=True))
+        for op, fn in operations(data).items():
+            t = timed(fn, args.repeat)
+            best, median = t.min, t.median
+            results.append({"op": op, "size": size, "nodes": nodes,
+                            "min_ms": best * 1e3, "median_ms": median * 1e3})
+            print("%-22s %10d %12.3f %12.3f" % (op, nodes, best * 1e3, median * 1e3))
+
+    return {
+        "meta": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": args.sizes,
+            "fanout": args.fanout,
+            "depth": args.depth,
+            "types": types,
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> bool:
+    """
+    Prints the change of every operation against the baseline, by minimum time.
+    Returns False if any of them is slower than the threshold (a fraction).
+    """
+    base = {(r["op"], r["size"]): r for r in baseline["results"]}
+    ok = True
+    print()
+    print("%-22s %10s %12s %12s %8s" % ("operation", "size", "base ms", "now ms", "change"))
+    for r in current["results"]:
+        b = base.get((r["op"], r["size"]))
+        if b is None:
+            continue
+        change = r["min_ms"] / b["min_ms"] - 1 if b["min_ms"] else 0.0
+        mark = ""
+        if change > threshold:
+            mark = " !"
+            ok = False
+        print("%-22s %10d %12.3f %12.3f %+7.1f%%%s" % (r["op"], r["size"], b["min_ms"],
+                                                      r["min_ms"], change * 100, mark))
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--fanout", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=None,
+                        help="maximum depth of the trees, which limits their size")
+    parser.add_argument("--types", default=None,
+                        help="type distribution, e.g. uast:Identifier=0.7,python:Call=0.3")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", help="save the results as JSON")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="slowdown reported as a regression by --compare")
+    args = parser.parse_args()
+
+    current = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if not compare(current, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
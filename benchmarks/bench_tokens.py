@@ -0,0 +1,39 @@
+"""
+Compares extracting (token, type, roles, offset) for every identifier with
+ResultContext.tokens() and by filtering //uast:Identifier and loading each
+result.
+"""
+import argparse
+
+from synthetic import generate, result_context, timed
+
+
+def filter_and_load(ctx) -> list:
+    res = []
+    for node in ctx.filter("//uast:Identifier"):
+        value = node.get()
+        offset = value.get("@pos", {}).get("start", {}).get("offset", -1)
+        res.append((value["Name"], value["@type"], tuple(value.get("@role", ())), offset))
+    res.sort(key=lambda t: t[3])
+    return res
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("%10s %10s %12s %12s %8s" % ("nodes", "tokens", "filter ms", "tokens ms",
+                                       "speedup"))
+    for size in args.sizes:
+        ctx = result_context(generate(size))
+        expected, _, _, slow = timed(lambda: filter_and_load(ctx), args.repeat)
+        toks, _, _, fast = timed(lambda: ctx.tokens(types=["uast:Identifier"]), args.repeat)
+        assert len(toks) == len(expected)
+        print("%10d %10d %12.2f %12.2f %8.2f" % (size, len(toks), slow * 1e3, fast * 1e3,
+                                                 slow / fast))
+
+
+if __name__ == "__main__":
+    main()
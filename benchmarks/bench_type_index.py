@@ -0,0 +1,35 @@
+"""
+Compares descendant-by-type queries evaluated by libuast with the ones served
+from the ResultContext type index, for several tree sizes.
+"""
+import argparse
+
+from synthetic import generate, result_context, timed
+
+QUERIES = ["//uast:Identifier", "//python:Call", "//uast:Identifier[@Name='x1']"]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print("%10s %12s %12s %12s %8s" % ("nodes", "libuast ms", "build ms", "index ms", "speedup"))
+    for size in args.sizes:
+        ctx = result_context(generate(size))
+
+        def run() -> None:
+            for _ in range(args.repeat):
+                for q in QUERIES:
+                    list(ctx.filter(q))
+
+        native = timed(run).mean
+        build = timed(lambda: ctx.nodes_of_type("python:Module")).mean
+        indexed = timed(run).mean
+        print("%10d %12.2f %12.2f %12.2f %8.2f" % (
+            size, native * 1e3, build * 1e3, indexed * 1e3, native / (build + indexed)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+Stand-in for bblfshd that replays recorded parse responses, to measure the
+client without Docker or language drivers.
+
+It implements Driver.Parse, DriverHost.SupportedLanguages and
+DriverHost.ServerVersion, and the Version and SupportedLanguages methods of
+the v1 ProtocolService, which BblfshClient.version() and
+supported_languages() still use; the v1 parse methods are not implemented.
+Responses are serialized ParseResponse messages
+stored as *.pb files in a directory (see record()); a request gets the
+recording with the same file name or, if there is none, the next one in turn.
+Each Parse call can be delayed by a fixed latency plus a random jitter.
+
+    python3 fake_bblfshd.py --responses recordings/ --port 9432 --latency 5
+"""
+import argparse
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent import futures
+from typing import Dict, Iterable, List, Optional
+
+import grpc
+
+from bblfsh.aliases import (
+    Manifest, ParseResponse, SupportedLanguagesResponse, SupportedLanguagesResponseV2,
+    VersionResponse, VersionResponseV2, protocol_grpc_v1_module, protocol_grpc_v2_module
+)
+
+VERSION = "fake"
+
+
+def load_responses(path: str) -> Dict[str, bytes]:
+    """
+    Loads the recorded responses of a directory, by file name.
+    """
+    responses = {}
+    for name in sorted(os.listdir(path)):
+        if name.endswith(".pb"):
+            with open(os.path.join(path, name), "rb") as f:
+                responses[name[:-len(".pb")]] = f.read()
+    if not responses:
+        raise ValueError("no recorded responses (*.pb) in %s" % path)
+    return responses
+
+
+def record(client, files: Iterable[str], path: str, **parse_args) -> List[str]:
+    """
+    Parses files with a real server and stores the responses in a directory,
+    to be replayed by FakeServer. Returns the names of the recordings.
+    """
+    os.makedirs(path, exist_ok=True)
+    names = []
+    for filename in files:
+        ctx = client.parse(filename, keep_response=True, **parse_args)
+        name = os.path.basename(filename)
+        with open(os.path.join(path, name + ".pb"), "wb") as f:
+            f.write(ctx._response.SerializeToString())
+        names.append(name)
+    return names
+
+
+class _Driver(protocol_grpc_v2_module.DriverServicer):
+    def __init__(self, server: "FakeServer") -> None:
+        self.server = server
+
+    def Parse(self, request, context):
+        self.server.delay()
+        return self.server.response(request.filename)
+
+
+class _DriverHost(protocol_grpc_v2_module.DriverHostServicer):
+    def __init__(self, server: "FakeServer") -> None:
+        self.server = server
+
+    def SupportedLanguages(self, request, context):
+        return SupportedLanguagesResponseV2(languages=[
+            Manifest(name=lang, language=lang, version=VERSION)
+            for lang in self.server.languages
+        ])
+
+    def ServerVersion(self, request, context):
+        res = VersionResponseV2()
+        res.version.version = VERSION
+        return res
+
+
+class _ProtocolService(protocol_grpc_v1_module.ProtocolServiceServicer):
+    def __init__(self, server: "FakeServer") -> None:
+        self.server = server
+
+    def SupportedLanguages(self, request, context):
+        res = SupportedLanguagesResponse()
+        for lang in self.server.languages:
+            res.languages.add(name=lang, language=lang, version=VERSION)
+        return res
+
+    def Version(self, request, context):
+        res = VersionResponse(version=VERSION)
+        res.build.GetCurrentTime()
+        return res
+
+
+class FakeServer:
+    """
+    gRPC server replaying recorded responses. latency and jitter are given in
+    seconds; every Parse call sleeps for latency plus a uniform random value
+    between -jitter and jitter.
+    """
+    def __init__(self, responses: Dict[str, bytes], address: str = "127.0.0.1:0",
+                 latency: float = 0.0, jitter: float = 0.0, workers: int = 16,
+                 seed: Optional[int] = None) -> None:
+        self._responses = {name: ParseResponse.FromString(data)
+                           for name, data in responses.items()}
+        self._cycle = itertools.cycle(list(self._responses.values()))
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self.latency = latency
+        self.jitter = jitter
+        self.languages = sorted({r.language for r in self._responses.values() if r.language})
+
+        self._server = grpc.server(futures.ThreadPoolExecutor(max_workers=workers))
+        protocol_grpc_v2_module.add_DriverServicer_to_server(_Driver(self), self._server)
+        protocol_grpc_v2_module.add_DriverHostServicer_to_server(_DriverHost(self),
+                                                                 self._server)
+        protocol_grpc_v1_module.add_ProtocolServiceServicer_to_server(
+            _ProtocolService(self), self._server)
+        host = address.rsplit(":", 1)[0]
+        self.port = self._server.add_insecure_port(address)
+        self.endpoint = "%s:%d" % (host, self.port)
+
+    def delay(self) -> None:
+        if not self.latency and not self.jitter:
+            return
+        with self._lock:
+            noise = self._random.uniform(-self.jitter, self.jitter)
+        time.sleep(max(0.0, self.latency + noise))
+
+    def response(self, filename: str) -> ParseResponse:
+        res = self._responses.get(filename)
+        if res is None:
+            with self._lock:
+                res = next(self._cycle)
+        return res
+
+    def start(self) -> "FakeServer":
+        self._server.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.stop(None)
+
+    def __enter__(self) -> "FakeServer":
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.stop()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--responses", required=True, help="directory of *.pb recordings")
+    parser.add_argument("--port", type=int, default=9432)
+    parser.add_argument("--latency", type=float, default=0.0, help="milliseconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="milliseconds")
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    server = FakeServer(load_responses(args.responses), "0.0.0.0:%d" % args.port,
+                        latency=args.latency / 1e3, jitter=args.jitter / 1e3,
+                        workers=args.workers)
+    with server:
+        print("serving on %s" % server.endpoint)
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+"""
+Synthetic UAST generator used by the benchmarks, so they can run without a
+Babelfish server, and the helpers they share to build contexts and time
+operations.
+"""
+import random
+import statistics
+import time
+from collections import deque
+from typing import Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Union
+
+import bblfsh
+from bblfsh.aliases import ParseResponse
+from bblfsh.result_context import ResultContext
+
+DEFAULT_TYPES = {
+    "uast:Identifier": 0.35,
+    "uast:String": 0.10,
+    "python:Call": 0.20,
+    "python:Expr": 0.20,
+    "uast:FunctionGroup": 0.10,
+    "uast:RuntimeImport": 0.05,
+}
+
+_ROLES = {
+    "uast:Identifier": ["Identifier", "Expression"],
+    "uast:String": ["Literal", "String", "Expression"],
+    "python:Call": ["Call", "Expression"],
+    "python:Expr": ["Expression"],
+    "uast:FunctionGroup": ["Function", "Declaration"],
+    "uast:RuntimeImport": ["Import", "Declaration"],
+}
+
+
+def _position(offset: int, line: int, col: int) -> dict:
+    return {"@type": "uast:Position", "offset": offset, "line": line, "col": col}
+
+
+def _new_node(rnd: random.Random, types: List[str], weights: List[float], n: int) -> dict:
+    t = rnd.choices(types, weights)[0]
+    node = {"@type": t, "@role": list(_ROLES.get(t, ["Expression"]))}
+    if t == "uast:Identifier":
+        node["Name"] = "x%d" % (n % 97)
+    elif t == "uast:String":
+        node["Value"] = "s%d" % (n % 31)
+    return node
+
+
+def _set_positions(root: dict) -> None:
+    offset = 0
+    line = 1
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        start = offset
+        offset += 8
+        node["@pos"] = {
+            "@type": "uast:Positions",
+            "start": _position(start, line, 1),
+            "end": _position(offset - 1, line, 8),
+        }
+        line += 1
+        stack.extend(reversed(node.get("Body", [])))
+
+
+def generate(size: int, fanout: int = 4, types: Optional[Dict[str, float]] = None,
+             seed: int = 0, depth: Optional[int] = None) -> dict:
+    """
+    Generates a tree of size object nodes where every inner node has up to fanout
+    children in its "Body" field. Node types are drawn from the types
+    distribution ({type: weight}). If depth is given, no node is deeper than
+    depth levels below the root, so the tree may have fewer nodes.
+    """
+    types = types or DEFAULT_TYPES
+    names = list(types)
+    weights = [types[t] for t in names]
+    rnd = random.Random(seed)
+
+    root = {"@type": "python:Module", "@role": ["File", "Module"], "Body": []}
+    count = 1
+    queue = deque([(root, 0)])
+    while count < size and queue:
+        parent, level = queue.popleft()
+        if depth is not None and level >= depth:
+            break
+        for _ in range(min(fanout, size - count)):
+            child = _new_node(rnd, names, weights, count)
+            child["Body"] = []
+            parent["Body"].append(child)
+            queue.append((child, level + 1))
+            count += 1
+
+    _set_positions(root)
+    return root
+
+
+def encode(tree: dict) -> bytes:
+    """
+    Encodes the tree in the binary format of the parse responses.
+    """
+    return bytes(bblfsh.context(tree).encode(fmt=0))
+
+
+def result_context(tree: Union[dict, bytes], **kwargs) -> ResultContext:
+    """
+    Decodes the tree, encoding it first unless it is already encoded, as if it
+    had been received from a server. kwargs are passed to ResultContext.
+    """
+    data = tree if isinstance(tree, bytes) else encode(tree)
+    return ResultContext(ParseResponse(uast=data, language="synthetic"), **kwargs)
+
+
+def drain(it: Iterable) -> int:
+    """
+    Consumes an iterator and returns the number of items.
+    """
+    return sum(1 for _ in it)
+
+
+class Timing(NamedTuple):
+    # the result of the last call and its times in seconds
+    result: Any
+    min: float
+    median: float
+    mean: float
+
+
+def timed(fn: Callable[[], Any], repeat: int = 1) -> Timing:
+    """
+    Calls fn repeat times, timing every call.
+    """
+    times = []
+    res = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = fn()
+        times.append(time.perf_counter() - start)
+    return Timing(res, min(times), statistics.median(times), statistics.mean(times))
@@ -325,9 +325,15 @@ def main():
     else:  # POSIX
         extra_objects = ['{}.a'.format(l) for l in static_libraries]
 
+    # PYUAST_STATS=1 compiles the profiling counters returned by pyuast.stats()
+    define_macros = []
+    if os.environ.get("PYUAST_STATS", "0") not in ("", "0"):
+        define_macros.append(("PYUAST_STATS", "1"))
+
     libuast_module = Extension(
         "bblfsh.pyuast",
         libraries=libraries,
+        define_macros=define_macros,
         extra_compile_args=["-std=c++11"],
         extra_objects=extra_objects,
         include_dirs=[j("bblfsh", "libuast")],